@@ -15,6 +15,527 @@ def counter():
     print(c.most_common(2))
 
 
+# ------------------------ Streaming counters ------------------------
+# Counter keeps an entry for every distinct key, on an endless stream of events with
+# hundreds of millions of keys most_common() runs out of memory long before the end.
+# The classes below use a fixed amount of memory, chosen up front, and give approximate
+# answers with known error bounds:
+#
+#   SpaceSaving(k)              top-k keys, every count is at most total / k too high
+#   CountMinSketch(w, d)        count of any key, too high by at most e / w * total
+#                               with probability 1 - e ** -d
+#   HyperLogLog(p)              number of distinct keys, about 1.04 / sqrt(2 ** p) error
+#   StreamCounter               all three behind a Counter-like API
+#
+#   c = StreamCounter(k=1000)
+#   c.update(events)            # iterable of keys, or a mapping key -> count
+#   c.most_common(10), c['foo'], c.distinct(), c.merge(other_counter)
+#
+# Keys are hashed with blake2b of a type tag and their bytes (str as utf-8, bytes as they
+# are, numbers by value, tuples item by item, other objects by repr()), not with hash(),
+# which is different in every process, so counters from different processes and machines
+# can be merged. Objects whose repr() is just their address are rejected.
+# The sketches are plain arrays.
+
+import heapq
+import math
+import struct
+import sys
+from array import array
+from collections import Counter
+from hashlib import blake2b
+
+
+def _key_bytes(key):
+    # A type tag keeps 1, '1' and b'1' apart. Equal numbers are equal keys, as in Counter.
+    if isinstance(key, str):
+        return b's' + key.encode()
+    if isinstance(key, (bytes, bytearray)):
+        return b'b' + bytes(key)
+    if isinstance(key, float) and key.is_integer():
+        key = int(key)
+    if isinstance(key, int):
+        return b'i' + key.to_bytes((key.bit_length() + 8) // 8, 'little', signed=True)
+    if isinstance(key, float):
+        return b'f' + struct.pack('<d', key)
+    if key is None:
+        return b'n'
+    if isinstance(key, tuple):
+        parts = [_key_bytes(item) for item in key]
+        return b't' + b''.join(len(part).to_bytes(4, 'little') + part for part in parts)
+    if type(key).__repr__ is object.__repr__:
+        raise TypeError('Can not hash {!r} the same way in every process, its repr() is its address; '
+                        'use a str, bytes, number or tuple key'.format(type(key).__name__))
+    return b'r' + type(key).__qualname__.encode() + b':' + repr(key).encode()
+
+
+def _hash64(key):
+    return int.from_bytes(blake2b(_key_bytes(key), digest_size=8).digest(), 'little')
+
+
+def _chunks_of_counts(items, chunk_size=65536):
+    # Counting a chunk first saves the sketches the work for every repeated key
+    if hasattr(items, 'items'):
+        yield items
+        return
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield Counter(chunk)
+            chunk = []
+    if chunk:
+        yield Counter(chunk)
+
+
+class SpaceSaving:
+    def __init__(self, k=1000):
+        if k < 1:
+            raise ValueError('k has to be at least 1')
+        self.k = k
+        self.total = 0
+        self._slots = {}                    # key -> slot
+        self._keys = []                     # slot -> key
+        self._counts = array('q')
+        self._errors = array('q')
+        self._heap = []                     # (count, slot), the count may be too low
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _min_slot(self):
+        heap, counts = self._heap, self._counts
+        while True:
+            count, slot = heap[0]
+            if counts[slot] == count:
+                return slot
+            heapq.heapreplace(heap, (counts[slot], slot))
+
+    def add(self, key, count=1):
+        self.total += count
+        slot = self._slots.get(key)
+        if slot is not None:
+            self._counts[slot] += count
+        elif len(self._keys) < self.k:
+            slot = len(self._keys)
+            self._slots[key] = slot
+            self._keys.append(key)
+            self._counts.append(count)
+            self._errors.append(0)
+            heapq.heappush(self._heap, (count, slot))
+        else:
+            # Replace the key with the smallest count, the new key might have had that many
+            slot = self._min_slot()
+            smallest = self._counts[slot]
+            del self._slots[self._keys[slot]]
+            self._slots[key] = slot
+            self._keys[slot] = key
+            self._counts[slot] = smallest + count
+            self._errors[slot] = smallest
+            heapq.heapreplace(self._heap, (smallest + count, slot))
+
+    def update(self, items):
+        for counts in _chunks_of_counts(items):
+            add = self.add
+            for key, count in counts.items():
+                add(key, count)
+
+    def __getitem__(self, key):
+        slot = self._slots.get(key)
+        if slot is None:
+            return self.min_count()
+        return self._counts[slot]
+
+    def min_count(self):
+        # Any key that is not monitored was seen at most this many times
+        if len(self._keys) < self.k:
+            return 0
+        return self._counts[self._min_slot()]
+
+    def bounds(self, key):
+        slot = self._slots.get(key)
+        if slot is None:
+            return 0, self.min_count()
+        return self._counts[slot] - self._errors[slot], self._counts[slot]
+
+    def most_common(self, n=None):
+        counts = self._counts
+        pairs = ((self._keys[slot], counts[slot]) for slot in range(len(self._keys)))
+        if n is None:
+            return sorted(pairs, key=lambda pair: pair[1], reverse=True)
+        return heapq.nlargest(n, pairs, key=lambda pair: pair[1])
+
+    def guaranteed(self, n=None):
+        # Keys of most_common(n) whose lower bound beats the upper bound of every key after them
+        top = self.most_common()
+        result = []
+        for i, (key, count) in enumerate(top[:n] if n is not None else top):
+            following = top[i + 1][1] if i + 1 < len(top) else self.min_count()
+            if count - self._errors[self._slots[key]] < following:
+                break
+            result.append((key, count))
+        return result
+
+    def merge(self, other):
+        # A key missing in one summary may have had up to its min_count there
+        merged = {}
+        for summary in (self, other):
+            missing = summary.min_count()
+            counts, errors, slots = summary._counts, summary._errors, summary._slots
+            for key in set(self._slots).union(other._slots):
+                slot = slots.get(key)
+                count, error = (missing, missing) if slot is None else (counts[slot], errors[slot])
+                old_count, old_error = merged.get(key, (0, 0))
+                merged[key] = (old_count + count, old_error + error)
+        result = SpaceSaving(self.k)
+        result.total = self.total + other.total
+        for key, (count, error) in heapq.nlargest(self.k, merged.items(), key=lambda item: item[1][0]):
+            slot = len(result._keys)
+            result._slots[key] = slot
+            result._keys.append(key)
+            result._counts.append(count)
+            result._errors.append(error)
+            result._heap.append((count, slot))
+        heapq.heapify(result._heap)
+        return result
+
+
+class CountMinSketch:
+    def __init__(self, width=2 ** 16, depth=4):
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self._table = array('q', bytes(8 * width * depth))
+
+    @classmethod
+    def from_error(cls, epsilon=0.0001, delta=0.01):
+        # Estimates are at most epsilon * total too high with probability 1 - delta
+        return cls(math.ceil(math.e / epsilon), math.ceil(math.log(1 / delta)))
+
+    def _cells(self, h):
+        # Rows use h1 + row * h2, two halves of one hash are as good as depth hashes
+        h1, h2 = h & 0xffffffff, (h >> 32) | 1
+        width = self.width
+        return [row * width + (h1 + row * h2) % width for row in range(self.depth)]
+
+    def add(self, key, count=1):
+        self._add_hash(_hash64(key), count)
+
+    def _add_hash(self, h, count):
+        self.total += count
+        table = self._table
+        for cell in self._cells(h):
+            table[cell] += count
+
+    def update(self, items):
+        for counts in _chunks_of_counts(items):
+            add = self.add
+            for key, count in counts.items():
+                add(key, count)
+
+    def __getitem__(self, key):
+        table = self._table
+        return min(table[cell] for cell in self._cells(_hash64(key)))
+
+    def merge(self, other):
+        if (self.width, self.depth) != (other.width, other.depth):
+            raise ValueError('Only sketches of the same size can be merged')
+        result = CountMinSketch(self.width, self.depth)
+        result.total = self.total + other.total
+        result._table = array('q', map(int.__add__, self._table, other._table))
+        return result
+
+
+class HyperLogLog:
+    def __init__(self, p=14):
+        if not 4 <= p <= 18:
+            raise ValueError('p has to be between 4 and 18')
+        self.p = p
+        self._registers = bytearray(2 ** p)
+
+    def add(self, key):
+        self._add_hash(_hash64(key))
+
+    def _add_hash(self, h):
+        p = self.p
+        index = h >> (64 - p)
+        rest = h & ((1 << (64 - p)) - 1)
+        rank = 64 - p - rest.bit_length() + 1
+        if rank > self._registers[index]:
+            self._registers[index] = rank
+
+    def update(self, items):
+        for counts in _chunks_of_counts(items):
+            add = self.add
+            for key in counts:
+                add(key)
+
+    def __len__(self):
+        return round(self.count())
+
+    def count(self):
+        m = len(self._registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self._registers)
+        zeros = self._registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Few keys, linear counting is more precise
+            return m * math.log(m / zeros)
+        return estimate
+
+    def merge(self, other):
+        if self.p != other.p:
+            raise ValueError('Only HyperLogLogs with the same p can be merged')
+        result = HyperLogLog(self.p)
+        result._registers = bytearray(map(max, self._registers, other._registers))
+        return result
+
+
+class StreamCounter:
+    def __init__(self, k=1000, width=2 ** 16, depth=4, p=14):
+        self.top = SpaceSaving(k)
+        self.sketch = CountMinSketch(width, depth)
+        self.distinct_keys = HyperLogLog(p)
+
+    def update(self, items):
+        top, sketch, distinct_keys = self.top, self.sketch, self.distinct_keys
+        for counts in _chunks_of_counts(items):
+            for key, count in counts.items():
+                h = _hash64(key)
+                top.add(key, count)
+                sketch._add_hash(h, count)
+                distinct_keys._add_hash(h)
+
+    @property
+    def total(self):
+        return self.sketch.total
+
+    def __getitem__(self, key):
+        # Both are upper bounds, the smaller one is closer
+        return min(self.sketch[key], self.top[key])
+
+    def most_common(self, n=None):
+        return self.top.most_common(n)
+
+    def distinct(self):
+        return len(self.distinct_keys)
+
+    def merge(self, other):
+        result = StreamCounter.__new__(StreamCounter)
+        result.top = self.top.merge(other.top)
+        result.sketch = self.sketch.merge(other.sketch)
+        result.distinct_keys = self.distinct_keys.merge(other.distinct_keys)
+        return result
+
+    def memory(self):
+        # Bytes used by the arrays of the three structures, the k keys themselves not included
+        top = self.top
+        return (top._counts.itemsize * top.k * 2 + sys.getsizeof(top._slots) + sys.getsizeof(top._keys)
+                + len(self.sketch._table) * self.sketch._table.itemsize + len(self.distinct_keys._registers))
+
+
+def streaming_counter(events=1000000, keys=200000):
+    import random
+    import time
+    import tracemalloc
+
+    # Zipf-like stream, a few keys are very common and there is a long tail
+    rng = random.Random(1)
+    weights = [1 / (i + 1) for i in range(keys)]
+    stream = ['key-{}'.format(i) for i in rng.choices(range(keys), weights, k=events)]
+
+    def measure(count):
+        start = time.perf_counter()
+        result = count()
+        elapsed = time.perf_counter() - start
+        # tracemalloc slows everything down, memory is measured in a second run
+        tracemalloc.start()
+        count()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return result, elapsed, peak
+
+    def stream_count():
+        c = StreamCounter(k=1000)
+        c.update(stream)
+        return c
+
+    exact, exact_time, exact_memory = measure(lambda: Counter(stream))
+    c, stream_time, stream_memory = measure(stream_count)
+    print('Counter        {:.2f} s, peak {:6.1f} MiB'.format(exact_time, exact_memory / 2 ** 20))
+    print('StreamCounter  {:.2f} s, peak {:6.1f} MiB (fixed: {:.1f} MiB)'.format(
+        stream_time, stream_memory / 2 ** 20, c.memory() / 2 ** 20))
+    print('{:10} {:>8} {:>8} {:>8}'.format('key', 'exact', 'top-k', 'sketch'))
+    for key, count in c.most_common(5):
+        print('{:10} {:8} {:8} {:8}'.format(key, exact[key], count, c.sketch[key]))
+    print('distinct keys: exact {}, HyperLogLog {}'.format(len(exact), c.distinct()))
+    top = set(key for key, _ in exact.most_common(10))
+    print('top 10 found: {}/10'.format(len(top & set(key for key, _ in c.most_common(10)))))
+
+    # Halves counted separately (other processes, other machines) and merged
+    first, second = StreamCounter(k=1000), StreamCounter(k=1000)
+    first.update(stream[:events // 2])
+    second.update(stream[events // 2:])
+    merged = first.merge(second)
+    print('merged halves: top 5 {}, distinct {}'.format([key for key, _ in merged.most_common(5)],
+                                                         merged.distinct()))
+
+
+# ------------------------ Parallel counting ------------------------
+# counter() counts on one core. parallel_count() cuts the input into chunks, counts every
+# chunk with a Counter in a process pool, and merges the Counters as a tree: two results
+# of the same level are merged (also in the pool) into one of the next level, so there
+# is no single huge merge at the end and merging runs in parallel with counting.
+#
+#   parallel_count('access.log', key=path_of_line, workers=8)
+#   parallel_count(events, key=itemgetter('user'), workers=4, chunk_size=100000)
+#
+# A file name is split into ranges of about chunk_bytes, cut at line ends, and every worker
+# reads its range itself, so only the counts go through pipes. Lines end at '\n' (or
+# '\r\n') and are passed to key without the line end. Any other iterable is read lazily, chunk_size items at a time,
+# with only a few chunks per worker in flight, so it can be endless or bigger than memory.
+# key (and the items) go to other processes, so key has to be picklable: a function
+# defined at module level, operator.itemgetter..., not a lambda.
+
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+
+
+def _count_items(items, key):
+    return Counter(items if key is None else map(key, items))
+
+
+def _count_file_range(path, start, end, key, encoding):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode(encoding)
+    # Ranges are cut after b'\n', so split on that only. splitlines() would also split on
+    # \x0b, \x1c, \u2028... inside a line, which reading the file line by line doesn't.
+    if '\r\n' in text:
+        text = text.replace('\r\n', '\n')
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    return _count_items(lines, key)
+
+
+def _merge_counters(a, b):
+    if len(a) < len(b):
+        a, b = b, a
+    a.update(b)
+    return a
+
+
+def _file_ranges(path, chunk_bytes):
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for offset in range(chunk_bytes, size, chunk_bytes):
+            # The range ends after the line that contains offset
+            f.seek(offset - 1)
+            f.readline()
+            if f.tell() > bounds[-1] and f.tell() < size:
+                bounds.append(f.tell())
+    bounds.append(size)
+    return zip(bounds, bounds[1:])
+
+
+def _chunked(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _map_tree_reduce(executor, tasks, window):
+    waiting = {}            # level -> result waiting for another result of the same level
+    running = {}            # future -> level
+    tasks = iter(tasks)
+    exhausted = False
+    while True:
+        while not exhausted and len(running) < window:
+            task = next(tasks, None)
+            if task is None:
+                exhausted = True
+            else:
+                running[executor.submit(*task)] = 0
+        if not running:
+            break
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            level = running.pop(future)
+            result = future.result()
+            other = waiting.pop(level, None)
+            if other is None:
+                waiting[level] = result
+            else:
+                running[executor.submit(_merge_counters, other, result)] = level + 1
+    # At most one result per level is left
+    total = Counter()
+    for level in sorted(waiting):
+        total = _merge_counters(total, waiting[level])
+    return total
+
+
+def parallel_count(source, key=None, workers=None, chunk_size=100000, chunk_bytes=16 * 2 ** 20,
+                   encoding='utf-8', executor=None):
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(workers)
+    window = 2 * (workers or os.cpu_count() or 1)
+    try:
+        if isinstance(source, (str, os.PathLike)):
+            tasks = ((_count_file_range, source, start, end, key, encoding)
+                     for start, end in _file_ranges(source, chunk_bytes))
+        else:
+            tasks = ((_count_items, chunk, key) for chunk in _chunked(source, chunk_size))
+        return _map_tree_reduce(executor, tasks, window)
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+
+def _log_path(line):
+    return line.split(' ', 4)[3]
+
+
+def parallel_counting(size_mb=64, workers=(1, 2, 4, 8)):
+    import random
+    import tempfile
+    import time
+
+    rng = random.Random(1)
+    paths = ['/api/items/{}'.format(i) for i in range(5000)]
+    with tempfile.NamedTemporaryFile('w', suffix='.log', delete=False) as f:
+        name = f.name
+        written = 0
+        while written < size_mb * 2 ** 20:
+            block = ''.join('2018-07-23 12:{:02}:{:02} GET {} {}\n'.format(
+                rng.randrange(60), rng.randrange(60), paths[int(rng.paretovariate(1.2)) % len(paths)],
+                rng.choice((200, 200, 200, 404, 500))) for _ in range(10000))
+            f.write(block)
+            written += len(block)
+    try:
+        start = time.perf_counter()
+        with open(name) as f:
+            expected = Counter(_log_path(line) for line in f)
+        base = time.perf_counter() - start
+        print('{} MiB log, {} CPUs'.format(size_mb, os.cpu_count()))
+        print('Counter, one process      {:.2f} s'.format(base))
+        for n in workers:
+            start = time.perf_counter()
+            counts = parallel_count(name, key=_log_path, workers=n, chunk_bytes=4 * 2 ** 20)
+            elapsed = time.perf_counter() - start
+            assert counts == expected
+            print('parallel_count, {} workers {:.2f} s  ({:.1f}x)'.format(n, elapsed, base / elapsed))
+        print(counts.most_common(3))
+    finally:
+        os.remove(name)
+
+
 def sort_dict():
     from operator import itemgetter
     rows = [{'first_name': 'John', 'last_name': 'Bob', 'address': 'some_address 5-12'},
@@ -103,18 +624,181 @@ def group_items():
     # print('-' * 10)
     # print(rows)
     # print('-' * 10)
-    # Iterate by groups
-    for date, items in groupby(rows, key=itemgetter('date')):
+    # Iterate by groups, external_sort() (below) sorts in memory when the rows fit in
+    # memory_budget and through temporary files when they don't
+    for date, items in groupby(external_sort(rows, key=itemgetter('date')), key=itemgetter('date')):
         print(date)
         for i in items:
             print('', i)
 
 
+# ------------------------ External sort ------------------------
+# groupby() needs its input sorted by the key, and sorted() needs all of it in memory.
+# external_sort() sorts any iterable within a memory budget:
+#   1. items are collected until they take about memory_budget (estimated with
+#      sys.getsizeof), sorted and written to a temporary file as a run of pickled blocks,
+#   2. the runs are merged lazily with heapq.merge, reading one block of every run at a
+#      time. With more runs than fit in the budget they are merged in several passes.
+# With workers > 1 the runs are sorted and written in a process pool while the next run is
+# collected, the budget is then shared by all the processes. key has to be picklable then.
+#
+#   for date, items in external_groupby(read_transactions(), key=itemgetter('date'),
+#                                       memory_budget=512 * 2 ** 20, workers=4):
+#       ...
+#
+# When everything fits in one run nothing is written, it is just sorted(). The temporary
+# files are removed when the result is exhausted or closed.
 
-def group_items_second_example():
-    from itertools import groupby
+import pickle
+import shutil
+import tempfile
+from itertools import groupby
+
+
+def _item_size(item):
+    size = sys.getsizeof(item)
+    if isinstance(item, dict):
+        item = item.values()
+    elif not isinstance(item, (tuple, list)):
+        return size
+    return size + sum(sys.getsizeof(value) for value in item)
+
+
+def _write_run(items, key, reverse, directory, block_items):
+    items.sort(key=key, reverse=reverse)
+    with tempfile.NamedTemporaryFile('wb', dir=directory, suffix='.run', delete=False) as f:
+        for start in range(0, len(items), block_items):
+            pickle.dump(items[start:start + block_items], f, pickle.HIGHEST_PROTOCOL)
+    return f.name
+
+
+def _read_run(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                block = pickle.load(f)
+            except EOFError:
+                return
+            yield from block
+
+
+def _merge_runs(paths, key, reverse, directory, block_items, fan_in):
+    # Merge passes until the runs fit into one merge
+    while len(paths) > fan_in:
+        merged = []
+        for start in range(0, len(paths), fan_in):
+            group = paths[start:start + fan_in]
+            with tempfile.NamedTemporaryFile('wb', dir=directory, suffix='.run', delete=False) as f:
+                block = []
+                for item in heapq.merge(*map(_read_run, group), key=key, reverse=reverse):
+                    block.append(item)
+                    if len(block) == block_items:
+                        pickle.dump(block, f, pickle.HIGHEST_PROTOCOL)
+                        block = []
+                if block:
+                    pickle.dump(block, f, pickle.HIGHEST_PROTOCOL)
+            for path in group:
+                os.remove(path)
+            merged.append(f.name)
+        paths = merged
+    return heapq.merge(*map(_read_run, paths), key=key, reverse=reverse)
+
+
+def external_sort(iterable, key=None, reverse=False, memory_budget=64 * 2 ** 20, workers=1, tmpdir=None,
+                  block_bytes=2 ** 18):
+    # Sorting needs about as much again as the items for the list and the keys
+    run_budget = memory_budget // (2 * workers) if workers > 1 else memory_budget // 2
+    it = iter(iterable)
+    buffer, used = [], 0
+    for item in it:
+        buffer.append(item)
+        used += _item_size(item)
+        if used >= run_budget:
+            break
+    else:
+        # Fits in memory
+        yield from sorted(buffer, key=key, reverse=reverse)
+        return
+
+    directory = tempfile.mkdtemp(prefix='external-sort-', dir=tmpdir)
+    executor = ProcessPoolExecutor(workers - 1) if workers > 1 else None
+    try:
+        block_items = max(1, block_bytes * len(buffer) // used)
+        paths, running = [], []
+        while buffer:
+            if executor is None:
+                paths.append(_write_run(buffer, key, reverse, directory, block_items))
+            else:
+                running.append(executor.submit(_write_run, buffer, key, reverse, directory, block_items))
+                if len(running) >= workers - 1:
+                    # Don't collect more runs than the workers can take
+                    paths.append(running.pop(0).result())
+            buffer, used = [], 0
+            for item in it:
+                buffer.append(item)
+                used += _item_size(item)
+                if used >= run_budget:
+                    break
+        paths.extend(future.result() for future in running)
+        fan_in = max(2, memory_budget // (4 * block_bytes))
+        yield from _merge_runs(paths, key, reverse, directory, block_items, fan_in)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def external_groupby(iterable, key, **options):
+    return groupby(external_sort(iterable, key=key, **options), key=key)
+
+
+def _transactions(count, seed=1):
+    import random
+    rng = random.Random(seed)
+    for i in range(count):
+        yield ('{:02}/{:02}/2018'.format(rng.randrange(1, 13), rng.randrange(1, 29)),
+               '{} N CLARK'.format(rng.randrange(10000)), i, rng.random() * 100)
+
+
+def _sort_in_process(count, memory_budget, workers):
+    import resource
+    import time
     from operator import itemgetter
 
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    groups = 0
+    if memory_budget is None:
+        ordered = sorted(_transactions(count), key=itemgetter(0))
+    else:
+        ordered = external_sort(_transactions(count), key=itemgetter(0), memory_budget=memory_budget,
+                                workers=workers)
+    for date, items in groupby(ordered, key=itemgetter(0)):
+        groups += 1
+        for _ in items:
+            pass
+    elapsed = time.perf_counter() - start
+    grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+    return elapsed, grown * 1024, groups
+
+
+def external_sort_benchmark(count=2 * 10 ** 6, memory_budget=64 * 2 ** 20, workers=(1, 2)):
+    # Every variant runs in a fresh process, so its peak RSS is its own
+    variants = [('sorted() in memory', None, 1)]
+    variants += [('external_sort, {} worker{}'.format(n, 's' if n > 1 else ''), memory_budget, n) for n in workers]
+    print('{:,} rows, memory budget {} MiB'.format(count, memory_budget // 2 ** 20))
+    for label, budget, n in variants:
+        with ProcessPoolExecutor(1) as pool:
+            elapsed, grown, groups = pool.submit(_sort_in_process, count, budget, n).result()
+        print('  {:26} {:6.2f} s, peak RSS grew {:6.1f} MiB, {} groups'.format(label, elapsed, grown / 2 ** 20,
+                                                                               groups))
+
+
+def group_items_second_example():
+    '''
+        Groups are listed in the order their first row appears in input. The sorted()
+        and groupby() version this replaces listed them sorted by (dept, sku).
+    '''
     input = [
         {'dept': '001', 'sku': 'foo', 'transId': 'uniqueId1', 'qty': 100},
         {'dept': '001', 'sku': 'bar', 'transId': 'uniqueId2', 'qty': 200},
@@ -128,27 +812,290 @@ def group_items_second_example():
     # 1) Get output based on aggregation
     # 2) Get output based on average
 
-    grouped = itemgetter('dept', 'sku')
-    aggregation_result = []
-    average_result = []
-    # -------------------- Aggregation --------------
-    for key, group in groupby(sorted(input, key=grouped), grouped):
-        temp_dict = dict(zip(['dept', 'sku'], key))
-        temp_dict['qty'] = sum(item['qty'] for item in group)
-        aggregation_result.append(temp_dict)
+    # Sorting and groupby() is O(n log n) for every aggregation, aggregate() (below) does
+    # all of them in one pass over the rows with a dict of groups
+
+    # -------------------- Aggregation and average --------------
+    result = aggregate(input, ('dept', 'sku'), qty=('qty', 'sum'), avg=('qty', 'mean'))
+    aggregation_result = [{'dept': row['dept'], 'sku': row['sku'], 'qty': row['qty']} for row in result]
+    average_result = [{'dept': row['dept'], 'sku': row['sku'], 'avg': row['avg']} for row in result]
     # for i in aggregation_result:
     #     print(i)
-    # --------------------- Average ------------------
-    for key, group in groupby(sorted(input, key=grouped), grouped):
-        temp_dict = dict(zip(['depth', 'sku'], key))
-        temp_list = [item['qty'] for item in group]
-        temp_dict['avg'] = sum(temp_list) / len(temp_list)
-        average_result.append(temp_dict)
 
     for i in average_result:
         print(i)
 
 
+# ------------------------ Hash aggregation ------------------------
+# aggregate() groups rows by the key fields and computes any number of aggregations in a
+# single pass, without sorting: sum, count, mean, min, max and distinct (number of
+# distinct values).
+#
+#   aggregate(rows, ('dept', 'sku'), total=('qty', 'sum'), avg=('qty', 'mean'),
+#             biggest=('qty', 'max'), orders=('transId', 'count'), skus=('sku', 'distinct'))
+#
+# rows can be any iterable (a generator reading a file works, only the groups are kept in
+# memory) of dicts or sequences (fields are then indexes), or a dict of columns
+# {'dept': [...], 'qty': [...]}. output='rows' gives a list of dicts, output='columns' a dict
+# of lists (numpy arrays with the numpy backend).
+# The loop for the given fields and aggregations is generated as Python source and
+# compiled once, so every row costs one dict lookup and a few additions.
+# backend='numpy' (or 'auto' with columns when numpy is installed) works on whole columns:
+# key columns are factorized (numbered by one argsort, or by their value for integers in a
+# small range) and combined into one group id, then bincount / reduceat compute the
+# aggregations. Groups come out in sorted key order there,
+# and in order of first appearance in the Python backend.
+
+from collections.abc import Mapping
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_AGGREGATIONS = ('sum', 'count', 'mean', 'min', 'max', 'distinct')
+_aggregators = {}
+
+
+def _parse_aggregations(aggregations):
+    specs = []
+    for name, spec in aggregations.items():
+        field, function = spec
+        if function not in _AGGREGATIONS:
+            raise ValueError('Unknown aggregation {!r}, use one of {}'.format(function, ', '.join(_AGGREGATIONS)))
+        specs.append((name, field, function))
+    return tuple(specs)
+
+
+def _state_slots(specs):
+    # The state of a group is a list, mean shares the sum and the row count with the others
+    slots = {}
+    for name, field, function in specs:
+        if function == 'mean':
+            slots.setdefault(('sum', field), len(slots))
+            slots.setdefault(('count', None), len(slots))
+        elif function == 'count':
+            slots.setdefault(('count', None), len(slots))
+        else:
+            slots.setdefault((function, field), len(slots))
+    return slots
+
+
+def _compile_aggregator(by, specs, access):
+    slots = _state_slots(specs)
+    initial = {'sum': '0', 'count': '0', 'min': 'None', 'max': 'None', 'distinct': 'set()'}
+    fields = list(dict.fromkeys(field for (_, field) in slots if field is not None))
+    if len(by) == 1:
+        key = 'row[{!r}]'.format(access[by[0]])
+    else:
+        key = '({},)'.format(', '.join('row[{!r}]'.format(access[field]) for field in by))
+    lines = ['def aggregate_rows(rows, groups):',
+             '    get = groups.get',
+             '    for row in rows:',
+             '        key = {}'.format(key),
+             '        s = get(key)',
+             '        if s is None:',
+             '            s = groups[key] = [{}]'.format(', '.join(initial[kind] for kind, _ in slots))]
+    for i, field in enumerate(fields):
+        lines.append('        v{} = row[{!r}]'.format(i, access[field]))
+    for (kind, field), index in slots.items():
+        v = 'v{}'.format(fields.index(field)) if field is not None else None
+        if kind == 'sum':
+            lines.append('        s[{}] += {}'.format(index, v))
+        elif kind == 'count':
+            lines.append('        s[{}] += 1'.format(index))
+        elif kind == 'distinct':
+            lines.append('        s[{}].add({})'.format(index, v))
+        else:
+            compare = '<' if kind == 'min' else '>'
+            lines.append('        if s[{0}] is None or {1} {2} s[{0}]:'.format(index, v, compare))
+            lines.append('            s[{}] = {}'.format(index, v))
+    namespace = {}
+    exec('\n'.join(lines), namespace)
+    return namespace['aggregate_rows'], slots
+
+
+def _finish(state, slots, name, field, function):
+    if function == 'mean':
+        return state[slots['sum', field]] / state[slots['count', None]]
+    if function == 'count':
+        return state[slots['count', None]]
+    if function == 'distinct':
+        return len(state[slots['distinct', field]])
+    return state[slots[function, field]]
+
+
+def _aggregate_python(data, by, specs):
+    if isinstance(data, Mapping):
+        needed = list(dict.fromkeys(list(by) + [field for _, field, _ in specs]))
+        access = {field: i for i, field in enumerate(needed)}
+        rows = zip(*(data[field] for field in needed))
+    else:
+        access = {field: field for field in list(by) + [field for _, field, _ in specs]}
+        rows = data
+    cache_key = (by, specs, tuple(access.items()))
+    compiled = _aggregators.get(cache_key)
+    if compiled is None:
+        compiled = _aggregators[cache_key] = _compile_aggregator(by, specs, access)
+    aggregate_rows, slots = compiled
+    groups = {}
+    aggregate_rows(rows, groups)
+    columns = {field: [] for field in by}
+    if len(by) == 1:
+        columns[by[0]] = list(groups)
+    else:
+        for field, values in zip(by, zip(*groups) if groups else [()] * len(by)):
+            columns[field] = list(values)
+    states = groups.values()
+    for name, field, function in specs:
+        columns[name] = [_finish(state, slots, name, field, function) for state in states]
+    return columns
+
+
+def _factorize(column):
+    # Returns (codes, values) with values[codes] == column. Integers in a small range are
+    # their own codes, which saves a sort
+    column = np.asarray(column)
+    if column.dtype.kind in 'iu' and len(column):
+        low, high = int(column.min()), int(column.max())
+        if high - low <= 2 * len(column) + 2 ** 16:
+            return (column - low).astype(np.int64), np.arange(low, high + 1, dtype=column.dtype)
+    # Like np.unique(return_inverse=True), which is a lot slower in some numpy versions
+    order = np.argsort(column, kind='stable')
+    ordered = column[order]
+    new_value = np.concatenate(([True], ordered[1:] != ordered[:-1])) if len(column) else np.zeros(0, bool)
+    codes = np.empty(len(column), np.int64)
+    codes[order] = np.cumsum(new_value) - 1
+    return codes, ordered[new_value]
+
+
+def _aggregate_numpy(data, by, specs):
+    if not isinstance(data, Mapping):
+        rows = list(data)
+        data = {field: [row[field] for row in rows] for field in set(by).union(field for _, field, _ in specs)}
+    codes = None
+    for field in by:
+        inverse, unique = _factorize(data[field])
+        if codes is None:
+            codes = inverse
+            continue
+        if len(codes) and (int(codes.max()) + 1) * len(unique) >= 2 ** 62:
+            # Would overflow int64, renumber the combinations so far to 0 .. groups - 1
+            codes = _factorize(codes)[0]
+        codes = codes * len(unique) + inverse
+    # One sort of the combined codes gives the groups and the order for reduceat
+    order = np.argsort(codes, kind='stable')
+    ordered_codes = codes[order]
+    if len(codes):
+        starts = np.concatenate(([0], np.flatnonzero(ordered_codes[1:] != ordered_codes[:-1]) + 1))
+    else:
+        starts = np.zeros(0, np.int64)
+    group_codes = ordered_codes[starts]
+    size = len(group_codes)
+    counts = np.diff(np.concatenate((starts, [len(codes)])))
+    groups = np.empty(len(codes), np.int64)
+    groups[order] = np.repeat(np.arange(size), counts)
+    # Keys of a group are taken from its first row
+    first_rows = order[starts]
+    columns = {field: np.asarray(data[field])[first_rows] for field in by}
+    for name, field, function in specs:
+        if function == 'count':
+            columns[name] = counts
+            continue
+        values = np.asarray(data[field])
+        if function == 'distinct':
+            # Distinct (group, value) pairs, counted per group
+            value_codes, distinct_values = _factorize(values)
+            spread = len(distinct_values) or 1
+            pairs = groups * spread + value_codes
+            if size * spread <= 4 * len(pairs) + 2 ** 20:
+                seen = np.bincount(pairs, minlength=size * spread) > 0
+                columns[name] = seen.reshape(size, spread).sum(axis=1)
+            else:
+                pairs.sort()
+                first = np.concatenate(([True], pairs[1:] != pairs[:-1]))
+                columns[name] = np.bincount(pairs[first] // spread, minlength=size)
+            continue
+        # Rows of one group are next to each other, reduceat works on the slices
+        ordered = values[order]
+        if function in ('sum', 'mean'):
+            sums = np.add.reduceat(ordered, starts) if len(ordered) else ordered[:0]
+            columns[name] = sums if function == 'sum' else sums / counts
+        elif function == 'min':
+            columns[name] = np.minimum.reduceat(ordered, starts) if len(ordered) else ordered[:0]
+        else:
+            columns[name] = np.maximum.reduceat(ordered, starts) if len(ordered) else ordered[:0]
+    return columns
+
+
+def aggregate(data, by, output='rows', backend='auto', **aggregations):
+    by = (by,) if isinstance(by, (str, int)) else tuple(by)
+    specs = _parse_aggregations(aggregations)
+    if backend == 'auto':
+        backend = 'numpy' if np is not None and isinstance(data, Mapping) else 'python'
+    if backend == 'numpy':
+        if np is None:
+            raise RuntimeError('The numpy backend needs numpy installed')
+        columns = _aggregate_numpy(data, by, specs)
+    elif backend == 'python':
+        columns = _aggregate_python(data, by, specs)
+    else:
+        raise ValueError('Unknown backend {!r}'.format(backend))
+    if output == 'columns':
+        return columns
+    if output != 'rows':
+        raise ValueError("output has to be 'rows' or 'columns'")
+    if backend == 'numpy':
+        columns = {name: column.tolist() for name, column in columns.items()}
+    names = list(columns)
+    return [dict(zip(names, values)) for values in zip(*columns.values())]
+
+
+def aggregation_benchmark(sizes=(10 ** 6, 10 ** 7)):
+    import random
+    import time
+    from itertools import groupby
+    from operator import itemgetter
+
+    def rows(count, seed=1):
+        rng = random.Random(seed)
+        for i in range(count):
+            yield {'dept': '{:03}'.format(rng.randrange(50)), 'sku': 'sku{}'.format(rng.randrange(200)),
+                   'transId': i, 'qty': rng.randrange(1, 1000)}
+
+    aggregations = dict(qty=('qty', 'sum'), avg=('qty', 'mean'), low=('qty', 'min'), high=('qty', 'max'),
+                        orders=('transId', 'count'), quantities=('qty', 'distinct'))
+    for size in sizes:
+        print('{:,} rows, 10000 groups'.format(size))
+        if size <= 10 ** 6:
+            # The old way needs all rows in memory and one sort per aggregation
+            data = list(rows(size))
+            grouped = itemgetter('dept', 'sku')
+            start = time.perf_counter()
+            for _ in ('sum', 'mean'):
+                for key, group in groupby(sorted(data, key=grouped), grouped):
+                    sum(item['qty'] for item in group)
+            print('  sort + groupby, sum and mean only   {:6.2f} s'.format(time.perf_counter() - start))
+            del data
+        start = time.perf_counter()
+        result = aggregate(rows(size), ('dept', 'sku'), **aggregations)
+        elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in rows(size):
+            pass
+        generating = time.perf_counter() - start
+        print('  aggregate(), streamed dict rows     {:6.2f} s (+ {:.2f} s making the rows)'.format(
+            elapsed - generating, generating))
+        if np is not None:
+            rng = np.random.default_rng(1)
+            columns = {'dept': rng.integers(0, 50, size), 'sku': rng.integers(0, 200, size),
+                       'transId': np.arange(size), 'qty': rng.integers(1, 1000, size)}
+            start = time.perf_counter()
+            aggregate(columns, ('dept', 'sku'), output='columns', **aggregations)
+            print('  aggregate(), numpy columns          {:6.2f} s'.format(time.perf_counter() - start))
+        print('  {} groups, first {}'.format(len(result), result[0]))
+
+
 def chain_dict():
     from collections import ChainMap
     d1 = {'first': 'first', 'second': 'second', 'third': 'third', 'fourth': 'fourth'}
@@ -224,3 +1171,7 @@ def partial():
     # text_search()         7
     # round_values()        8
     # partial()             9
+    # streaming_counter()   10
+    # parallel_counting()   11
+    # aggregation_benchmark()  12
+    # external_sort_benchmark()  13
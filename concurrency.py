@@ -113,65 +113,1410 @@
 '''
 
 
+'''
+    The IOTask above has two problems once you have a lot of them. Every task needs its own
+    thread, and terminate() only takes effect after the next socket timeout, so stopping a
+    task can take up to 5 seconds.
+    Instead of polling, a small number of threads can wait on many sockets at once with the
+    selectors module. Every selector thread also watches the read end of a pipe, so writing
+    a single byte into the pipe wakes it up at once. terminate() just queues a cancel request
+    and pokes the pipe, and the task is gone within milliseconds.
+    Read and idle timeouts are kept in a heap ordered by deadline, so the selector only sleeps
+    until the nearest deadline instead of waking up for every task.
+
+    with IOTaskManager(nthreads=2) as manager:
+        task = manager.submit(sock, read_timeout=5)
+        ...
+        task.terminate()        # returns at once, task is cancelled by the selector thread
+        data = task.wait()      # raises TaskCancelled
+'''
 
+import collections
+import heapq
+import itertools
+import os
+import selectors
+import threading
+import time
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class IOTask:
+    PENDING, RUNNING, DONE, CANCELLED, FAILED = 'pending', 'running', 'done', 'cancelled', 'failed'
+
+    def __init__(self, loop, sock, handler=None, read_timeout=None, idle_timeout=None, bufsize=8192):
+        self.sock = sock
+        self.handler = handler
+        self.read_timeout = read_timeout
+        self.idle_timeout = idle_timeout
+        self.bufsize = bufsize
+        self.state = IOTask.PENDING
+        self.result = None
+        self.exception = None
+        self._loop = loop
+        self._done = threading.Event()
+        self._read_deadline = None
+        self._idle_deadline = None
+        self._old_timeout = None
+
+    def __repr__(self):
+        return 'IOTask({!r}, state={})'.format(self.sock, self.state)
+
+    def terminate(self):
+        # Safe to call from any thread, the selector thread does the actual work
+        if not self._done.is_set():
+            try:
+                self._loop.call(self._loop.cancel, self)
+            except RuntimeError:
+                # The loop has stopped, it cancels all its tasks on the way out
+                pass
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError('Task is still running')
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    @property
+    def deadline(self):
+        deadlines = [d for d in (self._read_deadline, self._idle_deadline) if d is not None]
+        return min(deadlines) if deadlines else None
+
+
+class _SelectorLoop(threading.Thread):
+    # One selector thread that owns any number of tasks
+
+    def __init__(self, name=None):
+        super().__init__(name=name, daemon=True)
+        self.tasks = set()
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+        self._calls = collections.deque()
+        self._timers = []
+        self._counter = itertools.count()
+        self._signalled = False
+        self._running = True
+        self._stopping = False
+        self._closed = False            # run() has finished and closed the pipe
+        self._lock = threading.Lock()
+
+    def call(self, func, *args):
+        # The lock keeps run() from closing the pipe between the check and the write,
+        # the fd could already belong to another file. Several calls in a row cost a
+        # single write into the pipe.
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Selector loop has stopped')
+            self._calls.append((func, args))
+            if not self._signalled:
+                self._signalled = True
+                try:
+                    os.write(self._wakeup_w, b'\0')
+                except BlockingIOError:
+                    pass
+
+    def stop(self):
+        with self._lock:
+            if self._stopping or self._closed:
+                return
+            self._stopping = True
+        self.call(self._stop)
+
+    def _stop(self):
+        self._running = False
+
+    def run(self):
+        try:
+            while self._running or self._calls:
+                timeout = None
+                if self._timers:
+                    timeout = max(0, self._timers[0][0] - time.monotonic())
+                for key, mask in self._selector.select(timeout):
+                    if key.data is None:
+                        self._drain_wakeup()
+                    else:
+                        self._on_readable(key.data)
+                self._run_calls()
+                self._expire_timers()
+        finally:
+            with self._lock:
+                self._closed = True
+                os.close(self._wakeup_r)
+                os.close(self._wakeup_w)
+            self._running = False
+            # Calls that came in after the last round, add() cancels new tasks now
+            self._run_calls()
+            for task in list(self.tasks):
+                self._finish(task, IOTask.CANCELLED, exception=TaskCancelled('Manager shut down'))
+            self._selector.close()
+
+    def _drain_wakeup(self):
+        self._signalled = False
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _run_calls(self):
+        while self._calls:
+            func, args = self._calls.popleft()
+            func(*args)
+
+    def add(self, task):
+        if task.done():
+            return
+        if not self._running:
+            self._finish(task, IOTask.CANCELLED, exception=TaskCancelled('Manager shut down'))
+            return
+        task._old_timeout = task.sock.gettimeout()
+        task.sock.setblocking(False)
+        try:
+            self._selector.register(task.sock, selectors.EVENT_READ, task)
+        except (ValueError, OSError) as e:
+            self._finish(task, IOTask.FAILED, exception=e)
+            return
+        self.tasks.add(task)
+        task.state = IOTask.RUNNING
+        now = time.monotonic()
+        if task.read_timeout is not None:
+            task._read_deadline = now + task.read_timeout
+        if task.idle_timeout is not None:
+            task._idle_deadline = now + task.idle_timeout
+        self._schedule(task)
+
+    def cancel(self, task):
+        if task in self.tasks:
+            self._finish(task, IOTask.CANCELLED, exception=TaskCancelled('Task terminated'))
+        elif not task.done():
+            # Terminated before the loop got to register it
+            task.state = IOTask.CANCELLED
+            task.exception = TaskCancelled('Task terminated')
+            task._done.set()
+
+    def _schedule(self, task):
+        deadline = task.deadline
+        if deadline is not None:
+            heapq.heappush(self._timers, (deadline, next(self._counter), task))
+
+    def _expire_timers(self):
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            deadline, _, task = heapq.heappop(self._timers)
+            # Entries are never removed from the heap, stale ones are skipped here
+            if task not in self.tasks or task.deadline != deadline:
+                continue
+            which = 'Read' if deadline == task._read_deadline else 'Idle'
+            self._finish(task, IOTask.FAILED, exception=TimeoutError('{} timeout'.format(which)))
+
+    def _on_readable(self, task):
+        try:
+            data = task.sock.recv(task.bufsize)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self._finish(task, IOTask.FAILED, exception=e)
+            return
+        if task.handler is None:
+            # Same as the recipe above, first chunk of data is the result
+            self._finish(task, IOTask.DONE, result=data)
+        elif not data:
+            self._finish(task, IOTask.DONE)
+        else:
+            try:
+                keep_going = task.handler(data)
+            except Exception as e:
+                self._finish(task, IOTask.FAILED, exception=e)
+                return
+            if keep_going is False:
+                self._finish(task, IOTask.DONE)
+            elif task.idle_timeout is not None:
+                task._idle_deadline = time.monotonic() + task.idle_timeout
+                self._schedule(task)
+
+    def _finish(self, task, state, result=None, exception=None):
+        if task in self.tasks:
+            self.tasks.discard(task)
+            self._selector.unregister(task.sock)
+            try:
+                task.sock.settimeout(task._old_timeout)
+            except OSError:
+                pass
+        task.state = state
+        task.result = result
+        task.exception = exception
+        task._done.set()
+
+
+class IOTaskManager:
+    def __init__(self, nthreads=1):
+        self._loops = [_SelectorLoop('IOTaskManager-{}'.format(n)) for n in range(nthreads)]
+        for loop in self._loops:
+            loop.start()
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    def submit(self, sock, handler=None, read_timeout=None, idle_timeout=None, bufsize=8192):
+        '''
+            Starts reading from sock. Without a handler the task is done after the first
+            chunk of data. With a handler, handler(data) is called for every chunk until
+            EOF or until it returns False.
+        '''
+        if self._closed:
+            raise RuntimeError('Manager is shut down')
+        # Least loaded selector thread, len() of a set is safe to read from here
+        loop = min(self._loops, key=lambda l: len(l.tasks))
+        task = IOTask(loop, sock, handler, read_timeout, idle_timeout, bufsize)
+        loop.call(loop.add, task)
+        return task
+
+    def shutdown(self, wait=True):
+        self._closed = True
+        for loop in self._loops:
+            loop.stop()
+        if wait:
+            for loop in self._loops:
+                loop.join()
+
+
+def bench_iotask_manager(ntasks=500, nthreads=2):
+    import socket
+
+    pairs = [socket.socketpair() for _ in range(ntasks)]
+    start = time.perf_counter()
+    with IOTaskManager(nthreads) as manager:
+        tasks = [manager.submit(a, read_timeout=60) for a, b in pairs]
+        print('{} tasks submitted in {:.1f} ms, {} threads alive'.format(
+            ntasks, (time.perf_counter() - start) * 1000, threading.active_count()))
+        start = time.perf_counter()
+        for task in tasks:
+            task.terminate()
+        for task in tasks:
+            task._done.wait()
+        print('Terminated {} tasks in {:.1f} ms'.format(ntasks, (time.perf_counter() - start) * 1000))
+    for a, b in pairs:
+        a.close()
+        b.close()
 
 
+'''
+    A thread per countdown() is expensive if you need tens of thousands of them, each thread
+    takes its own stack and every switch between them goes through the OS.
+    Generators can be used as very cheap tasks instead. A task yields a request object telling
+    the scheduler what it is waiting for (Sleep, ReadWait, WriteWait, Join, a message from a
+    queue) and the scheduler resumes it with send() once that is ready. Yielding another
+    generator calls it as a subtask, the same trampolining that NodeVisitor uses in
+    recipies2.py, so tasks can be split into functions without recursion.
 
+    def countdown(n):
+        while n > 0:
+            print('T-minus', n)
+            n -= 1
+            yield Sleep(5)
 
+    sched = Scheduler()
+    sched.spawn(countdown(10))
+    sched.run()
 
+    Sleeping tasks are kept in a heap ordered by wake up time and sockets in a selector,
+    so the scheduler blocks exactly until the next thing that can happen.
+'''
 
+import types
 
 
+class Sleep:
+    __slots__ = ('seconds',)
 
+    def __init__(self, seconds):
+        self.seconds = seconds
 
+    def handle(self, sched, task):
+        if self.seconds <= 0:
+            sched._ready.append((task, None, None))
+        else:
+            sched._sleep(task, time.monotonic() + self.seconds)
 
 
+class ReadWait:
+    __slots__ = ('fileobj',)
 
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
 
+    def handle(self, sched, task):
+        sched._wait_io(self.fileobj, selectors.EVENT_READ, task)
 
 
+class WriteWait:
+    __slots__ = ('fileobj',)
 
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
 
+    def handle(self, sched, task):
+        sched._wait_io(self.fileobj, selectors.EVENT_WRITE, task)
 
 
+class Join:
+    __slots__ = ('task',)
 
+    def __init__(self, task):
+        self.task = task
 
+    def handle(self, sched, task):
+        if self.task.done:
+            sched._ready.append((task, self.task.result, self.task.exception))
+        else:
+            self.task._joiners.append(task)
 
 
+class _QueueGet:
+    __slots__ = ('queue',)
 
+    def __init__(self, queue):
+        self.queue = queue
 
+    def handle(self, sched, task):
+        if self.queue._items:
+            sched._ready.append((task, self.queue._items.popleft(), None))
+        else:
+            self.queue._getters.append(task)
 
 
+class MessageQueue:
+    # Unbounded queue between tasks of the same scheduler
 
+    def __init__(self):
+        self._items = collections.deque()
+        self._getters = collections.deque()
 
+    def __len__(self):
+        return len(self._items)
 
+    def put(self, item):
+        # Does not block, so it can be called without yield
+        if self._getters:
+            getter = self._getters.popleft()
+            getter._sched._ready.append((getter, item, None))
+        else:
+            self._items.append(item)
 
+    def get(self):
+        # msg = yield queue.get()
+        return _QueueGet(self)
 
 
+class CoTask:
+    __slots__ = ('id', 'done', 'result', 'exception', '_stack', '_sched', '_joiners')
 
+    def __init__(self, sched, id, gen):
+        self.id = id
+        self.done = False
+        self.result = None
+        self.exception = None
+        self._stack = [gen]
+        self._sched = sched
+        self._joiners = []
 
+    def __repr__(self):
+        return 'CoTask({}, done={})'.format(self.id, self.done)
 
 
+class Scheduler:
+    def __init__(self):
+        self._ready = collections.deque()
+        self._timers = []
+        self._selector = selectors.DefaultSelector()
+        self._io_waiting = {}       # fileobj -> {event: task}
+        self._ids = itertools.count()
+        self.ntasks = 0
+        self.switches = 0
+
+    def spawn(self, gen):
+        if not isinstance(gen, types.GeneratorType):
+            raise TypeError('Expected a generator, got {!r}'.format(gen))
+        task = CoTask(self, next(self._ids), gen)
+        self._ready.append((task, None, None))
+        self.ntasks += 1
+        return task
+
+    def run(self):
+        while self.ntasks:
+            if self._ready:
+                timeout = 0
+            elif self._timers:
+                timeout = max(0, self._timers[0][0] - time.monotonic())
+            elif self._io_waiting:
+                timeout = None
+            else:
+                raise RuntimeError('Deadlock: {} tasks waiting on queues or joins'.format(self.ntasks))
+            if self._io_waiting or timeout:
+                for key, mask in self._selector.select(timeout):
+                    self._io_ready(key.fileobj, mask)
+            now = time.monotonic()
+            while self._timers and self._timers[0][0] <= now:
+                task = heapq.heappop(self._timers)[2]
+                self._ready.append((task, None, None))
+            # Only run what is ready right now, so timers and I/O are not starved
+            for _ in range(len(self._ready)):
+                task, value, exc = self._ready.popleft()
+                self._step(task, value, exc)
+
+    def _step(self, task, value, exc):
+        self.switches += 1
+        stack = task._stack
+        while True:
+            gen = stack[-1]
+            try:
+                if exc is not None:
+                    request = gen.throw(exc)
+                else:
+                    request = gen.send(value)
+            except StopIteration as e:
+                stack.pop()
+                value, exc = e.value, None
+                if stack:
+                    continue
+                self._finish(task, value, None)
+                return
+            except Exception as e:
+                stack.pop()
+                value, exc = None, e
+                if stack:
+                    continue
+                self._finish(task, None, e)
+                return
+            if isinstance(request, types.GeneratorType):
+                # Call a subtask, its return value is sent back to the caller
+                stack.append(request)
+                value, exc = None, None
+            elif request is None:
+                self._ready.append((task, None, None))
+                return
+            else:
+                request.handle(self, task)
+                return
+
+    def _finish(self, task, result, exception):
+        task.done = True
+        task.result = result
+        task.exception = exception
+        self.ntasks -= 1
+        for joiner in task._joiners:
+            self._ready.append((joiner, result, exception))
+        task._joiners = None
+
+    def _sleep(self, task, deadline):
+        heapq.heappush(self._timers, (deadline, task.id, task))
+
+    def _wait_io(self, fileobj, event, task):
+        waiting = self._io_waiting.get(fileobj)
+        if waiting is None:
+            self._io_waiting[fileobj] = {event: task}
+            self._selector.register(fileobj, event)
+        else:
+            if event in waiting:
+                raise RuntimeError('{!r} already has a task waiting on it'.format(fileobj))
+            waiting[event] = task
+            self._selector.modify(fileobj, selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+    def _io_ready(self, fileobj, mask):
+        waiting = self._io_waiting[fileobj]
+        for event in (selectors.EVENT_READ, selectors.EVENT_WRITE):
+            if mask & event and event in waiting:
+                self._ready.append((waiting.pop(event), None, None))
+        if waiting:
+            self._selector.modify(fileobj, next(iter(waiting)))
+        else:
+            del self._io_waiting[fileobj]
+            self._selector.unregister(fileobj)
+
+
+def _rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+def bench_scheduler(ntasks=20000, nthreads=1000, nswitches=100000):
+    import queue
+    import tracemalloc
+
+    def countdown(n):
+        while n > 0:
+            n -= 1
+            yield Sleep(0.01)
+
+    # Memory per task
+    tracemalloc.start()
+    sched = Scheduler()
+    for _ in range(ntasks):
+        sched.spawn(countdown(3))
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    start = time.perf_counter()
+    sched.run()
+    print('Generators: {} tasks, {:.0f} bytes per task, ran in {:.2f} s'.format(
+        ntasks, size / ntasks, time.perf_counter() - start))
+
+    stop = threading.Event()
+    before = _rss_bytes()
+    threads = [threading.Thread(target=stop.wait, daemon=True) for _ in range(nthreads)]
+    for t in threads:
+        t.start()
+    after = _rss_bytes()
+    stop.set()
+    for t in threads:
+        t.join()
+    print('Threads: {} threads, {:.0f} bytes RSS per thread'.format(nthreads, (after - before) / nthreads))
+
+    # Context switches, two tasks passing a message back and forth
+    def ping(inq, outq, n):
+        for _ in range(n):
+            outq.put(None)
+            yield inq.get()
+
+    sched = Scheduler()
+    q1, q2 = MessageQueue(), MessageQueue()
+    sched.spawn(ping(q1, q2, nswitches // 2))
+    sched.spawn(ping(q2, q1, nswitches // 2))
+    start = time.perf_counter()
+    sched.run()
+    elapsed = time.perf_counter() - start
+    print('Generators: {:.0f} switches/s'.format(sched.switches / elapsed))
+
+    def thread_ping(inq, outq, n):
+        for _ in range(n):
+            outq.put(None)
+            inq.get()
+
+    q1, q2 = queue.Queue(), queue.Queue()
+    threads = [threading.Thread(target=thread_ping, args=(q1, q2, nswitches // 2)),
+               threading.Thread(target=thread_ping, args=(q2, q1, nswitches // 2))]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    print('Threads: {:.0f} switches/s'.format(nswitches / (time.perf_counter() - start)))
 
 
+'''
+    Threads and asyncio often have to live in the same program, for example the threaded
+    producers above feeding a coroutine that writes to the network. The usual bridge is
+    loop.call_soon_threadsafe() for every item, which wakes up the event loop once per item
+    and floods it when a producer sends a burst.
+    BridgeQueue can be used from both sides. Threads call put()/get(), coroutines await
+    async_put()/async_get(). Waiting coroutines are woken up by one scheduled callback, and
+    no new callback is scheduled until that one has run, so a burst of N items costs a single
+    loop wakeup. When maxsize is set, put() blocks the producing thread until a consumer makes
+    room, which keeps a fast thread from piling up memory in front of a slow coroutine.
+
+    q = BridgeQueue(maxsize=1000)
+
+    def producer():
+        for item in items:
+            q.put(item)
+
+    async def consumer():
+        while True:
+            batch = await q.async_get_batch(100)
+'''
 
+import asyncio
+import queue
 
 
+class BridgeQueue:
+    def __init__(self, maxsize=0, loop=None):
+        self.maxsize = maxsize
+        self.wakeups = 0
+        self._items = collections.deque()
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+        self._loop = loop
+        self._async_getters = collections.deque()
+        self._async_putters = collections.deque()
+        self._wakeup_pending = False
 
+    def __len__(self):
+        return len(self._items)
 
+    def _full(self):
+        return 0 < self.maxsize <= len(self._items)
 
+    # ---------------- Called with self._mutex held ----------------
 
+    def _schedule_wakeup(self):
+        if self._wakeup_pending or self._loop is None:
+            return
+        self._wakeup_pending = True
+        self.wakeups += 1
+        self._loop.call_soon_threadsafe(self._wake_async)
+
+    def _added(self, n):
+        for _ in range(n):
+            self._not_empty.notify()
+        if self._async_getters:
+            self._schedule_wakeup()
+
+    def _removed(self, n):
+        for _ in range(n):
+            self._not_full.notify()
+        if self._async_putters:
+            self._schedule_wakeup()
+
+    # ----------------------------------------------------------------
+
+    def _wake_async(self):
+        with self._mutex:
+            self._wakeup_pending = False
+            # Every woken coroutine checks again under the lock, so waking one
+            # too many is harmless
+            for _ in range(len(self._items)):
+                if not self._wake_one(self._async_getters):
+                    break
+            if self.maxsize <= 0:
+                free = len(self._async_putters)
+            else:
+                free = self.maxsize - len(self._items)
+            for _ in range(free):
+                if not self._wake_one(self._async_putters):
+                    break
 
+    @staticmethod
+    def _wake_one(waiters):
+        while waiters:
+            fut = waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return True
+        return False
+
+    # ---------------- Thread side ----------------
+
+    def put(self, item, block=True, timeout=None):
+        with self._not_full:
+            if self._full():
+                if not block:
+                    raise queue.Full
+                if not self._not_full.wait_for(lambda: not self._full(), timeout):
+                    raise queue.Full
+            self._items.append(item)
+            self._added(1)
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def get(self, block=True, timeout=None):
+        return self.get_batch(1, block, timeout)[0]
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def get_batch(self, max_items, block=True, timeout=None):
+        # Waits for at least one item and returns up to max_items of them
+        with self._not_empty:
+            if not self._items:
+                if not block:
+                    raise queue.Empty
+                if not self._not_empty.wait_for(lambda: self._items, timeout):
+                    raise queue.Empty
+            batch = self._take(max_items)
+            self._removed(len(batch))
+            return batch
+
+    def _take(self, max_items):
+        items = self._items
+        n = min(max_items, len(items))
+        return [items.popleft() for _ in range(n)]
+
+    # ---------------- Coroutine side ----------------
+
+    async def _wait(self, waiters):
+        fut = self._loop.create_future()
+        waiters.append(fut)
+        self._mutex.release()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            with self._mutex:
+                # Cancelling the task cancels fut as well, unless _wake_one() had already
+                # set its result. Then this wakeup was meant for an item or a free slot
+                # that is still there, pass it on to the next waiter.
+                if not fut.cancelled():
+                    self._schedule_wakeup()
+            raise
+        finally:
+            self._mutex.acquire()
+
+    def _bind_loop(self):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+
+    async def async_put(self, item):
+        self._bind_loop()
+        self._mutex.acquire()
+        try:
+            while self._full():
+                await self._wait(self._async_putters)
+            self._items.append(item)
+            self._added(1)
+        finally:
+            self._mutex.release()
+
+    async def async_get(self):
+        return (await self.async_get_batch(1))[0]
+
+    async def async_get_batch(self, max_items):
+        self._bind_loop()
+        self._mutex.acquire()
+        try:
+            while not self._items:
+                await self._wait(self._async_getters)
+            batch = self._take(max_items)
+            self._removed(len(batch))
+            return batch
+        finally:
+            self._mutex.release()
+
+
+def bench_bridge_queue(nitems=200000, batch=256):
+    async def consume_bridge(q):
+        received = 0
+        while received < nitems:
+            received += len(await q.async_get_batch(batch))
+
+    async def run_bridge():
+        q = BridgeQueue(maxsize=10000)
+
+        def producer():
+            for i in range(nitems):
+                q.put(i)
+
+        t = threading.Thread(target=producer)
+        start = time.perf_counter()
+        t.start()
+        await consume_bridge(q)
+        t.join()
+        return time.perf_counter() - start, q.wakeups
+
+    async def run_threadsafe():
+        loop = asyncio.get_running_loop()
+        aq = asyncio.Queue()
+
+        def producer():
+            for i in range(nitems):
+                loop.call_soon_threadsafe(aq.put_nowait, i)
+
+        t = threading.Thread(target=producer)
+        start = time.perf_counter()
+        t.start()
+        for _ in range(nitems):
+            await aq.get()
+        t.join()
+        return time.perf_counter() - start, nitems
+
+    elapsed, wakeups = asyncio.run(run_bridge())
+    print('BridgeQueue: {:.0f} items/s, {} loop wakeups'.format(nitems / elapsed, wakeups))
+    elapsed, wakeups = asyncio.run(run_threadsafe())
+    print('call_soon_threadsafe: {:.0f} items/s, {} loop wakeups'.format(nitems / elapsed, wakeups))
 
 
+'''
+    Locks and queues tell you nothing about how long threads were stuck on them. When a
+    threaded program is slow it is hard to say which SharedCounter lock or which pipeline
+    queue is the hot spot.
+    ProfiledLock, ProfiledCondition and ProfiledQueue are drop-in replacements that record
+    how often an acquire had to wait (contention), how long the wait was and how long the
+    lock was held, grouped by name. Contention is found with a non-blocking acquire first,
+    which costs almost nothing. Timing is only done for every sample_rate-th acquire to keep
+    the overhead low. A ProfiledQueue also times every get() waiting for an item and every
+    put() waiting for room, those waits are already slow, so they are not sampled.
+    Profiling is opt-in. make_lock() and make_queue() return plain threading.Lock and
+    queue.Queue objects until enable_lock_profiling() is called.
+
+    enable_lock_profiling(sample_rate=10)
 
+    class SharedCounter:
+        def __init__(self, initial_value=0):
+            self._value = initial_value
+            self._value_lock = make_lock('SharedCounter')
+
+        def incr(self, delta=1):
+            with self._value_lock:
+                self._value += delta
+
+    ...
+    print(lock_report())
+'''
+
+import json
+
+_profiling_enabled = False
+_sample_rate = 1
+_registry_lock = threading.Lock()
+_registry = collections.defaultdict(list)
+
+
+def enable_lock_profiling(sample_rate=1):
+    global _profiling_enabled, _sample_rate
+    if sample_rate < 1:
+        raise ValueError('sample_rate must be >= 1')
+    _profiling_enabled = True
+    _sample_rate = sample_rate
+
+
+def disable_lock_profiling():
+    global _profiling_enabled
+    _profiling_enabled = False
+
+
+def make_lock(name):
+    return ProfiledLock(name) if _profiling_enabled else threading.Lock()
+
+
+def make_queue(name, maxsize=0):
+    return ProfiledQueue(name, maxsize) if _profiling_enabled else queue.Queue(maxsize)
+
+
+class LockStats:
+    # Counters for one lock or queue. Only updated by the thread holding the lock.
+
+    FIELDS = ('acquires', 'contended', 'sampled', 'wait_total', 'wait_max',
+              'hold_total', 'hold_max', 'blocked_gets', 'blocked_puts', 'get_wait_total',
+              'get_wait_max', 'put_wait_total', 'put_wait_max', 'max_size')
+
+    def __init__(self, name, kind):
+        self.name = name
+        self.kind = kind
+        for field in LockStats.FIELDS:
+            setattr(self, field, 0)
+
+    def as_dict(self):
+        d = {'name': self.name, 'kind': self.kind}
+        for field in LockStats.FIELDS:
+            d[field] = getattr(self, field)
+        return d
+
+
+def _register(name, kind):
+    stats = LockStats(name, kind)
+    with _registry_lock:
+        _registry[name].append(stats)
+    return stats
+
+
+def reset_lock_stats():
+    with _registry_lock:
+        for entries in _registry.values():
+            for stats in entries:
+                stats.__init__(stats.name, stats.kind)
+
+
+def lock_stats():
+    # All instances with the same name are merged together
+    result = []
+    with _registry_lock:
+        items = [(name, list(entries)) for name, entries in _registry.items()]
+    for name, entries in items:
+        total = {'name': name, 'kind': entries[0].kind, 'instances': len(entries)}
+        for field in LockStats.FIELDS:
+            values = [getattr(s, field) for s in entries]
+            total[field] = max(values) if field.endswith('_max') or field == 'max_size' else sum(values)
+        # Sampled totals are scaled up to an estimate over all acquires
+        scale = total['acquires'] / total['sampled'] if total['sampled'] else 0
+        total['est_wait_total'] = total['wait_total'] * scale
+        total['est_hold_total'] = total['hold_total'] * scale
+        total['contention_ratio'] = total['contended'] / total['acquires'] if total['acquires'] else 0.0
+        result.append(total)
+    result.sort(key=lambda s: s['est_wait_total'], reverse=True)
+    return result
+
+
+def lock_report():
+    lines = ['{:<24} {:>6} {:>10} {:>10} {:>7} {:>12} {:>12} {:>12} {:>12} {:>12}'.format(
+        'name', 'kind', 'acquires', 'contended', 'ratio', 'est wait s', 'max wait ms', 'est hold s',
+        'get wait s', 'put wait s')]
+    for s in lock_stats():
+        lines.append('{:<24} {:>6} {:>10} {:>10} {:>7.1%} {:>12.4f} {:>12.3f} {:>12.4f} {:>12.4f} {:>12.4f}'.format(
+            s['name'][:24], s['kind'], s['acquires'], s['contended'], s['contention_ratio'],
+            s['est_wait_total'], s['wait_max'] * 1000, s['est_hold_total'],
+            s['get_wait_total'], s['put_wait_total']))
+    return '\n'.join(lines)
+
+
+def lock_report_json(**kwargs):
+    return json.dumps(lock_stats(), **kwargs)
+
+
+class ProfiledLock:
+    def __init__(self, name, kind='lock'):
+        self.name = name
+        self._lock = threading.Lock()
+        self._stats = _register(name, kind)
+        self._count = 0
+        self._owner = None
+        self._acquired_at = None
+
+    def __repr__(self):
+        return '<ProfiledLock {!r} locked={}>'.format(self.name, self._lock.locked())
+
+    def acquire(self, blocking=True, timeout=-1):
+        # Counter is racy without the lock, a lost increment only shifts the sampling
+        self._count += 1
+        sampled = self._count % _sample_rate == 0
+        if self._lock.acquire(False):
+            waited = 0.0
+            contended = False
+        elif not blocking:
+            return False
+        else:
+            contended = True
+            start = time.perf_counter() if sampled else 0.0
+            if not self._lock.acquire(True, timeout):
+                return False
+            waited = time.perf_counter() - start if sampled else 0.0
+        # From here on we own the lock, updating the stats is safe
+        stats = self._stats
+        stats.acquires += 1
+        if contended:
+            stats.contended += 1
+        if sampled:
+            stats.sampled += 1
+            stats.wait_total += waited
+            if waited > stats.wait_max:
+                stats.wait_max = waited
+            self._acquired_at = time.perf_counter()
+        self._owner = threading.get_ident()
+        return True
+
+    def release(self):
+        if self._acquired_at is not None:
+            held = time.perf_counter() - self._acquired_at
+            self._acquired_at = None
+            self._stats.hold_total += held
+            if held > self._stats.hold_max:
+                self._stats.hold_max = held
+        self._owner = None
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def _is_owned(self):
+        # Used by threading.Condition
+        return self._owner == threading.get_ident()
+
+    __enter__ = acquire
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class ProfiledCondition(threading.Condition):
+    def __init__(self, name, lock=None):
+        if lock is None:
+            lock = ProfiledLock(name, kind='cond')
+        super().__init__(lock)
+        self.name = name
+
+
+class _TimedCondition(threading.Condition):
+    # wait() is only called with the lock held and returns with it held again,
+    # so the stats are updated under the lock like in ProfiledLock
+    def __init__(self, lock, stats, op):
+        super().__init__(lock)
+        self._stats = stats
+        self._blocked = 'blocked_' + op + 's'
+        self._wait_total = op + '_wait_total'
+        self._wait_max = op + '_wait_max'
+
+    def wait(self, timeout=None):
+        start = time.perf_counter()
+        try:
+            return super().wait(timeout)
+        finally:
+            waited = time.perf_counter() - start
+            stats = self._stats
+            setattr(stats, self._blocked, getattr(stats, self._blocked) + 1)
+            setattr(stats, self._wait_total, getattr(stats, self._wait_total) + waited)
+            if waited > getattr(stats, self._wait_max):
+                setattr(stats, self._wait_max, waited)
+
+
+class ProfiledQueue(queue.Queue):
+    def __init__(self, name, maxsize=0):
+        super().__init__(maxsize)
+        self.name = name
+        # Rebuild the internal mutex and conditions on a profiled lock. queue.Queue only
+        # waits on not_empty and not_full when get() or put() has to block.
+        self.mutex = ProfiledLock(name, kind='queue')
+        self._stats = self.mutex._stats
+        self.not_empty = _TimedCondition(self.mutex, self._stats, 'get')
+        self.not_full = _TimedCondition(self.mutex, self._stats, 'put')
+        self.all_tasks_done = threading.Condition(self.mutex)
+
+    def _put(self, item):
+        super()._put(item)
+        n = self._qsize()
+        if n > self._stats.max_size:
+            self._stats.max_size = n
+
+
+def bench_lock_profiler(nthreads=4, nitems=100000):
+    def run(make_lock, make_queue):
+        counter_lock = make_lock('SharedCounter')
+        counter = [0]
+        work_q = make_queue('pipeline.work', 100)
+        done_q = make_queue('pipeline.done')
+
+        def worker():
+            while True:
+                item = work_q.get()
+                if item is None:
+                    break
+                with counter_lock:
+                    counter[0] += 1
+                done_q.put(item)
+
+        threads = [threading.Thread(target=worker) for _ in range(nthreads)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for i in range(nitems):
+            work_q.put(i)
+        for _ in threads:
+            work_q.put(None)
+        for t in threads:
+            t.join()
+        return time.perf_counter() - start
+
+    plain = run(lambda name: threading.Lock(), lambda name, maxsize=0: queue.Queue(maxsize))
+    enable_lock_profiling(sample_rate=10)
+    profiled = run(make_lock, make_queue)
+    disable_lock_profiling()
+    print('Plain: {:.2f} s, profiled: {:.2f} s ({:+.0%})'.format(plain, profiled, profiled / plain - 1))
+    print(lock_report())
 
 
+'''
+    The producer/consumer recipe above only works inside one process. Combined with the
+    Listener/Client recipe from network.py it becomes a small work distribution system:
+    a broker process holds named queues and producers and consumers on other hosts connect
+    to it with an authkey.
+
+    start_broker(('', 25001), authkey=b'peekaboo')
+
+    # Producer
+    c = WorkClient(('broker-host', 25001), authkey=b'peekaboo')
+    c.put_many('jobs', range(1000))
+
+    # Consumer
+    c = WorkClient(('broker-host', 25001), authkey=b'peekaboo', prefetch=50)
+    while True:
+        for delivery in c.fetch('jobs', 10):
+            process(delivery.item)
+            c.ack(delivery)
+
+    Every delivered item stays with the broker until it is acknowledged. If the consumer
+    connection goes away (process died, host rebooted) everything it had not acknowledged
+    goes back to the front of the queue and is delivered to somebody else. prefetch limits
+    how many unacknowledged items one consumer can hold, so a slow consumer does not grab
+    work that idle consumers could do.
+    The broker runs a thread per connection, which is plenty for tens of clients. Use
+    fetch() with a batch size to save round trips.
+'''
+
+import logging
+from multiprocessing.connection import Listener, Client
+
+_log = logging.getLogger(__name__)
 
 
+class Delivery:
+    __slots__ = ('tag', 'item', 'redelivered')
 
+    def __init__(self, tag, item, redelivered):
+        self.tag = tag
+        self.item = item
+        self.redelivered = redelivered
 
+    def __repr__(self):
+        return 'Delivery({}, {!r}, redelivered={})'.format(self.tag, self.item, self.redelivered)
 
 
+def connect(address, authkey, retry=5.0):
+    # Retry for a while, so clients can be started together with the server
+    deadline = time.monotonic() + retry
+    while True:
+        try:
+            return Client(address, authkey=authkey)
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
 
 
+class MessageServer:
+    '''
+        Serves every connection of a Listener in its own thread. A message is a tuple
+        (op, *args), it is handled by _op_<op>(*client_args, *args) and the return value
+        is sent back. client_args come from _client_args(conn) when the connection is
+        accepted, _client_done(conn, client_args) runs when it goes away. Exceptions are
+        sent back as ('error', message).
+    '''
+
+    def __init__(self, address, authkey):
+        self._listener = Listener(address, authkey=authkey)
+        self.address = self._listener.address
+        self._closed = False
+
+    def serve_forever(self):
+        while not self._closed:
+            try:
+                conn = self._listener.accept()
+            except OSError:
+                if self._closed:
+                    break
+                raise
+            except Exception as e:
+                # Wrong authkey and the like, keep serving the others
+                _log.warning('Rejected connection: %s', e)
+                continue
+            threading.Thread(target=self._serve_client, args=(conn,), daemon=True).start()
+
+    def close(self):
+        self._closed = True
+        self._listener.close()
+
+    def _client_args(self, conn):
+        return (conn,)
+
+    def _client_done(self, conn, client_args):
+        pass
+
+    def _serve_client(self, conn):
+        client_args = self._client_args(conn)
+        try:
+            while True:
+                msg = conn.recv()
+                try:
+                    op = msg[0]
+                    handler = getattr(self, '_op_' + op, None)
+                    if handler is None:
+                        reply = ('error', 'Unknown operation {!r}'.format(op))
+                    else:
+                        reply = handler(*client_args, *msg[1:])
+                except Exception as e:
+                    # A malformed message must not take the connection down
+                    reply = ('error', '{}: {}'.format(type(e).__name__, e))
+                conn.send(reply)
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+            self._client_done(conn, client_args)
+
+
+class WorkBroker(MessageServer):
+    def __init__(self, address, authkey):
+        super().__init__(address, authkey)
+        self._cond = threading.Condition()
+        self._queues = collections.defaultdict(collections.deque)     # name -> (tag, item, deliveries)
+        self._tags = itertools.count()
+
+    def _client_args(self, conn):
+        unacked = {}                # tag -> (queue, item, deliveries)
+        prefetch = [0]
+        return unacked, prefetch
+
+    def _client_done(self, conn, client_args):
+        self._requeue(client_args[0])
+
+    def _requeue(self, unacked):
+        if not unacked:
+            return
+        with self._cond:
+            # Oldest first, they go back to the front of their queues
+            for tag in sorted(unacked, reverse=True):
+                name, item, deliveries = unacked[tag]
+                self._queues[name].appendleft((tag, item, deliveries))
+            unacked.clear()
+            self._cond.notify_all()
+
+    def _op_hello(self, unacked, prefetch, limit):
+        prefetch[0] = limit
+        return ('ok',)
+
+    def _op_put(self, unacked, prefetch, name, items):
+        with self._cond:
+            q = self._queues[name]
+            for item in items:
+                q.append((next(self._tags), item, 0))
+            self._cond.notify_all()
+        return ('ok', len(items))
+
+    def _op_fetch(self, unacked, prefetch, name, max_items, timeout):
+        def room():
+            if prefetch[0] <= 0:
+                return max_items
+            return min(max_items, prefetch[0] - len(unacked))
+
+        # Only acks on this same connection make room, and it is busy waiting here,
+        # so a consumer at its prefetch limit gets nothing right away
+        if room() <= 0:
+            return ('items', [])
+        with self._cond:
+            q = self._queues[name]
+            if not self._cond.wait_for(lambda: q, timeout):
+                return ('items', [])
+            batch = []
+            for _ in range(min(room(), len(q))):
+                tag, item, deliveries = q.popleft()
+                unacked[tag] = (name, item, deliveries + 1)
+                batch.append((tag, item, deliveries > 0))
+        return ('items', batch)
+
+    def _op_ack(self, unacked, prefetch, tags):
+        for tag in tags:
+            unacked.pop(tag, None)
+        # Acks free prefetch room, consumers blocked on it are on the same connection,
+        # so nobody else needs to be woken up
+        return ('ok',)
+
+    def _op_nack(self, unacked, prefetch, tags):
+        self._requeue({tag: unacked.pop(tag) for tag in tags if tag in unacked})
+        return ('ok',)
+
+    def _op_stats(self, unacked, prefetch, name):
+        with self._cond:
+            return ('ok', len(self._queues[name]))
+
+
+def run_broker(address, authkey):
+    broker = WorkBroker(address, authkey)
+    broker.serve_forever()
+
+
+def start_broker(address, authkey):
+    import multiprocessing
+    p = multiprocessing.Process(target=run_broker, args=(address, authkey), daemon=True)
+    p.start()
+    return p
+
+
+class WorkClient:
+    def __init__(self, address, authkey, prefetch=0, retry=5.0):
+        self._conn = connect(address, authkey, retry)
+        self._call('hello', prefetch)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _call(self, *msg):
+        self._conn.send(msg)
+        reply = self._conn.recv()
+        if reply[0] == 'error':
+            raise RuntimeError(reply[1])
+        return reply
+
+    def put(self, name, item):
+        self.put_many(name, [item])
+
+    def put_many(self, name, items):
+        return self._call('put', name, list(items))[1]
+
+    def fetch(self, name, max_items=1, timeout=None):
+        # Blocks until at least one item is ready, returns [] on timeout and right away
+        # when prefetch unacknowledged items are already held
+        return [Delivery(*d) for d in self._call('fetch', name, max_items, timeout)[1]]
+
+    def ack(self, *deliveries):
+        self._call('ack', [_tag(d) for d in deliveries])
+
+    def nack(self, *deliveries):
+        self._call('nack', [_tag(d) for d in deliveries])
+
+    def qsize(self, name):
+        return self._call('stats', name)[1]
+
+    def close(self):
+        self._conn.close()
+
+
+def _tag(delivery):
+    return delivery.tag if isinstance(delivery, Delivery) else delivery
+
+
+def _bench_consumer(address, authkey, name, batch, work, done):
+    with WorkClient(address, authkey, prefetch=batch * 2) as c:
+        while True:
+            deliveries = c.fetch(name, batch)
+            for n, d in enumerate(deliveries):
+                if d.item is None:
+                    # One sentinel per consumer, give back whatever came after it
+                    c.ack(*deliveries[:n + 1])
+                    c.nack(*deliveries[n + 1:])
+                    with done.get_lock():
+                        done.value += n
+                    return
+                for _ in range(work):
+                    pass
+            c.ack(*deliveries)
+            with done.get_lock():
+                done.value += len(deliveries)
+
+
+def bench_work_broker(nitems=20000, batch=50, work=20000, consumers=(1, 2, 4)):
+    import multiprocessing
+
+    authkey = b'peekaboo'
+    for n in consumers:
+        address = ('localhost', 25100 + n)
+        broker = start_broker(address, authkey)
+        done = multiprocessing.Value('i', 0)
+        with WorkClient(address, authkey) as producer:
+            producer.put_many('jobs', range(nitems))
+            producer.put_many('jobs', [None] * n)
+            procs = [multiprocessing.Process(target=_bench_consumer,
+                                             args=(address, authkey, 'jobs', batch, work, done))
+                     for _ in range(n)]
+            start = time.perf_counter()
+            for p in procs:
+                p.start()
+            for p in procs:
+                p.join()
+            elapsed = time.perf_counter() - start
+        broker.terminate()
+        print('{} consumers: {:.0f} items/s'.format(n, done.value / elapsed))
+
+
+if __name__ == '__main__':
+    bench_iotask_manager()
+    bench_scheduler()
+    bench_bridge_queue()
+    bench_lock_profiler()
+    bench_work_broker()
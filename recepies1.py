@@ -20,7 +20,7 @@ from functools import partial
 #         self.sock.close()
 #         self.sock = None
 
-    '''
+'''
             ---------------------- Explanation ----------------------
     
     The main reason of this class is it opens a socket connection and closes it.
@@ -28,7 +28,7 @@ from functools import partial
     context manager or with keyword, for example:
     
             ----------------------------------------------------------
-    '''
+'''
 
     # if __name__ == '__main__':
     #     conn = LazyConnection(('www.python.org', 80))
@@ -42,7 +42,7 @@ from functools import partial
     #         print(resp)
     # conn.__exit__() connection closed
 
-    '''
+'''
     The main reason behind building a context manager is that you write code that is 
     surrounded by block of instructions of with(context manager).
     When the with instructions are first given to the interpreter __enter__() method
@@ -55,7 +55,7 @@ from functools import partial
     Currently we are allowed to have a single socket connection. As seen in code, if
     more than one connection is done we raise a RuntimeError.Of course, we can go around
     and import support for multiple socket connections
-    '''
+'''
 
 
 # class LazyConnection2:
@@ -112,19 +112,19 @@ or blocking. The key point of these resources is that they need to be closed or
 #         self.month = month
 #         self.day = day
 
-    '''
+'''
         When you use slots, instead of converting each element into a dictionary, python stores them inside a 
         specific data type with fixed size similar to tuple or a list. Attributes specified inside __slots__
         are linked to a specific index of a variable. Only side effect is you can't add new attributes and will
         be able to use only those specified inside __slots__
-    '''
+'''
 
     # ------------------------------------------ Part 3 ------------------------------------------------------
 
-    '''
+'''
         When creating many classes that are used as data structures it can be eased by defining a temp buffer
         for data types that will be the base of your class constructor
-    '''
+'''
 
     # class Structure:
     #     _fields = []
@@ -143,11 +143,11 @@ or blocking. The key point of these resources is that they need to be closed or
     #
     #     p = Person('Andrew', 'Anderson')
 
-    '''
+'''
         If you decide to give keyword argument support then there are few ways to realize that approach.
         One way is to reflect keyword arguments so they would correspond to attribute names defined in _fields.
         Example:
-    '''
+'''
 
     # class Structure:
     #     _fields = []
@@ -176,10 +176,10 @@ or blocking. The key point of these resources is that they need to be closed or
     #     p3 = Person('Andrew', last_name='Anderson', address='someStreet 5-43')
     #     p3 = Person('Andrew', last_name='Anderson', address='somestreet 5')
 
-    '''
+'''
         Another way is to use keyword arguments as a resource of adding additional attributes that weren't defined
         in _fields[]
-    '''
+'''
 
     # class Structure:
     #     _fields = []
@@ -209,12 +209,12 @@ or blocking. The key point of these resources is that they need to be closed or
 
     # ------------------------------------------ Part 4 ------------------------------------------------------
 
-    '''
+'''
         You need to create a data structure, but you need to limit definition of attributes that can be assigned 
         to a class.
         Let's say, you need to create type checking for specific attributes. In order to do that, you need to
         customize attribute setup for each attribute.
-    '''
+'''
 
 #
 # class Descriptor:
@@ -286,9 +286,9 @@ or blocking. The key point of these resources is that they need to be closed or
 # class SizedString(String, MaxSized):
 #     pass
 
-    '''
+'''
         Using these types, we can define our custom class
-    '''
+'''
 
     # class Stock:
     #     name = SizedString('name', size=8)
@@ -300,10 +300,10 @@ or blocking. The key point of these resources is that they need to be closed or
     #         self.shares = shares
     #         self.price = price
 
-    '''
+'''
         There are a few other ways to make specification limit for a class.
         One of them is to use decorator class
-    '''
+'''
     # def check_attribute(**kwargs):
     #     def decorate(cls):
     #         for k, v in kwargs.items():
@@ -326,9 +326,9 @@ or blocking. The key point of these resources is that they need to be closed or
     #         self.shares = shares
     #         self.price = price
 
-    '''
+'''
         Another way is to use metaclass
-    '''
+'''
 
     # class CheckedMeta(type):
     #     def __new__(cls, clsname, bases, methods):
@@ -348,21 +348,21 @@ or blocking. The key point of these resources is that they need to be closed or
     #         self.shares = shares
     #         self.price = price
 
-    '''
+'''
         In Descriptors base class is a method __set__(), but not __get__(). If
         descriptor isn't doing anything but extract the value with the same name
         from the dict there is no need to define __get__() and further more it makes
         the program slower
-    '''
+'''
 
     # ------------------------------------------ Part 5 ------------------------------------------------------
 
-    '''
+'''
         If you need to crete a custom class that copies the behaviour of a data structure like list or dictionary,
         but you aren't completely sure what methods you need to define.
         Lets say you need to create a class that supports iteration. For that, we can inherit from 
         collections.Iterable 
-    '''
+'''
 
     # from collections import Iterable
     #
@@ -374,10 +374,10 @@ or blocking. The key point of these resources is that they need to be closed or
     #     c = Item()
     # Print error, can't instantiate class with iter
 
-    '''
+'''
         Of course, if you want to make your class iterable you can simply override __iter__(). Lets take a look at
         another example
-    '''
+'''
 
 #
 # from collections import Sequence
@@ -418,9 +418,1742 @@ or blocking. The key point of these resources is that they need to be closed or
 #     for i in items:
 #         print(i)
 
-    '''
+'''
         As you can see, example of SortedItem behaves like usual Sequence and supports all other operations
         including indexing, iteration, len(), in checking and even slicing. bisect module, used in this 
         recipe gives a comfortable support of element sorting inside a list. Since bisect.insort() inserts
         elements inside of a list, the sequence stays sorted.
+'''
+
+# ------------------------------------------ Part 6 ------------------------------------------------------
+
+'''
+    __slots__ removes the dictionary of every Date, but a million dates are still a million
+    Python objects, each of them around 56 bytes plus the int objects it points to.
+    If all records have the same fixed fields, you can turn the storage around and keep one
+    array per field (a column) instead of one object per record. array.array stores raw machine
+    values, so a year fits in 2 bytes and a month in 1. Objects are only created when you
+    look at a record, as a small view that reads from the columns.
+    When NumPy is installed, filtering and sorting run over whole columns at once.
+
+    dates = ColumnStore.from_records(['year', 'month', 'day'], rows, typecodes='hbb')
+    d = dates[0]
+    d.year
+    recent = dates.where(('year', '>=', 2010), ('month', '==', 12))
+    by_date = recent.sort('year', 'month', 'day')
+'''
+
+import array
+import itertools
+import operator
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+_compare_ops = {
+    '==': operator.eq, '!=': operator.ne,
+    '<': operator.lt, '<=': operator.le,
+    '>': operator.gt, '>=': operator.ge,
+}
+
+
+def _make_view_class(fields):
+    # One property per field, reading and writing straight into the columns
+    def make_property(n):
+        def fget(self):
+            return self._columns[n][self._index]
+
+        def fset(self, value):
+            self._columns[n][self._index] = value
+        return property(fget, fset)
+
+    attrs = {'__slots__': ('_columns', '_index'), '_fields': tuple(fields)}
+    for n, name in enumerate(fields):
+        attrs[name] = make_property(n)
+    return type('RecordView', (RecordView,), attrs)
+
+
+class RecordView:
+    __slots__ = ()
+    _fields = ()
+
+    def __init__(self, columns, index):
+        self._columns = columns
+        self._index = index
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            '{}={!r}'.format(name, getattr(self, name)) for name in self._fields))
+
+    def __eq__(self, other):
+        if isinstance(other, RecordView):
+            return self.astuple() == other.astuple()
+        return NotImplemented
+
+    def astuple(self):
+        i = self._index
+        return tuple(column[i] for column in self._columns)
+
+
+class ColumnStore:
+    def __init__(self, fields, typecodes='q', columns=None):
+        self.fields = tuple(fields)
+        if len(typecodes) == 1:
+            typecodes = typecodes * len(self.fields)
+        if len(typecodes) != len(self.fields):
+            raise TypeError('Expected {} typecodes'.format(len(self.fields)))
+        self.typecodes = typecodes
+        if columns is None:
+            columns = [array.array(code) for code in typecodes]
+        self._columns = list(columns)
+        self._index = {name: n for n, name in enumerate(self.fields)}
+        self._view = _make_view_class(self.fields)
+
+    @classmethod
+    def from_records(cls, fields, records, typecodes='q'):
+        store = cls(fields, typecodes)
+        store.extend(records)
+        return store
+
+    @classmethod
+    def from_columns(cls, typecodes='q', **columns):
+        fields = list(columns)
+        store = cls(fields, typecodes)
+        for column, values in zip(store._columns, columns.values()):
+            column.extend(values)
+        if len(set(map(len, store._columns))) > 1:
+            raise ValueError('Columns have different lengths')
+        return store
+
+    def _like(self, columns):
+        store = type(self).__new__(type(self))
+        store.fields = self.fields
+        store.typecodes = self.typecodes
+        store._columns = columns
+        store._index = self._index
+        store._view = self._view
+        return store
+
+    def __len__(self):
+        return len(self._columns[0])
+
+    def __iter__(self):
+        view, columns = self._view, self._columns
+        for i in range(len(self)):
+            yield view(columns, i)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._like([column[index] for column in self._columns])
+        try:
+            # Any integer, numpy integers too
+            index = operator.index(index)
+        except TypeError:
+            # A boolean mask or a sequence of positions
+            return self.take(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('ColumnStore index out of range')
+        return self._view(self._columns, index)
+
+    def __repr__(self):
+        return 'ColumnStore({!r}, rows={})'.format(self.fields, len(self))
+
+    def column(self, name):
+        return self._columns[self._index[name]]
+
+    def nbytes(self):
+        return sum(column.itemsize * len(column) for column in self._columns)
+
+    def append(self, *values):
+        if len(values) != len(self.fields):
+            raise TypeError('Expected {} values'.format(len(self.fields)))
+        for column, value in zip(self._columns, values):
+            column.append(value)
+
+    def extend(self, records):
+        nfields = len(self.fields)
+        start = len(self)
+        records = iter(records)
+        try:
+            # Records are turned into columns a chunk at a time, so array.extend()
+            # does the work in C and the input can still be a stream
+            while True:
+                chunk = list(itertools.islice(records, 65536))
+                if not chunk:
+                    break
+                if set(map(len, chunk)) != {nfields}:
+                    bad = next(r for r in chunk if len(r) != nfields)
+                    raise TypeError('Expected {} values, got {!r}'.format(nfields, bad))
+                for column, values in zip(self._columns, zip(*chunk)):
+                    column.extend(values)
+        except BaseException:
+            # Nothing is added on errors, so the columns keep the same length
+            for column in self._columns:
+                del column[start:]
+            raise
+
+    # ---------------- Vectorised operations ----------------
+
+    def _np_column(self, n):
+        return np.frombuffer(self._columns[n], dtype=self._columns[n].typecode)
+
+    def _from_np(self, code, values):
+        column = array.array(code)
+        column.frombytes(values.astype(code, copy=False).tobytes())
+        return column
+
+    def take(self, indices):
+        if np is not None:
+            indices = np.asarray(indices)
+            if indices.dtype == bool:
+                indices = np.flatnonzero(indices)
+            else:
+                # np.asarray([]) is float64, which numpy won't index with
+                indices = indices.astype(np.intp, copy=False)
+            return self._like([self._from_np(c.typecode, self._np_column(n)[indices])
+                               for n, c in enumerate(self._columns)])
+        indices = list(indices)
+        if indices and isinstance(indices[0], bool):
+            indices = [i for i, keep in enumerate(indices) if keep]
+        return self._like([array.array(c.typecode, map(c.__getitem__, indices)) for c in self._columns])
+
+    def mask(self, name, op, value):
+        compare = _compare_ops[op]
+        n = self._index[name]
+        if np is not None:
+            return compare(self._np_column(n), value)
+        return [compare(v, value) for v in self._columns[n]]
+
+    def where(self, *conditions):
+        # where(('year', '>=', 2000), ('month', '==', 2)), all conditions must be true
+        masks = [self.mask(*condition) for condition in conditions]
+        if not masks:
+            return self[:]
+        if np is not None:
+            return self.take(np.logical_and.reduce(masks))
+        return self.take([all(m) for m in zip(*masks)])
+
+    def argsort(self, *names, reverse=False):
+        keys = [self._index[name] for name in names or self.fields]
+        if np is not None:
+            # lexsort uses the last key as the primary one
+            columns = [self._np_column(n) for n in reversed(keys)]
+            if not reverse:
+                return np.lexsort(columns)
+            # Sorting the reversed columns keeps equal rows in their original order
+            order = np.lexsort([column[::-1] for column in columns])[::-1]
+            return len(self) - 1 - order
+        if len(keys) == 1:
+            key = self._columns[keys[0]].__getitem__
+        else:
+            columns = [self._columns[n] for n in keys]
+            key = lambda i: tuple(column[i] for column in columns)
+        return sorted(range(len(self)), key=key, reverse=reverse)
+
+    def sort(self, *names, reverse=False):
+        return self.take(self.argsort(*names, reverse=reverse))
+
+
+def bench_columns(n=10000000):
+    import gc
+    import random
+    import time
+    import tracemalloc
+
+    class Date:
+        __slots__ = ['year', 'month', 'day']
+
+        def __init__(self, year, month, day):
+            self.year = year
+            self.month = month
+            self.day = day
+
+    rand = random.Random(0)
+    rows = [(rand.randint(1900, 2100), rand.randint(1, 12), rand.randint(1, 28)) for _ in range(1000)]
+
+    def source():
+        for i in range(n):
+            yield rows[i % 1000]
+
+    for name, build in [('list of __slots__ Date', lambda: [Date(*row) for row in source()]),
+                        ('ColumnStore', lambda: ColumnStore.from_records(['year', 'month', 'day'],
+                                                                         source(), 'hbb'))]:
+        gc.collect()
+        start = time.perf_counter()
+        result = build()
+        elapsed = time.perf_counter() - start
+        del result
+        # Memory is measured in a second run, tracemalloc slows down the build a lot
+        tracemalloc.start()
+        result = build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del result
+        print('{:<24} build {:.2f} s, {:.1f} bytes per row'.format(name, elapsed, size / n))
+
+
+# ------------------------------------------ Part 7 ------------------------------------------------------
+
+'''
+    The Structure classes from Part 3 check the argument count and then call setattr() in a
+    Python loop on every construction, which makes them several times slower than a class with
+    a normal __init__. Since _fields is known when the class is created, the metaclass can write
+    that normal __init__ for us. The source code is generated from _fields and compiled once
+    with exec(), the same trick collections.namedtuple uses.
+
+    class Stock(Structure):
+        _fields = ['name', 'shares', 'price']
+
+    The generated code for Stock is simply
+
+    def __init__(self, name, shares, price, **kwargs):
+        self.name = name
+        self.shares = shares
+        self.price = price
+        if kwargs:
+            _set_extra(self, kwargs)
+
+    so positional and keyword arguments work like before, and leftover keyword arguments
+    become extra attributes (s = Stock('ACME', 50, 91.1, date='8/2/2012')).
+    The fields also become __slots__. Extra attributes still work because '__dict__' is added
+    to the slots, Python only creates that dictionary when it is really used.
+    Set _extra_attributes = False in a class to get strict slots and no extra attributes.
+    __repr__ and __eq__ are generated the same way. The instances are mutable, so like
+    dataclass(eq=True) the class gets __hash__ = None unless it defines __hash__ itself.
+    Field names are checked before they go into the source code: they must be identifiers,
+    no keywords, and not a name the generated code uses itself (self, kwargs...).
+'''
+
+import keyword
+
+_RESERVED_FIELDS = {'self', 'kwargs', 'other', '_set_extra', '_no_extra'}
+
+
+def _set_extra(instance, kwargs):
+    for name, value in kwargs.items():
+        setattr(instance, name, value)
+
+
+def _no_extra(instance, kwargs):
+    raise TypeError('Invalid argument(s): {}'.format(', '.join(kwargs)))
+
+
+def _generate_methods(clsname, fields, extra):
+    args = ''.join(', ' + name for name in fields)
+    lines = ['def __init__(self{}, **kwargs):'.format(args)]
+    lines += ['    self.{0} = {0}'.format(name) for name in fields]
+    lines += ['    if kwargs:',
+              '        {}(self, kwargs)'.format('_set_extra' if extra else '_no_extra'),
+              '',
+              'def __repr__(self):',
+              '    return "{{}}({})".format(type(self).__name__{})'.format(
+                  ', '.join('{!r}' for _ in fields), ''.join(', self.' + name for name in fields)),
+              '',
+              'def __eq__(self, other):',
+              '    if type(other) is not type(self):',
+              '        return NotImplemented',
+              '    return ({},) == ({},)'.format(', '.join('self.' + name for name in fields),
+                                               ', '.join('other.' + name for name in fields)),
+              ]
+    namespace = {'_set_extra': _set_extra, '_no_extra': _no_extra}
+    exec('\n'.join(lines), namespace)
+    methods = {name: namespace[name] for name in ('__init__', '__repr__', '__eq__')}
+    for meth in methods.values():
+        meth.__qualname__ = '{}.{}'.format(clsname, meth.__name__)
+    methods['__hash__'] = None
+    return methods
+
+
+class StructureMeta(type):
+    def __new__(cls, clsname, bases, methods):
+        fields = methods.get('_fields')
+        if fields is None:
+            fields = next((b._fields for b in bases if hasattr(b, '_fields')), ())
+        fields = tuple(fields)
+        for name in fields:
+            if (not isinstance(name, str) or not name.isidentifier() or keyword.iskeyword(name)
+                    or name.startswith('__') or name in _RESERVED_FIELDS):
+                raise TypeError('Invalid field name {!r}'.format(name))
+        if len(set(fields)) != len(fields):
+            raise TypeError('Duplicate field names in {!r}'.format(fields))
+        extra = methods.get('_extra_attributes',
+                            next((b._extra_attributes for b in bases if hasattr(b, '_extra_attributes')), True))
+
+        if '__slots__' not in methods:
+            inherited = set()
+            class_attrs = set(methods)
+            for base in bases:
+                for klass in base.__mro__:
+                    inherited.update(getattr(klass, '__slots__', ()))
+                    class_attrs.update(vars(klass))
+                    if klass is not object and '__slots__' not in vars(klass):
+                        inherited.add('__dict__')
+            # A field that is also a class attribute (a descriptor for example) can't
+            # be a slot, its value goes into __dict__ instead
+            slots = [name for name in fields if name not in inherited and name not in class_attrs]
+            in_dict = any(name in class_attrs and name not in inherited for name in fields)
+            if fields and (extra or in_dict) and '__dict__' not in inherited:
+                slots.append('__dict__')
+            methods['__slots__'] = tuple(slots)
+
+        if fields:
+            generated = _generate_methods(clsname, fields, extra)
+            if '__eq__' in methods:
+                # Python decides about __hash__ for a custom __eq__, as for any class
+                del generated['__hash__']
+            for name, meth in generated.items():
+                methods.setdefault(name, meth)
+        methods['_fields'] = fields
+        methods['_extra_attributes'] = extra
+        return super().__new__(cls, clsname, bases, methods)
+
+
+class Structure(metaclass=StructureMeta):
+    _fields = ()
+
+
+def bench_structure(n=1000000):
+    import timeit
+
+    class LoopStructure:
+        # Same as the last Structure of Part 3
+        _fields = []
+
+        def __init__(self, *args, **kwargs):
+            if len(args) != len(self._fields) and (len(args) + len(kwargs) != len(self._fields)):
+                raise TypeError('Expected {} of arguments'.format(len(self._fields)))
+            for name, value in zip(self._fields, args):
+                setattr(self, name, value)
+            extra_args = kwargs.keys() - self._fields
+            for name in extra_args:
+                setattr(self, name, kwargs.pop(name))
+            if kwargs:
+                raise TypeError('Duplicate values for {}'.format(', '.join(kwargs)))
+
+    class LoopStock(LoopStructure):
+        _fields = ['name', 'shares', 'price']
+
+    class PlainStock:
+        def __init__(self, name, shares, price):
+            self.name = name
+            self.shares = shares
+            self.price = price
+
+    class Stock(Structure):
+        _fields = ['name', 'shares', 'price']
+
+    for name, cls in [('plain class', PlainStock), ('setattr loop', LoopStock), ('generated', Stock)]:
+        elapsed = min(timeit.repeat(lambda: cls('ACME', 50, 91.1), number=n, repeat=3))
+        print('{:<14} {:.0f} ns per construction'.format(name, elapsed / n * 1e9))
+
+
+# ------------------------------------------ Part 8 ------------------------------------------------------
+
+'''
+    The descriptors from Part 4 are nice building blocks, but every assignment walks the
+    whole super().__set__() chain. For a SizedString that is SizedString -> Typed -> MaxSized
+    -> Descriptor, one Python call per level, and Stock() pays it for every field.
+    Here every constraint class also describes its check as a line of source code in
+    _check_source. When a descriptor is created, the checks of all classes in its MRO are
+    glued together into one __set__ function, compiled with exec(), and the descriptor is
+    switched to a small subclass that uses it. For SizedString(size=8) the result is
+
+    def __set__(self, instance, value):
+        if not isinstance(value, expected_type):
+            raise TypeError('Expected type {}'.format(expected_type))
+        if len(value) >= size:
+            raise ValueError('size must be < ' + str(size))
+        instance.__dict__[self.name] = value
+
+    Classes that override __set__ without giving a _check_source keep the normal chain.
+    CheckedMeta and check_attribute() work as before and also remember the field order,
+    which bulk_load() uses. bulk_load() validates a whole batch of rows first and then builds
+    the instances without going through the descriptors at all.
+'''
+
+
+class Descriptor:
+    _check_source = None
+    _check_params = ()
+
+    def __init__(self, name=None, **opts):
+        self.name = name
+        for key, value in opts.items():
+            setattr(self, key, value)
+        self._compile()
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.name] = value
+
+    def check(self, value):
+        # Runs the whole __set__ chain against a throw away object
+        self.__set__(_CheckTarget(), value)
+        return value
+
+    def _compile(self):
+        cls = type(self)
+        if vars(cls).get('_fused'):
+            return
+        snippets = []
+        params = {}
+        for klass in cls.__mro__:
+            if klass is Descriptor:
+                break
+            attrs = vars(klass)
+            if '_check_source' in attrs:
+                snippets.append(attrs['_check_source'])
+                for param in klass._check_params:
+                    params[param] = getattr(self, param)
+            elif '__set__' in attrs:
+                # Hand written __set__, keep the super() chain
+                return
+        if snippets:
+            self.__class__ = _fused_class(cls, snippets, params)
+
+
+class _CheckTarget:
+    pass
+
+
+_fused_cache = {}
+
+
+def _fused_class(cls, snippets, params):
+    try:
+        key = (cls, tuple(sorted(params.items())))
+        hash(key)
+    except TypeError:
+        key = None
+    if key in _fused_cache:
+        return _fused_cache[key]
+    body = ''.join('    ' + line + '\n' for snippet in snippets for line in snippet.splitlines())
+    source = ('def __set__(self, instance, value):\n' + body +
+              '    instance.__dict__[self.name] = value\n\n'
+              'def check(self, value):\n' + body +
+              '    return value\n')
+    namespace = dict(params)
+    exec(source, namespace)
+    fused = type(cls.__name__, (cls,), {
+        '__set__': namespace['__set__'],
+        'check': namespace['check'],
+        '__qualname__': cls.__qualname__,
+        '__module__': cls.__module__,
+        '_fused': True,
+    })
+    if key is not None:
+        _fused_cache[key] = fused
+    return fused
+
+
+def _is_array(values):
+    return np is not None and isinstance(values, np.ndarray) and values.dtype != object
+
+
+_numpy_kinds = {int: 'biu', float: 'f', str: 'U', bytes: 'S'}
+
+
+class Typed(Descriptor):
+    expected_type = type(None)
+    _check_source = ('if not isinstance(value, expected_type):\n'
+                     '    raise TypeError("Expected type {}".format(expected_type))')
+    _check_params = ('expected_type',)
+
+    def __set__(self, instance, value):
+        if not isinstance(value, self.expected_type):
+            raise TypeError('Expected type {}'.format(self.expected_type))
+        super().__set__(instance, value)
+
+    def _check_column(self, values):
+        # Whole column version of the check, see Part 9
+        expected = self.expected_type
+        if _is_array(values):
+            dtype = values.dtype
+            if issubclass(dtype.type, expected) or dtype.kind in _numpy_kinds.get(expected, ''):
+                return []
+            bad = range(len(values))
+        # map() and set() run in C, the loop below only runs when something is wrong
+        elif all(issubclass(t, expected) for t in set(map(type, values))):
+            return []
+        else:
+            bad = [i for i, v in enumerate(values) if not isinstance(v, expected)]
+        return [(i, TypeError('Expected type {}'.format(expected))) for i in bad]
+
+
+class Unsigned(Descriptor):
+    _check_source = ('if value < 0:\n'
+                     '    raise ValueError("Expected >= 0")')
+
+    def __set__(self, instance, value):
+        if value < 0:
+            raise ValueError('Expected >= 0')
+        super().__set__(instance, value)
+
+    def _check_column(self, values):
+        if _is_array(values):
+            bad = np.flatnonzero(values < 0).tolist()
+        elif not len(values) or min(values) >= 0:
+            return []
+        else:
+            bad = [i for i, v in enumerate(values) if v < 0]
+        return [(i, ValueError('Expected >= 0')) for i in bad]
+
+
+class MaxSized(Descriptor):
+    _check_source = ('if len(value) >= size:\n'
+                     '    raise ValueError("size must be < " + str(size))')
+    _check_params = ('size',)
+
+    def __init__(self, name=None, **opts):
+        if 'size' not in opts:
+            raise ValueError('Expected size option')
+        super().__init__(name, **opts)
+
+    def __set__(self, instance, value):
+        if len(value) >= self.size:
+            raise ValueError('size must be < ' + str(self.size))
+        super().__set__(instance, value)
+
+    def _check_column(self, values):
+        if _is_array(values):
+            bad = np.flatnonzero(np.char.str_len(values) >= self.size).tolist()
+        elif not len(values) or max(map(len, values)) < self.size:
+            return []
+        else:
+            bad = [i for i, v in enumerate(values) if len(v) >= self.size]
+        return [(i, ValueError('size must be < ' + str(self.size))) for i in bad]
+
+
+class Integer(Typed):
+    expected_type = int
+
+
+class UnsignedInteger(Integer, Unsigned):
+    pass
+
+
+class Float(Typed):
+    expected_type = float
+
+
+class UnsignedFloat(Float, Unsigned):
+    pass
+
+
+class String(Typed):
+    expected_type = str
+
+
+class SizedString(String, MaxSized):
+    pass
+
+
+def check_attribute(**kwargs):
+    def decorate(cls):
+        for k, v in kwargs.items():
+            if isinstance(v, Descriptor):
+                v.name = k
+                setattr(cls, k, v)
+            else:
+                setattr(cls, k, v(k))
+        inherited = [name for name in getattr(cls, '_checked_fields', ()) if name not in kwargs]
+        cls._checked_fields = tuple(inherited) + tuple(kwargs)
+        return cls
+    return decorate
+
+
+class CheckedMeta(type):
+    def __new__(cls, clsname, bases, methods):
+        # Fields of the bases come first, in MRO order. A field defined again keeps its
+        # place, one replaced by something that is not a descriptor is dropped.
+        fields = []
+        for base in reversed(bases):
+            for klass in reversed(base.__mro__):
+                for name in vars(klass).get('_checked_fields', ()):
+                    if name not in fields:
+                        fields.append(name)
+        fields = [name for name in fields if name not in methods or isinstance(methods[name], Descriptor)]
+        for key, value in methods.items():
+            if isinstance(value, Descriptor):
+                value.name = key
+                if key not in fields:
+                    fields.append(key)
+        methods['_checked_fields'] = tuple(fields)
+        return type.__new__(cls, clsname, bases, methods)
+
+    # Batch loading, see Part 9
+    def from_columns(cls, result='instances', **columns):
+        return load_columns(cls, result, **columns)
+
+    def from_rows(cls, rows, result='instances'):
+        return load_rows(cls, rows, result)
+
+
+def bulk_load(cls, rows, trusted=False):
     '''
+        Builds instances of a checked class from rows of values in _checked_fields order.
+        The whole batch is validated first, unless trusted=True, then the instances are
+        filled in directly, without calling __init__ or the descriptors.
+    '''
+    fields = cls._checked_fields
+    if not isinstance(rows, list):
+        rows = list(rows)
+    if not trusted:
+        checks = [getattr(cls, name).check for name in fields]
+        for row in rows:
+            if len(row) != len(fields):
+                raise TypeError('Expected {} values, got {!r}'.format(len(fields), row))
+            for check, value in zip(checks, row):
+                check(value)
+    new = cls.__new__
+    result = []
+    append = result.append
+    for row in rows:
+        obj = new(cls)
+        obj.__dict__.update(zip(fields, row))
+        append(obj)
+    return result
+
+
+def bench_descriptors(n=1000000):
+    import timeit
+
+    class Stock(metaclass=CheckedMeta):
+        name = SizedString(size=8)
+        shares = UnsignedInteger()
+        price = UnsignedFloat()
+
+        def __init__(self, name, shares, price):
+            self.name = name
+            self.shares = shares
+            self.price = price
+
+    s = Stock('ACME', 50, 91.1)
+    fused = [Stock.__dict__[name] for name in Stock._checked_fields]
+    elapsed = min(timeit.repeat(lambda: setattr(s, 'name', 'IBM'), number=n, repeat=3))
+    print('Fused SizedString set      {:.0f} ns'.format(elapsed / n * 1e9))
+    elapsed = min(timeit.repeat(lambda: Stock('ACME', 50, 91.1), number=n, repeat=3))
+    print('Fused Stock()              {:.0f} ns'.format(elapsed / n * 1e9))
+
+    # Switch the descriptors back to their normal classes
+    for d in fused:
+        d.__class__ = type(d).__bases__[0]
+    elapsed = min(timeit.repeat(lambda: setattr(s, 'name', 'IBM'), number=n, repeat=3))
+    print('super() chain SizedString  {:.0f} ns'.format(elapsed / n * 1e9))
+    elapsed = min(timeit.repeat(lambda: Stock('ACME', 50, 91.1), number=n, repeat=3))
+    print('super() chain Stock()      {:.0f} ns'.format(elapsed / n * 1e9))
+    for d in fused:
+        d._compile()
+
+    rows = [('ACME', 50, 91.1)] * n
+    elapsed = min(timeit.repeat(lambda: [Stock(*row) for row in rows], number=1, repeat=3))
+    print('[Stock(*row) for row]   {:.0f} ns per row'.format(elapsed / n * 1e9))
+    for trusted in (False, True):
+        elapsed = min(timeit.repeat(lambda: bulk_load(Stock, rows, trusted), number=1, repeat=3))
+        print('bulk_load(trusted={})   {:.0f} ns per row'.format(trusted, elapsed / n * 1e9))
+
+
+# ------------------------------------------ Part 9 ------------------------------------------------------
+
+'''
+    Loading millions of rows one Stock() at a time is still one __set__ call per field per
+    row. When the data comes in as whole columns (a CSV reader, a database cursor, NumPy
+    arrays) each constraint can be checked once for the whole column instead:
+    Typed looks at the set of types in the column, Unsigned at min(), MaxSized at max(len).
+    With NumPy arrays the checks become array comparisons.
+    Every constraint also has a _check_column() doing this, and load_columns() runs them
+    in the same order as __set__ would. Rows that fail one check are not passed to the next
+    ones, so len() is never called on a number. All problems are collected with their row
+    index and raised together as a ValidationError.
+
+    stocks = Stock.from_rows(rows)
+    columns = Stock.from_columns(name=names, shares=shares, price=prices, result='columns')
+
+    try:
+        Stock.from_rows([('ACME', 50, 91.1), ('IBM', -1, 10.0)])
+    except ValidationError as e:
+        print(e.errors)        # [(1, 'shares', ValueError('Expected >= 0'))]
+'''
+
+
+class ValidationError(ValueError):
+    def __init__(self, errors):
+        self.errors = errors
+        shown = '; '.join('row {} {}: {}'.format(row, field, exc) for row, field, exc in errors[:5])
+        more = ' (and {} more)'.format(len(errors) - 5) if len(errors) > 5 else ''
+        super().__init__('{} invalid value(s): {}{}'.format(len(errors), shown, more))
+
+
+def _element_check_column(descriptor, values):
+    bad = []
+    for i, value in enumerate(values):
+        try:
+            descriptor.check(value)
+        except (TypeError, ValueError) as e:
+            bad.append((i, e))
+    return bad
+
+
+def column_errors(descriptor, values):
+    # List of (row, exception) for one column
+    if not getattr(type(descriptor), '_fused', False):
+        # Hand written __set__, the only safe way is one value at a time
+        return _element_check_column(descriptor, values)
+    errors = []
+    rows = None                 # Position of values[i] in the original column
+    for klass in type(descriptor).__mro__:
+        check = vars(klass).get('_check_column')
+        if check is None:
+            continue
+        try:
+            bad = check(descriptor, values)
+        except TypeError:
+            # min() or len() on values of mixed types, check the rest one by one
+            errors.extend((i if rows is None else rows[i], e)
+                          for i, e in _element_check_column(descriptor, values))
+            break
+        if not bad:
+            continue
+        errors.extend((i if rows is None else rows[i], e) for i, e in bad)
+        failed = {i for i, e in bad}
+        keep = [i for i in range(len(values)) if i not in failed]
+        rows = keep if rows is None else [rows[i] for i in keep]
+        values = values[keep] if _is_array(values) else [values[i] for i in keep]
+    errors.sort(key=lambda e: e[0])
+    return errors
+
+
+def validate_columns(cls, **columns):
+    fields = cls._checked_fields
+    if set(columns) != set(fields):
+        raise TypeError('Expected columns {}'.format(', '.join(fields)))
+    if len({len(column) for column in columns.values()}) > 1:
+        raise ValueError('Columns have different lengths')
+    errors = []
+    for name in fields:
+        descriptor = getattr(cls, name)
+        errors.extend((row, name, exc) for row, exc in column_errors(descriptor, columns[name]))
+    if errors:
+        errors.sort(key=lambda e: e[0])
+        raise ValidationError(errors)
+
+
+def load_columns(cls, result='instances', **columns):
+    validate_columns(cls, **columns)
+    fields = cls._checked_fields
+    if result == 'columns':
+        return {name: columns[name] for name in fields}
+    if result != 'instances':
+        raise ValueError("result must be 'instances' or 'columns'")
+    python_columns = [columns[name].tolist() if _is_array(columns[name]) else columns[name]
+                      for name in fields]
+    return bulk_load(cls, list(zip(*python_columns)), trusted=True)
+
+
+def load_rows(cls, rows, result='instances'):
+    fields = cls._checked_fields
+    if not isinstance(rows, list):
+        rows = list(rows)
+    if rows and set(map(len, rows)) != {len(fields)}:
+        i = next(i for i, row in enumerate(rows) if len(row) != len(fields))
+        raise TypeError('Row {}: expected {} values, got {!r}'.format(i, len(fields), rows[i]))
+    columns = list(zip(*rows)) if rows else [()] * len(fields)
+    validate_columns(cls, **dict(zip(fields, columns)))
+    if result == 'columns':
+        return {name: list(column) for name, column in zip(fields, columns)}
+    if result != 'instances':
+        raise ValueError("result must be 'instances' or 'columns'")
+    return bulk_load(cls, rows, trusted=True)
+
+
+def bench_batch_load(n=1000000):
+    import time
+
+    class Stock(metaclass=CheckedMeta):
+        name = SizedString(size=8)
+        shares = UnsignedInteger()
+        price = UnsignedFloat()
+
+        def __init__(self, name, shares, price):
+            self.name = name
+            self.shares = shares
+            self.price = price
+
+    rows = [('ACME', i, 91.1) for i in range(n)]
+    start = time.perf_counter()
+    [Stock(*row) for row in rows]
+    print('Stock(*row)             {:.2f} s'.format(time.perf_counter() - start))
+    start = time.perf_counter()
+    Stock.from_rows(rows)
+    print('from_rows()             {:.2f} s'.format(time.perf_counter() - start))
+    start = time.perf_counter()
+    Stock.from_rows(rows, result='columns')
+    print('from_rows(columns)      {:.2f} s'.format(time.perf_counter() - start))
+    columns = {name: [row[n] for row in rows] for n, name in enumerate(Stock._checked_fields)}
+    start = time.perf_counter()
+    Stock.from_columns(result='columns', **columns)
+    print('from_columns(lists)     {:.2f} s'.format(time.perf_counter() - start))
+    if np is not None:
+        arrays = {name: np.array(column) for name, column in columns.items()}
+        start = time.perf_counter()
+        Stock.from_columns(result='columns', **arrays)
+        print('from_columns(numpy)     {:.2f} s'.format(time.perf_counter() - start))
+
+    # A subclass checks and loads the fields of its base
+    class SubStock(Stock):
+        pass
+
+    assert SubStock._checked_fields == Stock._checked_fields
+    assert type(SubStock.from_rows(rows[:10])[0]) is SubStock
+    assert SubStock.from_columns(result='columns', **columns).keys() == columns.keys()
+    try:
+        SubStock.from_rows([('ACME', -1, 91.1)])
+    except ValidationError as e:
+        assert [(row, name) for row, name, exc in e.errors] == [(0, 'shares')]
+    else:
+        raise AssertionError('SubStock.from_rows() did not check shares')
+
+
+# ------------------------------------------ Part 10 -----------------------------------------------------
+
+'''
+    A class declared with _fields and Integer/Float/SizedString descriptors already says
+    everything a fixed binary layout needs: the order of the fields, their types and, for
+    strings, the maximum size. Record builds a struct.Struct from that declaration, so
+    records can be written as raw bytes instead of going through pickle or JSON.
+
+    class Stock(Record):
+        _fields = ['name', 'shares', 'price']
+        name = SizedString(size=8)
+        shares = UnsignedInteger()
+        price = UnsignedFloat()
+
+    data = Stock('ACME', 50, 91.1).pack()          # 24 bytes, '<8sQd'
+    s = Stock.unpack(data)
+    buf = Stock.pack_many(stocks)                   # one bytearray for all of them
+    for s in Stock.iter_unpack(memoryview(buf)):
+        ...
+
+    Integers are 8 byte signed ('q') or unsigned ('Q'), floats are doubles ('d') and a
+    SizedString(size=n) takes n bytes of UTF-8, padded with zero bytes, so such a string
+    can't end with a zero byte itself. Other 'ns' fields (bytes) are stored as they are, zero
+    bytes and all, and come back n bytes long. Put a struct_format option on a descriptor to
+    pick another code, Integer(struct_format='i') for example.
+    iter_unpack() works straight on the buffer, struct.iter_unpack() does not copy it.
+    The pack and unpack functions are generated and compiled once per class, like __init__.
+'''
+
+import struct
+
+
+class CheckedStructureMeta(StructureMeta, CheckedMeta):
+    pass
+
+
+class Record(Structure, metaclass=CheckedStructureMeta):
+    _fields = ()
+
+    def pack(self):
+        return type(self)._layout().pack(self)
+
+    @classmethod
+    def unpack(cls, buffer):
+        return cls._layout().unpack(buffer)
+
+    @classmethod
+    def pack_many(cls, records):
+        return cls._layout().pack_many(records)
+
+    @classmethod
+    def iter_unpack(cls, buffer):
+        return cls._layout().iter_unpack(buffer)
+
+    @classmethod
+    def _layout(cls):
+        layout = cls.__dict__.get('_record_layout')
+        if layout is None:
+            layout = RecordLayout(cls)
+            cls._record_layout = layout
+        return layout
+
+
+def _struct_code(name, descriptor):
+    code = getattr(descriptor, 'struct_format', None)
+    if code is not None:
+        return code
+    if isinstance(descriptor, MaxSized) and isinstance(descriptor, String):
+        return '{}s'.format(descriptor.size)
+    if isinstance(descriptor, Integer):
+        return 'Q' if isinstance(descriptor, Unsigned) else 'q'
+    if isinstance(descriptor, Float):
+        return 'd'
+    raise TypeError('No binary layout for field {!r} ({})'.format(name, type(descriptor).__name__))
+
+
+class RecordLayout:
+    def __init__(self, cls, byteorder='<'):
+        self.cls = cls
+        fields = cls._fields
+        descriptors = [getattr(cls, name, None) for name in fields]
+        codes = [_struct_code(name, d) for name, d in zip(fields, descriptors)]
+        self.struct = struct.Struct(byteorder + ''.join(codes))
+        self.size = self.struct.size
+        # Only str fields are padded, trailing zero bytes of a bytes field are part of its value
+        strings = [n for n, code in enumerate(codes)
+                   if code.endswith('s') and isinstance(descriptors[n], String)
+                   and issubclass(descriptors[n].expected_type, str)]
+
+        # pack: encode strings and refuse to cut them, struct would do it silently
+        lines = ['def to_values(obj):']
+        values = []
+        for n, name in enumerate(fields):
+            if n in strings:
+                lines.append('    v{0} = obj.{1}.encode("utf-8")'.format(n, name))
+                lines.append('    if len(v{0}) > {1}:'.format(n, int(codes[n][:-1])))
+                lines.append('        raise ValueError("{} does not fit into {} bytes")'.format(name, codes[n][:-1]))
+                lines.append('    if v{0}.endswith(b"\\0"):'.format(n))
+                lines.append('        raise ValueError("{} ends with a zero byte, it would be taken for padding")'.format(name))
+                values.append('v{}'.format(n))
+            else:
+                values.append('obj.{}'.format(name))
+        lines.append('    return ({},)'.format(', '.join(values)))
+
+        # unpack: strip the padding, decode and fill __dict__ without validating again
+        lines.append('def from_values(t):')
+        lines.append('    obj = new(cls)')
+        items = []
+        for n, name in enumerate(fields):
+            if n in strings:
+                items.append('{!r}: t[{}].rstrip(b"\\0").decode("utf-8")'.format(name, n))
+            else:
+                items.append('{!r}: t[{}]'.format(name, n))
+        lines.append('    obj.__dict__.update({{{}}})'.format(', '.join(items)))
+        lines.append('    return obj')
+        namespace = {'new': cls.__new__, 'cls': cls}
+        exec('\n'.join(lines), namespace)
+        self._to_values = namespace['to_values']
+        self._from_values = namespace['from_values']
+
+    def pack(self, obj):
+        return self.struct.pack(*self._to_values(obj))
+
+    def unpack(self, buffer):
+        return self._from_values(self.struct.unpack(buffer))
+
+    def pack_many(self, records):
+        if not isinstance(records, (list, tuple)):
+            records = list(records)
+        size = self.size
+        buf = bytearray(size * len(records))
+        pack_into = self.struct.pack_into
+        to_values = self._to_values
+        for n, obj in enumerate(records):
+            pack_into(buf, n * size, *to_values(obj))
+        return buf
+
+    def iter_unpack(self, buffer):
+        return map(self._from_values, self.struct.iter_unpack(buffer))
+
+
+class _PackedStock(Record):
+    # Module level, so pickle can find it
+    _fields = ['name', 'shares', 'price']
+    name = SizedString(size=8)
+    shares = UnsignedInteger()
+    price = UnsignedFloat()
+
+
+def bench_record_packing(n=1000000):
+    import pickle
+    import time
+
+    Stock = _PackedStock
+    stocks = Stock.from_rows([('ACME', i, 91.1) for i in range(n)])
+    for name, dump, load in [
+            ('pickle', pickle.dumps, pickle.loads),
+            ('struct', Stock.pack_many, lambda buf: list(Stock.iter_unpack(memoryview(buf))))]:
+        start = time.perf_counter()
+        data = dump(stocks)
+        middle = time.perf_counter()
+        load(data)
+        end = time.perf_counter()
+        print('{:<7} {:>6.1f} MB, dump {:.0f} ns, load {:.0f} ns per record'.format(
+            name, len(data) / 1e6, (middle - start) / n * 1e9, (end - middle) / n * 1e9))
+
+
+# ------------------------------------------ Part 11 -----------------------------------------------------
+
+'''
+    With a fixed layout from Part 10 there is no need to load a whole file of records into
+    Python objects. Record n always starts at header_size + n * record_size, so the file can
+    be mapped into memory with mmap and a record is only decoded when you ask for it.
+    Opening the file reads just the header, no matter how big the file is, and the OS only
+    loads the pages you actually touch.
+
+    with RecordFileWriter(Stock, 'stocks.rec') as w:
+        w.write_many(stocks)
+        w.write(Stock('ACME', 50, 91.1))
+
+    with RecordFile(Stock, 'stocks.rec') as f:
+        len(f)
+        f[1000000]
+        for s in f[5000:6000]:       # slices are lazy too
+            ...
+
+    The header holds a magic value, a version and the struct format of the class, so a file
+    can't be read with the wrong class by accident. The writer only ever appends, the number
+    of records comes from the file size. A half written record at the end (a crash during a
+    write) is ignored by readers and cut off when the file is opened for writing again.
+    refresh() maps the file again after another process appended to it.
+'''
+
+import mmap
+import os
+
+_RECORD_MAGIC = b'RECF'
+_RECORD_VERSION = 1
+_record_header = struct.Struct('<4sHH')
+
+
+def _make_record_header(layout):
+    fmt = layout.struct.format.encode('ascii')
+    header = _record_header.pack(_RECORD_MAGIC, _RECORD_VERSION, len(fmt)) + fmt
+    # Keep the records 8 byte aligned
+    return header + b'\0' * (-len(header) % 8)
+
+
+def _read_record_header(f, layout, path):
+    fixed = f.read(_record_header.size)
+    if len(fixed) < _record_header.size:
+        raise ValueError('{}: not a record file'.format(path))
+    magic, version, fmt_len = _record_header.unpack(fixed)
+    if magic != _RECORD_MAGIC:
+        raise ValueError('{}: not a record file'.format(path))
+    if version != _RECORD_VERSION:
+        raise ValueError('{}: unsupported version {}'.format(path, version))
+    fmt = f.read(fmt_len).decode('ascii')
+    if fmt != layout.struct.format:
+        raise ValueError('{}: records have format {!r}, {} uses {!r}'.format(
+            path, fmt, layout.cls.__name__, layout.struct.format))
+    size = _record_header.size + fmt_len
+    return size + (-size % 8)
+
+
+class RecordFileWriter:
+    def __init__(self, cls, path):
+        self.layout = cls._layout()
+        self.path = path
+        self._file = open(path, 'a+b')
+        self._file.seek(0, os.SEEK_END)
+        end = self._file.tell()
+        if end == 0:
+            self._file.write(_make_record_header(self.layout))
+        else:
+            self._file.seek(0)
+            header_size = _read_record_header(self._file, self.layout, path)
+            partial = (end - header_size) % self.layout.size
+            if partial:
+                self._file.truncate(end - partial)
+            self._file.seek(0, os.SEEK_END)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, record):
+        self._file.write(self.layout.pack(record))
+
+    def write_many(self, records, chunk=65536):
+        records = iter(records)
+        while True:
+            batch = list(itertools.islice(records, chunk))
+            if not batch:
+                break
+            self._file.write(self.layout.pack_many(batch))
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class RecordFile:
+    def __init__(self, cls, path):
+        self.layout = cls._layout()
+        self.path = path
+        self._file = open(path, 'rb')
+        self._header_size = _read_record_header(self._file, self.layout, path)
+        self._mmap = None
+        self._range = range(0)
+        self.refresh()
+
+    def refresh(self):
+        # Picks up records appended since the file was opened
+        size = os.fstat(self._file.fileno()).st_size
+        count = (size - self._header_size) // self.layout.size
+        if self._mmap is not None and count == len(self._range):
+            return
+        if self._mmap is not None:
+            self._mmap.close()
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._range = range(count)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._file.close()
+
+    def __len__(self):
+        return len(self._range)
+
+    def __repr__(self):
+        return 'RecordFile({}, {!r}, records={})'.format(self.layout.cls.__name__, self.path, len(self))
+
+    def _decode(self, n):
+        offset = self._header_size + n * self.layout.size
+        return self.layout._from_values(self.layout.struct.unpack_from(self._mmap, offset))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return RecordFileSlice(self, self._range[index])
+        return self._decode(self._range[index])
+
+    def __iter__(self):
+        return iter(RecordFileSlice(self, self._range))
+
+
+class RecordFileSlice:
+    # A lazy view on a range of records, nothing is decoded until it is used
+
+    def __init__(self, source, records):
+        self._source = source
+        self._range = records
+
+    def __len__(self):
+        return len(self._range)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return RecordFileSlice(self._source, self._range[index])
+        return self._source._decode(self._range[index])
+
+    def __iter__(self):
+        source, r = self._source, self._range
+        if r.step == 1:
+            # Records are next to each other, let struct walk over them. The memoryview
+            # is read a chunk at a time, so closing the file is not blocked for long.
+            size = source.layout.size
+            start = source._header_size + r.start * size
+            stop = source._header_size + r.stop * size
+            chunk = size * 4096
+            for offset in range(start, stop, chunk):
+                with memoryview(source._mmap) as view:
+                    block = list(source.layout.iter_unpack(view[offset:min(offset + chunk, stop)]))
+                yield from block
+        else:
+            for n in r:
+                yield source._decode(n)
+
+
+def bench_record_file(n=1000000):
+    import tempfile
+    import time
+
+    Stock = _PackedStock
+    stocks = Stock.from_rows([('ACME', i, 91.1) for i in range(n)])
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench_records.rec')
+        start = time.perf_counter()
+        with RecordFileWriter(Stock, path) as w:
+            w.write_many(stocks)
+        print('write {} records  {:.2f} s, {:.1f} MB'.format(
+            n, time.perf_counter() - start, os.path.getsize(path) / 1e6))
+        del stocks
+        start = time.perf_counter()
+        with RecordFile(Stock, path) as f:
+            print('open               {:.3f} ms'.format((time.perf_counter() - start) * 1000))
+            start = time.perf_counter()
+            f[n // 2]
+            print('random access      {:.3f} ms'.format((time.perf_counter() - start) * 1000))
+            start = time.perf_counter()
+            count = sum(1 for _ in f)
+            print('iterate {} records {:.2f} s'.format(count, time.perf_counter() - start))
+
+
+# ------------------------------------------ Part 12 -----------------------------------------------------
+
+'''
+    SortedItem from Part 5 keeps everything in one list, so every bisect.insort() has to
+    move all items after the insertion point. With millions of items that memmove makes each
+    add() slower and slower.
+    The fix is to cut the list into many small sorted lists, each at most 2 * load items
+    long, and to keep the largest item of every sublist in a separate list (_maxes).
+    add() bisects _maxes to find the right sublist and only moves items inside it. A sublist
+    that grows too big is split in two, one that gets too small is joined with a neighbour.
+    To find the item at position i the sizes of the sublists are kept in a Fenwick tree
+    (binary indexed tree), which gives the sublist holding position i in O(log n).
+
+    items = SortedItem([10, 43, 3])
+    items.add(2)
+    items.update(range(1000000))
+    items[500000]
+    events = SortedItem(key=attrgetter('timestamp'))
+
+    With key=..., items are ordered by key(item) and items with equal keys stay in the
+    order they were added. The class is still a Sequence, so indexing, slicing, in, len()
+    and iteration work like before.
+'''
+
+from bisect import bisect_left, bisect_right, insort
+from collections.abc import Sequence
+
+
+class SortedItem(Sequence):
+    def __init__(self, sequence=None, key=None, load=1000):
+        self._key = key
+        self._load = load
+        self._reset([])
+        if sequence is not None:
+            self.update(sequence)
+
+    # ---------------- Internal layout ----------------
+
+    def _reset(self, values):
+        # values are already sorted
+        load = self._load
+        self._lists = [values[i:i + load] for i in range(0, len(values), load)]
+        if self._key is None:
+            self._keys = self._lists
+        else:
+            self._keys = [list(map(self._key, sub)) for sub in self._lists]
+        self._maxes = [sub[-1] for sub in self._keys]
+        self._len = len(values)
+        self._tree = None
+
+    def _build_tree(self):
+        tree = [0]
+        tree.extend(map(len, self._lists))
+        size = len(tree) - 1
+        for i in range(1, size + 1):
+            j = i + (i & -i)
+            if j <= size:
+                tree[j] += tree[i]
+        self._tree = tree
+
+    def _tree_update(self, pos, delta):
+        tree = self._tree
+        if tree is None:
+            return
+        i = pos + 1
+        size = len(tree) - 1
+        while i <= size:
+            tree[i] += delta
+            i += i & -i
+
+    def _offset(self, pos):
+        # Number of items in the sublists before lists[pos]
+        if self._tree is None:
+            self._build_tree()
+        tree = self._tree
+        total = 0
+        while pos > 0:
+            total += tree[pos]
+            pos -= pos & -pos
+        return total
+
+    def _loc(self, index):
+        # Position index -> (sublist, index inside the sublist)
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError('SortedItem index out of range')
+        lists = self._lists
+        if index < len(lists[0]):
+            return 0, index
+        last = self._len - len(lists[-1])
+        if index >= last:
+            return len(lists) - 1, index - last
+        if self._tree is None:
+            self._build_tree()
+        tree = self._tree
+        size = len(tree) - 1
+        pos = 0
+        bit = 1 << (size.bit_length() - 1)
+        while bit:
+            nxt = pos + bit
+            if nxt <= size and tree[nxt] <= index:
+                pos = nxt
+                index -= tree[nxt]
+            bit >>= 1
+        return pos, index
+
+    def _expand(self, pos):
+        lists, keys, load = self._lists, self._keys, self._load
+        if len(lists[pos]) > 2 * load:
+            lists.insert(pos + 1, lists[pos][load:])
+            del lists[pos][load:]
+            if keys is not lists:
+                keys.insert(pos + 1, keys[pos][load:])
+                del keys[pos][load:]
+            self._maxes[pos] = keys[pos][-1]
+            self._maxes.insert(pos + 1, keys[pos + 1][-1])
+            self._tree = None
+        else:
+            self._tree_update(pos, 1)
+
+    def _delete(self, pos, idx):
+        lists, keys, maxes = self._lists, self._keys, self._maxes
+        del lists[pos][idx]
+        if keys is not lists:
+            del keys[pos][idx]
+        self._len -= 1
+        size = len(lists[pos])
+        if size == 0:
+            del lists[pos]
+            if keys is not lists:
+                del keys[pos]
+            del maxes[pos]
+            self._tree = None
+        elif size < self._load // 2 and len(lists) > 1:
+            # Join with a neighbour, split again if that got too big
+            prev = pos - 1 if pos > 0 else pos
+            lists[prev].extend(lists[prev + 1])
+            del lists[prev + 1]
+            if keys is not lists:
+                keys[prev].extend(keys[prev + 1])
+                del keys[prev + 1]
+            del maxes[prev + 1]
+            maxes[prev] = keys[prev][-1]
+            self._tree = None
+            self._expand(prev)
+        else:
+            maxes[pos] = keys[pos][-1]
+            self._tree_update(pos, -1)
+
+    def _find(self, value):
+        # (sublist, index) of value or None
+        if not self._maxes:
+            return None
+        if self._key is None:
+            pos = bisect_left(self._maxes, value)
+            if pos == len(self._maxes):
+                return None
+            idx = bisect_left(self._lists[pos], value)
+            return (pos, idx) if self._lists[pos][idx] == value else None
+        key = self._key(value)
+        pos = bisect_left(self._maxes, key)
+        if pos == len(self._maxes):
+            return None
+        idx = bisect_left(self._keys[pos], key)
+        # Walk over all items with an equal key
+        lists, keys = self._lists, self._keys
+        while pos < len(lists):
+            sub_keys = keys[pos]
+            while idx < len(sub_keys):
+                if sub_keys[idx] != key:
+                    return None
+                if lists[pos][idx] == value:
+                    return pos, idx
+                idx += 1
+            pos += 1
+            idx = 0
+        return None
+
+    # ---------------- Public API ----------------
+
+    def __len__(self):
+        return self._len
+
+    def __repr__(self):
+        return 'SortedItem({!r})'.format(list(self))
+
+    def __iter__(self):
+        for sub in self._lists:
+            yield from sub
+
+    def __reversed__(self):
+        for sub in reversed(self._lists):
+            yield from reversed(sub)
+
+    def __contains__(self, value):
+        return self._find(value) is not None
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._len)
+            if step == 1:
+                return list(self._iter_range(start, stop))
+            return [self[i] for i in range(start, stop, step)]
+        pos, idx = self._loc(index)
+        return self._lists[pos][idx]
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._len)
+            positions = range(start, stop, step)
+            if step > 0:
+                positions = reversed(positions)
+            for i in positions:
+                del self[i]
+            return
+        self._delete(*self._loc(index))
+
+    def _iter_range(self, start, stop):
+        if start >= stop:
+            return
+        pos, idx = self._loc(start)
+        remaining = stop - start
+        lists = self._lists
+        while remaining > 0:
+            sub = lists[pos]
+            chunk = sub[idx:idx + remaining]
+            yield from chunk
+            remaining -= len(chunk)
+            pos += 1
+            idx = 0
+
+    def add(self, other):
+        key = other if self._key is None else self._key(other)
+        lists, keys, maxes = self._lists, self._keys, self._maxes
+        if not maxes:
+            lists.append([other])
+            if keys is not lists:
+                keys.append([key])
+            maxes.append(key)
+            self._tree = None
+        else:
+            pos = bisect_right(maxes, key)
+            if pos == len(maxes):
+                pos -= 1
+                maxes[pos] = key
+                keys[pos].append(key)
+                if keys is not lists:
+                    lists[pos].append(other)
+            elif keys is lists:
+                insort(lists[pos], other)
+            else:
+                idx = bisect_right(keys[pos], key)
+                keys[pos].insert(idx, key)
+                lists[pos].insert(idx, other)
+            self._expand(pos)
+        self._len += 1
+
+    def update(self, iterable):
+        values = list(iterable)
+        if not values:
+            return
+        if len(values) * 4 >= self._len:
+            # Cheaper to sort everything again (sort() is fast on sorted runs)
+            values = list(self) + values
+            values.sort(key=self._key)
+            self._reset(values)
+        else:
+            for value in values:
+                self.add(value)
+
+    add_many = update
+
+    def remove(self, value):
+        loc = self._find(value)
+        if loc is None:
+            raise ValueError('{!r} not in SortedItem'.format(value))
+        self._delete(*loc)
+
+    def discard(self, value):
+        loc = self._find(value)
+        if loc is not None:
+            self._delete(*loc)
+
+    def pop(self, index=-1):
+        pos, idx = self._loc(index)
+        value = self._lists[pos][idx]
+        self._delete(pos, idx)
+        return value
+
+    def clear(self):
+        self._reset([])
+
+    def index(self, value, start=0, stop=None):
+        loc = self._find(value)
+        if loc is not None:
+            index = self._offset(loc[0]) + loc[1]
+            if stop is None:
+                stop = self._len
+            if start <= index < stop:
+                return index
+        # Rare cases (equal values around start) are left to the slow generic version
+        return super().index(value, start, stop)
+
+    # ---------------- Range queries ----------------
+
+    def _bisect_key_left(self, key):
+        pos = bisect_left(self._maxes, key)
+        if pos == len(self._maxes):
+            return self._len
+        return self._offset(pos) + bisect_left(self._keys[pos], key)
+
+    def _bisect_key_right(self, key):
+        pos = bisect_right(self._maxes, key)
+        if pos == len(self._maxes):
+            return self._len
+        return self._offset(pos) + bisect_right(self._keys[pos], key)
+
+    def bisect_left(self, value):
+        return self._bisect_key_left(value if self._key is None else self._key(value))
+
+    def bisect_right(self, value):
+        return self._bisect_key_right(value if self._key is None else self._key(value))
+
+    bisect = bisect_right
+
+    def count(self, value):
+        if self._key is None:
+            return self.bisect_right(value) - self.bisect_left(value)
+        key = self._key(value)
+        start, stop = self._bisect_key_left(key), self._bisect_key_right(key)
+        return sum(1 for item in self.islice(start, stop) if item == value)
+
+    def islice(self, start=None, stop=None, reverse=False):
+        # Lazy version of self[start:stop], nothing is copied up front
+        start, stop, _ = slice(start, stop).indices(self._len)
+        if reverse:
+            return self._iter_range_reversed(start, stop)
+        return self._iter_range(start, stop)
+
+    def _iter_range_reversed(self, start, stop):
+        if start >= stop:
+            return
+        pos, idx = self._loc(stop - 1)
+        remaining = stop - start
+        lists = self._lists
+        while remaining > 0:
+            sub = lists[pos]
+            low = max(0, idx + 1 - remaining)
+            chunk = sub[low:idx + 1]
+            yield from reversed(chunk)
+            remaining -= len(chunk)
+            pos -= 1
+            idx = len(lists[pos]) - 1 if pos >= 0 else 0
+
+    def irange(self, minimum=None, maximum=None, inclusive=(True, True), reverse=False):
+        # All items between minimum and maximum, None means no limit on that side
+        key = self._key
+        min_key = None if minimum is None or key is None else key(minimum)
+        max_key = None if maximum is None or key is None else key(maximum)
+        return self.irange_key(minimum if key is None else min_key,
+                               maximum if key is None else max_key,
+                               inclusive, reverse)
+
+    def irange_key(self, min_key=None, max_key=None, inclusive=(True, True), reverse=False):
+        # Same as irange(), but the limits are keys, handy with key=attrgetter('timestamp')
+        if min_key is None:
+            start = 0
+        elif inclusive[0]:
+            start = self._bisect_key_left(min_key)
+        else:
+            start = self._bisect_key_right(min_key)
+        if max_key is None:
+            stop = self._len
+        elif inclusive[1]:
+            stop = self._bisect_key_right(max_key)
+        else:
+            stop = self._bisect_key_left(max_key)
+        return self.islice(start, stop, reverse)
+
+
+def bench_sorted_item(sizes=(1000000, 10000000), inserts=100000, flat_inserts=1000):
+    import random
+    import time
+
+    rand = random.Random(0)
+    for n in sizes:
+        base = sorted(rand.random() for _ in range(n))
+        new = [rand.random() for _ in range(inserts)]
+
+        flat = list(base)
+        start = time.perf_counter()
+        for value in new[:flat_inserts]:
+            insort(flat, value)
+        flat_add = (time.perf_counter() - start) / flat_inserts
+        del flat
+
+        start = time.perf_counter()
+        items = SortedItem(base)
+        build = time.perf_counter() - start
+        start = time.perf_counter()
+        for value in new:
+            items.add(value)
+        chunked_add = (time.perf_counter() - start) / inserts
+
+        positions = [rand.randrange(len(items)) for _ in range(inserts)]
+        start = time.perf_counter()
+        for i in positions:
+            items[i]
+        index = (time.perf_counter() - start) / inserts
+        start = time.perf_counter()
+        for value in new:
+            items.remove(value)
+        remove = (time.perf_counter() - start) / inserts
+        print('n={:>9}: build {:.2f} s, add {:.2f} us (flat insort {:.2f} us), '
+              'index {:.2f} us, remove {:.2f} us'.format(
+                  n, build, chunked_add * 1e6, flat_add * 1e6, index * 1e6, remove * 1e6))
+
+
+# ------------------------------------------ Part 13 -----------------------------------------------------
+
+'''
+    Slicing a SortedItem still gives you a new list, which is a waste when you only want to
+    look at the items between two values. irange() finds both ends with bisect and returns a
+    generator that walks over the sublists, so a window query costs O(log n) to find the start
+    plus the items you actually read.
+
+    window = events.irange_key(start_time, end_time, inclusive=(True, False))
+    last_ten = items.islice(-10, reverse=True)
+    items.bisect_left(42), items.bisect_right(42), items.count(42)
+
+    Several sorted containers (or any sorted iterables, irange() results too) can be walked
+    as one with merge_sorted(). It is heapq.merge(), which only keeps one item per input in
+    memory.
+'''
+
+import heapq
+
+
+def merge_sorted(*iterables, key=None, reverse=False):
+    if key is None:
+        # Use the key of the containers, if they have one
+        key = next((it._key for it in iterables if isinstance(it, SortedItem) and it._key), None)
+    return heapq.merge(*iterables, key=key, reverse=reverse)
+
+
+def bench_range_queries(n=1000000, queries=10000, width=100):
+    import random
+    import time
+
+    rand = random.Random(0)
+    items = SortedItem(range(n))
+    starts = [rand.randrange(n - width) for _ in range(queries)]
+    start = time.perf_counter()
+    for low in starts:
+        [x for x in items[low:] if x < low + width]
+    copy = (time.perf_counter() - start) / queries
+    start = time.perf_counter()
+    for low in starts:
+        list(items.irange(low, low + width, inclusive=(True, False)))
+    lazy = (time.perf_counter() - start) / queries
+    print('n={}: slice and filter {:.0f} us, irange {:.1f} us per query'.format(n, copy * 1e6, lazy * 1e6))
+
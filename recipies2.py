@@ -15,40 +15,184 @@ class Node:
 
 
 class NodeVisitor:
+    '''
+        Handlers are looked up once per node type and kept in a table on the visitor class,
+        instead of building 'visit_' + name and calling getattr() for every node. The lookup
+        walks the MRO of the node type, so visit_Node also handles subclasses of Node that
+        have no handler of their own. Handlers can also be staticmethods, classmethods or
+        set on the visitor instance, those are looked up with getattr() on every call.
+        Handlers that return a plain value instead of a generator are handled right away,
+        without going through the stack.
+    '''
+
     def visit(self, node):
-        stack = [node]
-        last_result = None
-        while stack:
-            try:
-                last = stack[-1]
-                if isinstance(last, types.GeneratorType):
+        dispatch = self._dispatch_table()
+        generator_type = types.GeneratorType
+        stack = []
+        item = node
+        while True:
+            node_type = type(item)
+            func = dispatch.get(node_type)
+            if func is not None or (node_type is not generator_type and isinstance(item, Node)):
+                if func is None:
+                    func = self._lookup(node_type)
+                item = func(self, item)
+                continue
+            if node_type is generator_type:
+                stack.append(item)
+                value = None
+            else:
+                value = item
+            # Resume the generator on top with the last result
+            while stack:
+                try:
                     '''
                         Resumes the execution and "sends" a value into the generator function.
                         The value argument becomes the result of the current yield expression.
                         The send method returns the next value yielded by the generator,
                         or raises StopIteration if the generator exits without yielding another value.
                     '''
-                    stack.append(last.send(last_result))
-                    last_result = None
-                elif isinstance(last, Node):
-                    stack.append(self._visited(stack.pop()))
-                else:
-                    last_result = stack.pop()
-            except StopIteration:
-                stack.pop()
-        return last_result
+                    item = stack[-1].send(value)
+                    break
+                except StopIteration:
+                    stack.pop()
+            else:
+                return value
+
+    def _dispatch_table(self):
+        # Every visitor class gets its own table, subclasses may define other handlers.
+        # An instance with handlers in its own __dict__ gets a table of its own.
+        own = getattr(self, '__dict__', {})
+        table = own.get('_dispatch')
+        if table is not None:
+            return table
+        if any(name.startswith('visit_') for name in own):
+            table = own['_dispatch'] = {}
+            return table
+        cls = type(self)
+        table = cls.__dict__.get('_dispatch')
+        if table is None:
+            table = {}
+            cls._dispatch = table
+        return table
+
+    def _lookup(self, node_type):
+        for klass in node_type.__mro__:
+            meth = self._handler('visit_' + klass.__name__)
+            if meth is not None:
+                break
+        else:
+            meth = self._handler('generic_visit')
+        self._dispatch_table()[node_type] = meth
+        return meth
+
+    def _handler(self, name):
+        # Table entries are called as meth(self, node). Plain functions are stored as they
+        # are, anything else (staticmethod, classmethod, a handler set on the instance)
+        # is bound by getattr() on every call.
+        if name in getattr(self, '__dict__', ()):
+            return _late_bound(name)
+        for klass in type(self).__mro__:
+            if name in vars(klass):
+                attr = vars(klass)[name]
+                return attr if isinstance(attr, types.FunctionType) else _late_bound(name)
+        return None
 
     def _visited(self, node):
-        methname = 'visit_' + type(node).__name__
-        meth = getattr(self, methname, None)
-        if meth is None:
-            meth = self.generic_visit
-        return meth(node)
+        node_type = type(node)
+        meth = self._dispatch_table().get(node_type) or self._lookup(node_type)
+        return meth(self, node)
 
     def generic_visit(self, node):
         raise RuntimeError('No {} method'.format('visit_' + type(node).__name__))
 
 
+def _late_bound(name):
+    def handler(visitor, node):
+        return getattr(visitor, name)(node)
+    return handler
+
+
+def bench_node_visitor(depth=100000, balanced_depth=17):
+    import time
+
+    class OldNodeVisitor:
+        # The visitor before the dispatch table
+        def visit(self, node):
+            stack = [node]
+            last_result = None
+            while stack:
+                try:
+                    last = stack[-1]
+                    if isinstance(last, types.GeneratorType):
+                        stack.append(last.send(last_result))
+                        last_result = None
+                    elif isinstance(last, Node):
+                        stack.append(self._visited(stack.pop()))
+                    else:
+                        last_result = stack.pop()
+                except StopIteration:
+                    stack.pop()
+            return last_result
+
+        def _visited(self, node):
+            methname = 'visit_' + type(node).__name__
+            meth = getattr(self, methname, None)
+            if meth is None:
+                meth = self.generic_visit
+            return meth(node)
+
+    class Number(Node):
+        def __init__(self, value):
+            self.value = value
+
+    class Add(Node):
+        def __init__(self, left, right):
+            self.left = left
+            self.right = right
+
+    class Evaluator:
+        def visit_Number(self, node):
+            return node.value
+
+        def visit_Add(self, node):
+            yield (yield node.left) + (yield node.right)
+
+    class NewEvaluator(Evaluator, NodeVisitor):
+        pass
+
+    class OldEvaluator(Evaluator, OldNodeVisitor):
+        pass
+
+    def recursive(node):
+        if type(node) is Number:
+            return node.value
+        return recursive(node.left) + recursive(node.right)
+
+    deep = Number(0)
+    for i in range(depth):
+        deep = Add(deep, Number(1))
+
+    def balanced(d):
+        return Number(1) if d == 0 else Add(balanced(d - 1), balanced(d - 1))
+    wide = balanced(balanced_depth)
+
+    trees = [('deep ({} levels)'.format(depth), deep),
+             ('balanced ({} nodes)'.format(2 ** (balanced_depth + 1) - 1), wide)]
+    runs = [('old visitor', OldEvaluator().visit),
+            ('new visitor', NewEvaluator().visit),
+            ('recursion', recursive)]
+    for name, tree in trees:
+        for label, run in runs:
+            start = time.perf_counter()
+            try:
+                run(tree)
+            except RecursionError:
+                print('{:<26} {:<12} RecursionError'.format(name, label))
+                continue
+            print('{:<26} {:<12} {:.3f} s'.format(name, label, time.perf_counter() - start))
+
+
 '''
                     You have a program that cycles a structure, and memory problems occur   
     Simple example is a tree, where the parent targets the child and the child back to the parent. When you work with
@@ -67,18 +211,655 @@ class Node:
     def __repr__(self):
         return 'Node({!r:})'.format(self.value)
 
+    # Every change of a public attribute bumps the version of the node and of its cached
+    # parents, IncrementalVisitor uses it to find out what has to be visited again
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if not name.startswith('_'):
+            self.invalidate()
+
+    def invalidate(self):
+        # Only IncrementalVisitor marks nodes clean, and the parents of a dirty node are
+        # dirty too, so the walk stops at the first dirty parent. Trees that are never
+        # visited incrementally pay only for the node itself.
+        self._version = getattr(self, '_version', 0) + 1
+        self._clean = False
+        node = self.parent
+        while node is not None and getattr(node, '_clean', False):
+            node._version += 1
+            node._clean = False
+            node = node.parent
+
     # Property that controls the parent
     @property
     def parent(self):
-        return self._parent if self._parent is None else self._parent
+        ref = getattr(self, '_parent', None)
+        return None if ref is None else ref()
 
     @parent.setter
     def parent(self, node):
-        self._parent = weakref.ref(node)
+        self._parent = None if node is None else weakref.ref(node)
 
     def add_child(self, node):
         self.children.append(node)
-        self._parent = self
+        # Setting the parent also invalidates self and everything above it
+        node.parent = self
+
+    def remove_child(self, node):
+        self.children.remove(node)
+        node.parent = None
+        self.invalidate()
+
+
+'''
+    NodeVisitor runs on one core. A lot of visitors (evaluators, analyzers) compute the result
+    of a subtree only from the subtree itself, so different subtrees can be visited in
+    different processes.
+    ParallelVisitor cuts the tree either at a given depth or into subtrees of at most
+    chunk_size nodes, sends those subtrees to a process pool where the normal visit() and
+    visit_* methods run on them, and then combines the results of the top part of the tree
+    with a reducer: reducer(node, [results of its children]). Without a reducer and without
+    a reduce() method the list of the children's results is passed up as it is.
+
+    class Evaluator(ParallelVisitor):
+        def visit_Number(self, node):
+            return node.value
+
+        def visit_Add(self, node):
+            yield (yield node.left) + (yield node.right)
+
+        def reduce(self, node, results):
+            return sum(results)
+
+    Evaluator().parallel_visit(tree, processes=4, chunk_size=50000)
+
+    Children of a node are its public attributes that hold a Node or a list of Nodes.
+    Pickle is recursive and would hit the recursion limit on deep subtrees, so subtrees are
+    sent as a flat list of (class, attributes) records where links to other nodes are
+    replaced by their position in the list. Weak references to the parent are rebuilt on
+    the other side. Nothing here is recursive, deep trees work as well as wide ones.
+'''
+
+from concurrent.futures import Future, ProcessPoolExecutor
+
+_PLAIN, _NODE, _NODE_LIST, _PARENT_REF = range(4)
+
+
+def _child_kind(name, value):
+    # The one place that decides which attributes link to children
+    if name.startswith('_'):
+        return None
+    if isinstance(value, Node):
+        return _NODE
+    if isinstance(value, (list, tuple)) and value and all(isinstance(v, Node) for v in value):
+        return _NODE_LIST
+    return None
+
+
+def _children(node):
+    kids = []
+    for name, value in vars(node).items():
+        kind = _child_kind(name, value)
+        if kind == _NODE:
+            kids.append(value)
+        elif kind == _NODE_LIST:
+            kids.extend(value)
+    return kids
+
+
+def flatten_tree(root):
+    records = []
+    index = {id(root): 0}
+    order = [root]
+    parents = [None]
+    i = 0
+    while i < len(order):
+        node = order[i]
+        state = []
+        for name, value in vars(node).items():
+            kind = _child_kind(name, value)
+            if kind == _NODE:
+                state.append((name, _NODE, _add_node(value, i, index, order, parents)))
+            elif kind == _NODE_LIST:
+                refs = [_add_node(v, i, index, order, parents) for v in value]
+                state.append((name, _NODE_LIST, (type(value), refs)))
+            elif isinstance(value, weakref.ref):
+                # Only a link back to the parent survives the trip
+                parent = parents[i]
+                is_parent = parent is not None and value() is order[parent]
+                state.append((name, _PARENT_REF if is_parent else _PLAIN, None))
+            else:
+                state.append((name, _PLAIN, value))
+        records.append((type(node), state))
+        i += 1
+    return records
+
+
+def _add_node(node, parent, index, order, parents):
+    n = index.get(id(node))
+    if n is None:
+        n = index[id(node)] = len(order)
+        order.append(node)
+        parents.append(parent)
+    return n
+
+
+def unflatten_tree(records):
+    nodes = [cls.__new__(cls) for cls, state in records]
+    for n, (cls, state) in enumerate(records):
+        attrs = nodes[n].__dict__
+        for name, kind, value in state:
+            if kind == _NODE:
+                attrs[name] = nodes[value]
+            elif kind == _NODE_LIST:
+                container, refs = value
+                attrs[name] = container(nodes[r] for r in refs)
+            else:
+                attrs[name] = value
+    # Parent links point backwards, fix them once every node exists
+    for n, (cls, state) in enumerate(records):
+        for name, kind, value in state:
+            if kind == _NODE:
+                _set_parent_refs(nodes[value], nodes[n], records[value][1])
+            elif kind == _NODE_LIST:
+                for r in value[1]:
+                    _set_parent_refs(nodes[r], nodes[n], records[r][1])
+    return nodes[0] if nodes else None
+
+
+def _set_parent_refs(child, parent, state):
+    for name, kind, value in state:
+        if kind == _PARENT_REF:
+            child.__dict__[name] = weakref.ref(parent)
+
+
+def _visit_flat(visitor, records):
+    return visitor.visit(unflatten_tree(records))
+
+
+class ParallelVisitor(NodeVisitor):
+    def reduce(self, node, results):
+        # Without a reducer a node above the cut gives the list of its children's results
+        return results
+
+    def parallel_visit(self, node, reducer=None, processes=None, depth=None, chunk_size=10000, executor=None):
+        reducer = reducer or self.reduce
+        if depth is None:
+            sizes = _subtree_sizes(node)
+            if sizes[id(node)] <= chunk_size:
+                return self.visit(node)
+
+            def ship(n, level, kids):
+                return sizes[id(n)] <= chunk_size
+        else:
+            def ship(n, level, kids):
+                return level == depth and kids
+
+        own_executor = executor is None
+        if own_executor:
+            executor = ProcessPoolExecutor(processes)
+        try:
+            results = {}
+            order = []          # Nodes above the cut, children before parents
+            stack = [(node, 0, False)]
+            while stack:
+                n, level, expanded = stack.pop()
+                if expanded:
+                    order.append(n)
+                    continue
+                kids = _children(n)
+                if ship(n, level, kids):
+                    results[id(n)] = executor.submit(_visit_flat, self, flatten_tree(n))
+                elif not kids:
+                    results[id(n)] = self.visit(n)
+                else:
+                    stack.append((n, level, True))
+                    for kid in reversed(kids):
+                        stack.append((kid, level + 1, False))
+            for n in order:
+                results[id(n)] = reducer(n, [_result(results[id(kid)]) for kid in _children(n)])
+            return _result(results[id(node)])
+        finally:
+            if own_executor:
+                executor.shutdown()
+
+
+def _result(value):
+    return value.result() if isinstance(value, Future) else value
+
+
+def _subtree_sizes(root):
+    sizes = {}
+    stack = [(root, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if expanded:
+            sizes[id(node)] = 1 + sum(sizes[id(kid)] for kid in _children(node))
+        else:
+            stack.append((node, True))
+            stack.extend((kid, False) for kid in _children(node))
+    return sizes
+
+
+class _BenchNumber(Node):
+    def __init__(self, value):
+        self.value = value
+
+
+class _BenchAdd(Node):
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+
+class _BenchEvaluator(ParallelVisitor):
+    # Module level, the worker processes get these classes by reference
+    def visit__BenchNumber(self, node):
+        # Some work per leaf, so there is something to spread over the processes
+        return sum(range(node.value))
+
+    def visit__BenchAdd(self, node):
+        yield (yield node.left) + (yield node.right)
+
+    def reduce(self, node, results):
+        return sum(results)
+
+
+def bench_parallel_visitor(depth=15, leaf_work=5000, processes=(1, 2, 4)):
+    import time
+
+    def balanced(d):
+        # Built bottom up, without recursion
+        level = [_BenchNumber(leaf_work) for _ in range(2 ** d)]
+        while len(level) > 1:
+            level = [_BenchAdd(level[i], level[i + 1]) for i in range(0, len(level), 2)]
+        return level[0]
+
+    tree = balanced(depth)
+    visitor = _BenchEvaluator()
+    start = time.perf_counter()
+    expected = visitor.visit(tree)
+    print('visit()                      {:.2f} s'.format(time.perf_counter() - start))
+    for n in processes:
+        start = time.perf_counter()
+        result = visitor.parallel_visit(tree, processes=n, depth=4)
+        assert result == expected
+        print('parallel_visit({} processes)  {:.2f} s'.format(n, time.perf_counter() - start))
+
+
+'''
+    Running a visitor again after a small change visits the whole tree, although almost
+    all of it is the same as before. IncrementalVisitor remembers the result of every node
+    together with the version of the node at that time. Changing a node (add_child(),
+    remove_child() or setting one of its attributes) bumps the version of the node and of
+    all its parents, following the weak parent references up to the first parent that
+    was already changed since it was cached. The next visit() takes the
+    result of every node whose version did not change from the cache, so only the path
+    from the changed node up to the root is computed again.
+    Caches compare versions, the dirty flag only stops the walk, so several visitors can
+    cache results of the same tree without resetting each other.
+
+    evaluator = Evaluator()             # class Evaluator(IncrementalVisitor)
+    evaluator.visit(tree)
+    leaf.value = 42
+    evaluator.visit(tree)               # recomputes leaf and its ancestors only
+    evaluator.hits, evaluator.recomputes
+
+    Changing node.children in place (children.append()) can't be seen, use add_child().
+'''
+
+
+class IncrementalVisitor(NodeVisitor):
+    def __init__(self):
+        self._cache = weakref.WeakKeyDictionary()
+        self.hits = 0
+        self.recomputes = 0
+
+    def reset_stats(self):
+        self.hits = 0
+        self.recomputes = 0
+
+    def clear(self):
+        self._cache.clear()
+
+    def visit(self, node):
+        dispatch = self._dispatch_table()
+        generator_type = types.GeneratorType
+        cache = self._cache
+        stack = []              # (generator, node it computes or None, version of that node)
+        item = node
+        while True:
+            node_type = type(item)
+            if node_type is generator_type:
+                stack.append((item, None, None))
+                value = None
+            elif isinstance(item, Node):
+                version = getattr(item, '_version', 0)
+                entry = cache.get(item)
+                if entry is not None and entry[0] == version:
+                    self.hits += 1
+                    value = entry[1]
+                else:
+                    self.recomputes += 1
+                    func = dispatch.get(node_type) or self._lookup(node_type)
+                    result = func(self, item)
+                    if type(result) is generator_type:
+                        stack.append((result, item, version))
+                        value = None
+                    elif isinstance(result, Node):
+                        # Handed over to another node, only that one is cached
+                        item = result
+                        continue
+                    else:
+                        cache[item] = (version, result)
+                        item._clean = True
+                        value = result
+            else:
+                value = item
+            while stack:
+                gen, owner, version = stack[-1]
+                try:
+                    item = gen.send(value)
+                    break
+                except StopIteration:
+                    stack.pop()
+                    if owner is not None:
+                        cache[owner] = (version, value)
+                        owner._clean = True
+            else:
+                return value
+
+
+def bench_incremental_visitor(depth=16):
+    import time
+
+    class Number(Node):
+        def __init__(self, value):
+            self.value = value
+
+    class Add(Node):
+        def __init__(self, left, right):
+            self.left = left
+            self.right = right
+            left.parent = self
+            right.parent = self
+
+    class Evaluator:
+        def visit_Number(self, node):
+            return node.value
+
+        def visit_Add(self, node):
+            yield (yield node.left) + (yield node.right)
+
+    class Plain(Evaluator, NodeVisitor):
+        pass
+
+    class Incremental(Evaluator, IncrementalVisitor):
+        pass
+
+    leaves = [Number(1) for _ in range(2 ** depth)]
+    level = leaves
+    while len(level) > 1:
+        level = [Add(level[i], level[i + 1]) for i in range(0, len(level), 2)]
+    tree = level[0]
+
+    plain, incremental = Plain(), Incremental()
+    incremental.visit(tree)
+    incremental.reset_stats()
+    leaves[12345 % len(leaves)].value = 2
+    start = time.perf_counter()
+    plain_result = plain.visit(tree)
+    middle = time.perf_counter()
+    result = incremental.visit(tree)
+    end = time.perf_counter()
+    assert result == plain_result
+    print('{} nodes, one leaf changed: full visit {:.3f} s, incremental {:.5f} s '
+          '({} recomputed, {} cache hits)'.format(2 ** (depth + 1) - 1, middle - start, end - middle,
+                                                incremental.recomputes, incremental.hits))
+
+
+'''
+    Every Node above is a handful of Python objects: the instance, its __dict__, the list of
+    children and the weak reference to the parent. That is a few hundred bytes per node,
+    for trees with tens of millions of nodes it doesn't fit in memory.
+    TreeStore keeps the whole tree in arrays indexed by an integer node id: parent,
+    first child, last child and next sibling (-1 when there is none), and the values in a
+    separate column (a list, or an array when a typecode is given). TreeNode is a small
+    proxy (store, id) with the same feel as Node, it is created only when asked for.
+
+    store = TreeStore()
+    root = store.node(store.add('root'))
+    child = root.add_child('child')
+    child.parent, root.children, list(store.preorder()), list(store.postorder())
+
+    Ancestor / descendant queries use an Euler tour index: the position of every node in
+    pre-order (tin) and the size of its subtree. a is an ancestor of b when
+    tin[a] < tin[b] < tin[a] + size[a], and the descendants of a are the slice
+    order[tin[a] + 1:tin[a] + size[a]] of the pre-order. The index is built on the first
+    query after a change, so build the tree first and query after.
+    Nodes can only be added, the ids stay valid for the lifetime of the store.
+'''
+
+from array import array
+
+
+class TreeNode:
+    __slots__ = ('store', 'id')
+
+    def __init__(self, store, node_id):
+        self.store = store
+        self.id = node_id
+
+    def __repr__(self):
+        return 'TreeNode({}, {!r:})'.format(self.id, self.value)
+
+    def __eq__(self, other):
+        return isinstance(other, TreeNode) and self.store is other.store and self.id == other.id
+
+    def __hash__(self):
+        return hash((id(self.store), self.id))
+
+    @property
+    def value(self):
+        return self.store.values[self.id]
+
+    @value.setter
+    def value(self, value):
+        self.store.values[self.id] = value
+
+    @property
+    def parent(self):
+        parent = self.store.parents[self.id]
+        return None if parent < 0 else TreeNode(self.store, parent)
+
+    @property
+    def children(self):
+        return [TreeNode(self.store, child) for child in self.store.children(self.id)]
+
+    def add_child(self, value):
+        return TreeNode(self.store, self.store.add(value, self.id))
+
+    def ancestors(self):
+        return [TreeNode(self.store, node_id) for node_id in self.store.ancestors(self.id)]
+
+    def descendants(self):
+        return [TreeNode(self.store, node_id) for node_id in self.store.descendants(self.id)]
+
+    def is_ancestor_of(self, other):
+        return self.store.is_ancestor(self.id, other.id)
+
+
+class TreeStore:
+    # Ids are C ints, that is enough for 2 ** 31 nodes
+    def __init__(self, value_typecode=None):
+        self.parents = array('i')
+        self.first_child = array('i')
+        self.last_child = array('i')
+        self.next_sibling = array('i')
+        self.values = [] if value_typecode is None else array(value_typecode)
+        self.roots = array('i')
+        self._order = None          # Euler tour index, built lazily
+        self._tin = None
+        self._size = None
+
+    def __len__(self):
+        return len(self.parents)
+
+    def node(self, node_id):
+        if not 0 <= node_id < len(self.parents):
+            raise IndexError('no node with id {}'.format(node_id))
+        return TreeNode(self, node_id)
+
+    def add(self, value, parent=-1):
+        node_id = len(self.parents)
+        if parent >= node_id:
+            raise IndexError('no node with id {}'.format(parent))
+        self.values.append(value)
+        self.parents.append(parent)
+        self.first_child.append(-1)
+        self.last_child.append(-1)
+        self.next_sibling.append(-1)
+        if parent < 0:
+            self.roots.append(node_id)
+        else:
+            last = self.last_child[parent]
+            if last < 0:
+                self.first_child[parent] = node_id
+            else:
+                self.next_sibling[last] = node_id
+            self.last_child[parent] = node_id
+        self._order = None
+        return node_id
+
+    @classmethod
+    def from_nodes(cls, root, value_typecode=None):
+        # Converts a tree of Node objects, children are taken the same way as in ParallelVisitor
+        store = cls(value_typecode)
+        stack = [(root, -1)]
+        while stack:
+            node, parent = stack.pop()
+            node_id = store.add(node.value, parent)
+            stack.extend((kid, node_id) for kid in reversed(_children(node)))
+        return store
+
+    def children(self, node_id):
+        child = self.first_child[node_id]
+        next_sibling = self.next_sibling
+        while child >= 0:
+            yield child
+            child = next_sibling[child]
+
+    def _walk_roots(self, root):
+        return self.roots if root is None else (root,)
+
+    def preorder(self, root=None):
+        first_child, next_sibling, parents = self.first_child, self.next_sibling, self.parents
+        for top in self._walk_roots(root):
+            node = top
+            while True:
+                yield node
+                child = first_child[node]
+                if child >= 0:
+                    node = child
+                    continue
+                while node != top and next_sibling[node] < 0:
+                    node = parents[node]
+                if node == top:
+                    break
+                node = next_sibling[node]
+
+    def postorder(self, root=None):
+        first_child, next_sibling, parents = self.first_child, self.next_sibling, self.parents
+        for top in self._walk_roots(root):
+            node = top
+            while first_child[node] >= 0:
+                node = first_child[node]
+            while True:
+                yield node
+                if node == top:
+                    break
+                sibling = next_sibling[node]
+                if sibling >= 0:
+                    node = sibling
+                    while first_child[node] >= 0:
+                        node = first_child[node]
+                else:
+                    node = parents[node]
+
+    def _build_index(self):
+        order = array('i', self.preorder())
+        tin = array('i', bytes(4 * len(order)))
+        for position, node_id in enumerate(order):
+            tin[node_id] = position
+        size = array('i', [1]) * len(order)
+        parents = self.parents
+        for node_id in reversed(order):
+            parent = parents[node_id]
+            if parent >= 0:
+                size[parent] += size[node_id]
+        self._order, self._tin, self._size = order, tin, size
+
+    def is_ancestor(self, ancestor, node_id):
+        if self._order is None:
+            self._build_index()
+        start = self._tin[ancestor]
+        return start < self._tin[node_id] < start + self._size[ancestor]
+
+    def descendants(self, node_id):
+        if self._order is None:
+            self._build_index()
+        start = self._tin[node_id]
+        return self._order[start + 1:start + self._size[node_id]]
+
+    def subtree_size(self, node_id):
+        if self._order is None:
+            self._build_index()
+        return self._size[node_id]
+
+    def ancestors(self, node_id):
+        parents = self.parents
+        result = []
+        node_id = parents[node_id]
+        while node_id >= 0:
+            result.append(node_id)
+            node_id = parents[node_id]
+        return result
+
+
+def bench_tree_store(count=200000, fanout=4):
+    import time
+    import tracemalloc
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    nodes = [Node(0)]
+    for i in range(1, count):
+        node = Node(i)
+        nodes[(i - 1) // fanout].add_child(node)
+        nodes.append(node)
+    node_time = time.perf_counter() - start
+    node_memory = tracemalloc.get_traced_memory()[0]
+    del nodes, node
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    store = TreeStore('q')
+    for i in range(count):
+        store.add(i, (i - 1) // fanout if i else -1)
+    store_time = time.perf_counter() - start
+    store_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print('{} nodes'.format(count))
+    print('Node objects  {:7.1f} bytes/node  build {:.2f} s'.format(node_memory / count, node_time))
+    print('TreeStore     {:7.1f} bytes/node  build {:.2f} s'.format(store_memory / count, store_time))
+    start = time.perf_counter()
+    visited = sum(1 for _ in store.preorder())
+    print('preorder      {:.2f} s for {} nodes'.format(time.perf_counter() - start, visited))
+    start = time.perf_counter()
+    below = len(store.descendants(1))
+    print('index + descendants(1) {:.3f} s, {} nodes'.format(time.perf_counter() - start, below))
 
 
 '''
@@ -113,7 +894,8 @@ _spam_cache = weakref.WeakValueDictionary()
 def get_spam(name):
     if name not in _spam_cache:
         s = Spam(name)
-        _spam_cache[name] = name
+        _spam_cache[name] = s
+        return s
     else:
         return _spam_cache[name]
 
@@ -130,7 +912,7 @@ class Spam:
         if name in cls._spam_cache:
             return cls._spam_cache[name]
         else:
-            self = super().__new__()
+            self = super().__new__(cls)
             cls._spam_cache[name] = self
             return self
 
@@ -173,23 +955,267 @@ class Spam:
     '''
 
 
+'''
+    All the caches above check whether the name is cached and then create the object. When
+    two threads ask for the same missing name at the same time, both create it, and the
+    __new__ variant also runs __init__ again on every cache hit.
+    SingleFlight makes sure there is only one call in flight for a key: the first caller
+    runs the function, the others that come while it runs wait for it and get the same
+    result (or the same exception). Every key has its own lock, callers of different keys
+    never wait for each other. AsyncSingleFlight does the same for coroutines, they all
+    await one shared task.
+
+    flight = SingleFlight()
+    flight.do(name, build, name)
+    await async_flight.do(name, async_build, name)
+
+    CachedInstanceMeta uses it for the classes that cache their instances: instances are
+    created (and __init__ runs) once per arguments, also when threads race.
+
+    class Spam(metaclass=CachedInstanceMeta):
+        def __init__(self, name):
+            self.name = name
+'''
+
+import asyncio
+import threading
+
+
+class _Call:
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        # Held by the caller that runs the function until it is finished, a plain lock
+        # is much cheaper to create than an Event
+        self.done = threading.Lock()
+        self.done.acquire()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._pending = {}
+
+    def do(self, key, func, *args):
+        call = _Call()
+        # setdefault is atomic, so exactly one caller becomes the one who runs func
+        current = self._pending.setdefault(key, call)
+        if current is not call:
+            with current.done:
+                pass
+            if current.error is not None:
+                raise current.error
+            return current.value
+        try:
+            call.value = func(*args)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            del self._pending[key]
+            call.done.release()
+        return call.value
+
+    def in_flight(self):
+        return len(self._pending)
+
+
+class AsyncSingleFlight:
+    def __init__(self):
+        self._pending = {}
+
+    async def do(self, key, func, *args):
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args))
+            self._pending[key] = task
+            task.add_done_callback(lambda _, key=key: self._pending.pop(key, None))
+        # A cancelled caller must not cancel the task the others are waiting for
+        return await asyncio.shield(task)
+
+    def in_flight(self):
+        return len(self._pending)
+
+
+class CachedInstanceMeta(type):
+    def __init__(cls, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        cls._instances = weakref.WeakValueDictionary()
+        cls._flight = SingleFlight()
+
+    def __call__(cls, *args):
+        instance = cls._instances.get(args)
+        if instance is None:
+            instance = cls._flight.do(args, cls._create_instance, *args)
+        return instance
+
+    def _create_instance(cls, *args):
+        # Somebody may have finished creating it between the lookup and do()
+        instance = cls._instances.get(args)
+        if instance is None:
+            instance = super().__call__(*args)
+            cls._instances[args] = instance
+        return instance
+
+
+'''
+    The weak cache forgets an object as soon as the last reference to it is gone. Code that
+    creates an object, uses it and drops it (for example once per request) builds the same
+    object again every time.
+    CachedSpamManager can keep the most recently used objects alive with a strong LRU tier
+    in front of the weak one. The strong tier is bounded by the number of objects (maxsize)
+    and/or by their estimated size in bytes (maxbytes, estimated with sizeof). Objects pushed
+    out of the strong tier stay in the weak tier as long as someone still uses them.
+    With ttl every object is created again after ttl seconds, no matter in which tier it is.
+
+    manager = CachedSpamManager(maxsize=1000, ttl=60)
+    manager.get_spam('foo')
+    manager.hits, manager.misses, manager.evictions
+
+    Without maxsize or maxbytes (the default) it is the plain weak cache from above.
+    The manager is thread safe. A short lock protects the bookkeeping of the tiers, objects
+    are created outside of it with a SingleFlight, so a name is created once even when many
+    threads ask for it at the same time. async_get_spam() is the coroutine version, it
+    creates objects with async_factory, or with factory in the default executor.
+'''
+
+import sys
+import time
 import weakref
+from collections import OrderedDict
 
 
 class CachedSpamManager:
-    def __init__(self):
+    def __init__(self, maxsize=0, maxbytes=None, ttl=None, factory=None, sizeof=sys.getsizeof,
+                 clock=time.monotonic, async_factory=None):
         self._cache = weakref.WeakValueDictionary()
+        self._strong = OrderedDict()        # name -> (object, size)
+        self._deadlines = {}                # name -> time when the object expires, only with ttl
+        self._bytes = 0
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self._factory = factory
+        self._async_factory = async_factory
+        self._sizeof = sizeof
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self._async_flight = AsyncSingleFlight()
+        self._clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
     def get_spam(self, name):
-        if name not in self._cache:
-            s = Spam(name)
-            self._cache[name] = s
-        else:
-            s = self._cache[name]
-            return s
+        with self._lock:
+            s = self._lookup(name)
+        if s is None:
+            s = self._flight.do(name, self._create, name)
+        return s
+
+    async def async_get_spam(self, name):
+        with self._lock:
+            s = self._lookup(name)
+        if s is None:
+            s = await self._async_flight.do(name, self._async_create, name)
+        return s
+
+    def _lookup(self, name):
+        strong = self._strong
+        if self.ttl is not None and name in self._deadlines and self._clock() >= self._deadlines[name]:
+            self._drop(name)
+        entry = strong.get(name)
+        if entry is not None:
+            strong.move_to_end(name)
+            self.hits += 1
+            return entry[0]
+        s = self._cache.get(name)
+        if s is not None:
+            self.hits += 1
+            self._keep(name, s)
+        return s
+
+    def _create(self, name):
+        with self._lock:
+            # The previous flight for this name may have finished after our lookup
+            s = self._lookup(name)
+        if s is None:
+            s = self._store(name, (self._factory or Spam)(name))
+        return s
+
+    async def _async_create(self, name):
+        with self._lock:
+            s = self._lookup(name)
+        if s is None:
+            if self._async_factory is not None:
+                s = await self._async_factory(name)
+            else:
+                loop = asyncio.get_running_loop()
+                s = await loop.run_in_executor(None, self._factory or Spam, name)
+            s = self._store(name, s)
+        return s
+
+    def _store(self, name, s):
+        with self._lock:
+            self.misses += 1
+            try:
+                self._cache[name] = s
+            except TypeError:
+                # Can't be weakly referenced (int, str, tuple...), only the strong tier keeps it
+                pass
+            if self.ttl is not None:
+                self._deadlines[name] = self._clock() + self.ttl
+                if len(self._deadlines) > 2 * (len(self._cache) + self.maxsize) + 16:
+                    self._prune_deadlines()
+            self._keep(name, s)
+        return s
+
+    def _keep(self, name, s):
+        if not self.maxsize and self.maxbytes is None:
+            return
+        # The name may be kept already, e.g. when get_spam() and async_get_spam() both created it
+        old = self._strong.pop(name, None)
+        if old is not None:
+            self._bytes -= old[1]
+        size = self._sizeof(s) if self.maxbytes is not None else 0
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        self._strong[name] = (s, size)
+        self._bytes += size
+        while ((self.maxsize and len(self._strong) > self.maxsize)
+               or (self.maxbytes is not None and self._bytes > self.maxbytes)):
+            _, (_, size) = self._strong.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+
+    def _prune_deadlines(self):
+        # Names that were dropped from the weak tier don't need a deadline anymore
+        cache = self._cache
+        self._deadlines = {name: deadline for name, deadline in self._deadlines.items() if name in cache}
+
+    def invalidate(self, name):
+        with self._lock:
+            self._drop(name)
+
+    def _drop(self, name):
+        entry = self._strong.pop(name, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+        self._cache.pop(name, None)
+        self._deadlines.pop(name, None)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'strong': len(self._strong), 'strong_bytes': self._bytes, 'weak': len(self._cache)}
 
     def clear(self):
-        self._cache.clear()
+        with self._lock:
+            self._strong.clear()
+            self._cache.clear()
+            self._deadlines.clear()
+            self._bytes = 0
 
 
 class Spam:
@@ -200,3 +1226,717 @@ class Spam:
 
     def get_spam(name):
         return Spam.manager.get_spam(name)
+
+
+def bench_spam_cache(requests=200000, names=500, maxsize=1000):
+    import random
+
+    class Expensive:
+        created = 0
+
+        def __init__(self, name):
+            Expensive.created += 1
+            self.name = name
+            self.data = [name] * 100
+
+    rng = random.Random(1)
+    sequence = [rng.randrange(names) for _ in range(requests)]
+    for label, size in (('weak only', 0), ('weak + LRU({})'.format(maxsize), maxsize)):
+        Expensive.created = 0
+        manager = CachedSpamManager(maxsize=size, factory=Expensive)
+        start = time.perf_counter()
+        for name in sequence:
+            spam = manager.get_spam(name)       # used and dropped right away
+            del spam
+        print('{:16} {:.2f} s  {:7} created  hit rate {:.1%}'.format(
+            label, time.perf_counter() - start, Expensive.created, manager.hits / requests))
+
+
+def bench_single_flight(threads=32, keys=4, build_time=0.05, rounds=3):
+    from concurrent.futures import ThreadPoolExecutor
+
+    created = []
+    created_lock = threading.Lock()
+
+    def build(name):
+        with created_lock:
+            created.append(name)
+        time.sleep(build_time)          # stands for an expensive constructor
+        return Spam(name)
+
+    def racy_get(cache, name):
+        if name not in cache:
+            cache[name] = build(name)
+        return cache[name]
+
+    names = [i % keys for i in range(threads)]
+
+    def timed(get, name):
+        start = time.perf_counter()
+        get(name)
+        return time.perf_counter() - start
+
+    for label in ('check then create', 'SingleFlight'):
+        del created[:]
+        latencies = []
+        start = time.perf_counter()
+        for _ in range(rounds):
+            if label == 'SingleFlight':
+                manager = CachedSpamManager(maxsize=keys, factory=build)
+                get = manager.get_spam
+            else:
+                cache = {}
+                get = lambda name, cache=cache: racy_get(cache, name)
+            with ThreadPoolExecutor(threads) as pool:
+                latencies.extend(pool.map(lambda name: timed(get, name), names))
+        latencies.sort()
+        print('{:18} {:4} created for {} keys x {} rounds, p50 {:.3f} s, max {:.3f} s, total {:.2f} s'.format(
+            label, len(created), keys, rounds, latencies[len(latencies) // 2], latencies[-1],
+            time.perf_counter() - start))
+    assert len(created) == keys * rounds
+
+    # A slow key must not hold back the others
+    manager = CachedSpamManager(factory=lambda name: build(name) if name != 'slow' else time.sleep(1) or Spam(name))
+    slow = threading.Thread(target=manager.get_spam, args=('slow',))
+    slow.start()
+    time.sleep(0.01)
+    elapsed = timed(manager.get_spam, 'fast')
+    slow.join()
+    print('other key while a slow one is built: {:.3f} s'.format(elapsed))
+    assert elapsed < 0.5
+
+    async def async_build(name):
+        created.append(name)
+        await asyncio.sleep(build_time)
+        return Spam(name)
+
+    async def run_async():
+        manager = CachedSpamManager(maxsize=keys, async_factory=async_build)
+        return await asyncio.gather(*(manager.async_get_spam(name) for name in names))
+
+    del created[:]
+    start = time.perf_counter()
+    results = asyncio.run(run_async())
+    print('asyncio: {} coroutines, {} created, {:.3f} s'.format(len(results), len(created),
+                                                               time.perf_counter() - start))
+    assert len(created) == keys and results[0] is results[keys]
+
+    class Cached(metaclass=CachedInstanceMeta):
+        inits = 0
+
+        def __init__(self, name):
+            type(self).inits += 1
+            time.sleep(build_time)
+            self.name = name
+
+    with ThreadPoolExecutor(threads) as pool:
+        instances = list(pool.map(Cached, names))
+    print('CachedInstanceMeta: {} instances asked, __init__ ran {} times'.format(len(instances), Cached.inits))
+    assert Cached.inits == keys and Cached('x') is Cached('x')
+
+
+'''
+    Every process has its own CachedSpamManager, so N worker processes build and keep N
+    copies of the same objects. SharedCacheServer is a cache process the workers share:
+    the first worker that needs a name builds the object and publishes it, the server copies
+    it into a shared memory segment, and every other worker maps that segment instead of
+    building the object again.
+
+    start_shared_cache(('localhost', 25002), authkey=b'peekaboo', maxbytes=2 ** 30)
+
+    # In every worker
+    cache = SharedSpamCache(('localhost', 25002), authkey=b'peekaboo', factory=build_spam)
+    spam = cache.get_spam('foo')
+    cache.invalidate('foo')        # removes it from the server and from every worker
+
+    - bytes, bytearray, array.array and numpy arrays are used zero-copy: get_spam() returns
+      a read-only memoryview (cast to the typecode of the array) or a read-only numpy array
+      over the shared memory. Everything else is pickled and unpickled by every worker.
+    - While one worker builds a name, other workers asking for it wait for it instead of
+      building it too (for at most lease_timeout seconds, or until the builder disconnects).
+    - The server keeps at most maxbytes of values and evicts the least recently used ones.
+      Evicted values stay valid in the workers that already have them.
+    - invalidate() is broadcast to all workers over a second connection that every
+      SharedSpamCache keeps open, they drop the name from their local cache.
+    - Every worker keeps the values it got in a local CachedSpamManager (keyword arguments
+      are passed to it, maxsize defaults to 128 here), so repeated lookups don't even talk
+      to the server. A zero-copy value asked for again maps the segment the worker already
+      has instead of attaching it again.
+    Mappings of replaced or invalidated zero-copy values may still be in use, those are kept
+    until the SharedSpamCache is closed. Segments are removed by the server when it is closed, a
+    killed server can leave them behind in /dev/shm.
+'''
+
+import os
+import pickle
+import socket
+from multiprocessing import resource_tracker, shared_memory
+
+from concurrency import MessageServer, connect
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_PICKLED, _BYTES, _ARRAY, _NDARRAY = range(4)
+
+
+def _encode(value):
+    # Returns (kind, meta, buffer)
+    if isinstance(value, (bytes, bytearray)):
+        return _BYTES, None, value
+    if isinstance(value, array):
+        return _ARRAY, value.typecode, memoryview(value).cast('B')
+    if np is not None and isinstance(value, np.ndarray) and not value.dtype.hasobject:
+        value = np.ascontiguousarray(value)
+        return _NDARRAY, (value.dtype.str, value.shape), memoryview(value.reshape(-1).view(np.uint8))
+    return _PICKLED, None, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+_own_segments = set()          # segments created by a server in this process
+
+
+def _attach(name):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, track=False)
+    # Before 3.13 attaching registers the segment with the resource tracker, which removes
+    # it when the process exits, but the server owns it. When the server runs in this
+    # process the registration is its own and has to stay.
+    shm = shared_memory.SharedMemory(name)
+    if shm.name not in _own_segments:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+class SharedCacheServer(MessageServer):
+    # Connections, threads and message dispatch come from MessageServer in concurrency.py,
+    # the handlers get the connection as their first argument
+    def __init__(self, address, authkey, maxbytes=256 * 2 ** 20, lease_timeout=30.0):
+        super().__init__(address, authkey)
+        self._cond = threading.Condition()
+        self._entries = OrderedDict()       # key -> (segment, nbytes, kind, meta)
+        self._building = {}                 # key -> connection of the worker that builds it
+        self._subscribers = {}              # connection -> lock for sending to it
+        self._bytes = 0
+        self.maxbytes = maxbytes
+        self.lease_timeout = lease_timeout
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def serve_forever(self):
+        try:
+            super().serve_forever()
+        finally:
+            self._unlink_all()
+
+    def close(self):
+        super().close()
+        self._unlink_all()
+
+    def _unlink_all(self):
+        with self._cond:
+            for key in list(self._entries):
+                self._remove(key)
+
+    def _client_done(self, conn, client_args):
+        with self._cond:
+            for key in [key for key, builder in self._building.items() if builder is conn]:
+                del self._building[key]
+            self._subscribers.pop(conn, None)
+            self._cond.notify_all()
+
+    def _remove(self, key):
+        segment, nbytes, _, _ = self._entries.pop(key)
+        self._bytes -= nbytes
+        segment.close()
+        segment.unlink()
+        _own_segments.discard(segment.name)
+
+    def _op_subscribe(self, conn):
+        # From now on only the server writes to this connection
+        with self._cond:
+            self._subscribers[conn] = threading.Lock()
+        return ('ok',)
+
+    def _op_get(self, conn, key):
+        deadline = None
+        with self._cond:
+            while True:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    segment, nbytes, kind, meta = entry
+                    return ('found', segment.name, nbytes, kind, meta)
+                builder = self._building.get(key)
+                if builder is None or builder is conn:
+                    self.misses += 1
+                    self._building[key] = conn
+                    return ('build',)
+                if deadline is None:
+                    deadline = time.monotonic() + self.lease_timeout
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    # The builder takes too long, build it here as well
+                    self.misses += 1
+                    return ('build',)
+                self._cond.wait(remaining)
+
+    def _op_put(self, conn, key, kind, meta, nbytes):
+        segment = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        _own_segments.add(segment.name)
+        conn.recv_bytes_into(segment.buf)
+        with self._cond:
+            if self._building.get(key) is conn:
+                del self._building[key]
+            self._cond.notify_all()
+            if nbytes > self.maxbytes:
+                segment.close()
+                segment.unlink()
+                _own_segments.discard(segment.name)
+                return ('ok', False)
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (segment, nbytes, kind, meta)
+            self._bytes += nbytes
+            while self._bytes > self.maxbytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        return ('ok', True)
+
+    def _op_abandon(self, conn, key):
+        with self._cond:
+            if self._building.get(key) is conn:
+                del self._building[key]
+                self._cond.notify_all()
+        return ('ok',)
+
+    def _op_invalidate(self, conn, key):
+        with self._cond:
+            if key in self._entries:
+                self._remove(key)
+            subscribers = list(self._subscribers.items())
+        # A slow subscriber must not hold up the other cache operations
+        for subscriber, lock in subscribers:
+            try:
+                with lock:
+                    subscriber.send(('invalidate', key))
+            except OSError:
+                with self._cond:
+                    self._subscribers.pop(subscriber, None)
+        return ('ok',)
+
+    def _op_stats(self, conn):
+        with self._cond:
+            return ('ok', {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                           'entries': len(self._entries), 'bytes': self._bytes,
+                           'subscribers': len(self._subscribers)})
+
+
+def run_shared_cache(address, authkey, maxbytes=256 * 2 ** 20, lease_timeout=30.0):
+    SharedCacheServer(address, authkey, maxbytes, lease_timeout).serve_forever()
+
+
+def start_shared_cache(address, authkey, maxbytes=256 * 2 ** 20, lease_timeout=30.0):
+    import multiprocessing
+    p = multiprocessing.Process(target=run_shared_cache, args=(address, authkey, maxbytes, lease_timeout),
+                                daemon=True)
+    p.start()
+    return p
+
+
+class SharedSpamCache:
+    def __init__(self, address, authkey, factory=None, retry=5.0, **local):
+        self._conn = connect(address, authkey, retry)
+        self._conn_lock = threading.Lock()
+        self._events = connect(address, authkey, retry)
+        self._events.send(('subscribe',))
+        self._events.recv()
+        self._factory = factory
+        self._segments = {}         # key -> segment behind a zero-copy value
+        self._retired = []          # segments of invalidated values, maybe still in use
+        self.builds = 0
+        # Unpickled values are often dicts or lists, which the weak tier alone can't hold
+        local.setdefault('maxsize', 128)
+        self.local = CachedSpamManager(factory=self._load, **local)
+        self._stopping = False
+        self._listener = threading.Thread(target=self._listen, daemon=True)
+        self._listener.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _call(self, *msg, payload=None):
+        with self._conn_lock:
+            self._conn.send(msg)
+            if payload is not None:
+                self._conn.send_bytes(payload)
+            reply = self._conn.recv()
+        if reply[0] == 'error':
+            raise RuntimeError(reply[1])
+        return reply
+
+    def _listen(self):
+        try:
+            while not self._stopping:
+                op, key = self._events.recv()
+                if op == 'invalidate':
+                    self._forget(key)
+        except (EOFError, OSError):
+            pass
+
+    def _forget(self, name):
+        self.local.invalidate(name)
+        segment = self._segments.pop(name, None)
+        if segment is not None:
+            self._retire(segment)
+
+    def _retire(self, segment):
+        try:
+            segment.close()
+        except BufferError:
+            # A value over it is still in use, close it with the cache
+            self._retired.append(segment)
+
+    def get_spam(self, name):
+        return self.local.get_spam(name)
+
+    def _load(self, name):
+        reply = self._call('get', name)
+        if reply[0] == 'found':
+            return self._map(name, *reply[1:])
+        try:
+            self.builds += 1
+            value = (self._factory or Spam)(name)
+        except BaseException:
+            self._call('abandon', name)
+            raise
+        kind, meta, payload = _encode(value)
+        payload = memoryview(payload)
+        self._call('put', name, kind, meta, payload.nbytes, payload=payload)
+        return value
+
+    def _map(self, name, segment_name, nbytes, kind, meta):
+        if kind == _PICKLED:
+            segment = _attach(segment_name)
+            try:
+                with segment.buf[:nbytes] as view:
+                    return pickle.loads(view)
+            finally:
+                segment.close()
+        segment = self._segments.get(name)
+        if segment is None or segment.name != segment_name:
+            # First time, or the server has a new segment for the name (evicted and built again)
+            if segment is not None:
+                self._retire(segment)
+            segment = self._segments[name] = _attach(segment_name)
+        view = segment.buf[:nbytes].toreadonly()
+        if kind == _BYTES:
+            return view
+        if kind == _ARRAY:
+            return view.cast(meta)
+        dtype, shape = meta
+        return np.frombuffer(view, dtype=dtype).reshape(shape)
+
+    def invalidate(self, name):
+        self._call('invalidate', name)
+        # Don't wait for our own broadcast, the next get_spam() must not see the old value
+        self._forget(name)
+
+    def stats(self):
+        stats = {'local': self.local.stats(), 'builds': self.builds}
+        stats['server'] = self._call('stats')[1]
+        return stats
+
+    def close(self):
+        # Wake the listener up with a shutdown of its socket, closing the connection under
+        # a thread blocked in recv() breaks it in odd ways
+        self._stopping = True
+        try:
+            with socket.socket(fileno=os.dup(self._events.fileno())) as sock:
+                sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._listener.join()
+        self.local.clear()
+        self._conn.close()
+        self._events.close()
+        for segment in list(self._segments.values()) + self._retired:
+            try:
+                segment.close()
+            except BufferError:
+                # Somebody still uses a view of it, the mapping goes away with the process
+                pass
+        self._segments.clear()
+        del self._retired[:]
+
+
+def _bench_build(build_time, size, name):
+    time.sleep(build_time)
+    return array('d', [float(len(str(name)))]) * (size // 8)
+
+
+def _shared_cache_worker(address, authkey, names, build_time, size, shared):
+    import functools
+    factory = functools.partial(_bench_build, build_time, size)
+    if shared:
+        cache = SharedSpamCache(address, authkey, factory=factory, maxsize=len(names))
+        for name in names:
+            assert cache.get_spam(name)[0] == len(str(name))
+        builds = cache.builds
+        cache.close()
+        return builds
+    manager = CachedSpamManager(maxsize=len(names), factory=factory)
+    for name in names:
+        manager.get_spam(name)
+    return manager.misses
+
+
+def bench_shared_cache(workers=4, names=20, build_time=0.05, size=2 ** 20):
+    import multiprocessing
+    import random
+
+    address, authkey = ('localhost', 0), b'bench'
+    server = SharedCacheServer(address, authkey, maxbytes=names * size * 2)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        for shared in (False, True):
+            jobs = []
+            for i in range(workers):
+                order = list(range(names))
+                random.Random(i).shuffle(order)
+                jobs.append((server.address, authkey, order, build_time, size, shared))
+            start = time.perf_counter()
+            with multiprocessing.Pool(workers) as pool:
+                builds = sum(pool.starmap(_shared_cache_worker, jobs))
+            # Every built value is held once, by the worker or by the server
+            print('{:24} {} workers x {} names of {} KiB: {:3} built, {:4} MiB held, {:.2f} s'.format(
+                'shared cache' if shared else 'cache per process', workers, names, size // 1024, builds,
+                builds * size // 2 ** 20, time.perf_counter() - start))
+
+        with SharedSpamCache(server.address, authkey, factory=lambda name: b'payload') as a, \
+                SharedSpamCache(server.address, authkey, factory=lambda name: b'changed') as b:
+            first = bytes(a.get_spam('key'))
+            assert bytes(b.get_spam('key')) == first and b.builds == 0
+            a.invalidate('key')
+            time.sleep(0.1)             # the broadcast is asynchronous
+            assert bytes(b.get_spam('key')) == b'changed'
+            print('invalidation broadcast ok, server stats {}'.format(a.stats()['server']))
+    finally:
+        server.close()
+
+
+'''
+    get_spam(name) gives one object per name. With tens of millions of names every object
+    costs its instance and __dict__, and the WeakValueDictionary adds a weak reference with a
+    callback per entry.
+    InternTable gives every key a small integer handle instead, and keeps the state of the
+    instances in array columns indexed by the handle, one column per field. handle() returns
+    a Flyweight, a two-slot proxy with a property per field, created only when asked for.
+
+    table = InternTable(count='q', score='d')
+    h = table.acquire('foo')            # the same handle for the same key
+    table.set(h, 'count', 1)            # or table.handle(h).count = 1
+    table.key(h), table.get(h, 'score')
+    table.release(h)
+
+    Entries are reclaimed in one of two ways, no weak references involved:
+    - acquire() / release() count references, the entry is freed when the count drops to 0.
+    - intern() doesn't count, it only stamps the entry with the current generation.
+      sweep(keep) frees the entries without references that were not used in the last keep
+      generations, and starts a new generation. Call it every request, every minute...
+    Freed handles are reused, so don't keep a handle after releasing it.
+    Fields are typed (array typecodes), a field given as None is kept in a list and can hold
+    any object.
+'''
+
+
+class Flyweight:
+    __slots__ = ('table', 'handle')
+
+    def __init__(self, table, handle):
+        self.table = table
+        self.handle = handle
+
+    def __repr__(self):
+        return '{}({!r:})'.format(type(self).__name__, self.table.key(self.handle))
+
+    def __eq__(self, other):
+        return isinstance(other, Flyweight) and self.table is other.table and self.handle == other.handle
+
+    def __hash__(self):
+        return hash((id(self.table), self.handle))
+
+    @property
+    def key(self):
+        return self.table.key(self.handle)
+
+
+def _flyweight_field(name):
+    def fget(self):
+        return self.table.columns[name][self.handle]
+
+    def fset(self, value):
+        self.table.columns[name][self.handle] = value
+    return property(fget, fset)
+
+
+class InternTable:
+    def __init__(self, **fields):
+        self._handles = {}                  # key -> handle
+        self._keys = []                     # handle -> key, None when free
+        self._refs = array('I')
+        self._generations = array('I')
+        self._free = array('I')
+        self.generation = 0
+        self.fields = fields
+        self.columns = {name: [] if typecode is None else array(typecode) for name, typecode in fields.items()}
+        self._defaults = {name: None if typecode is None else array(typecode, [0])[0]
+                          for name, typecode in fields.items()}
+        self._flyweight = type('Flyweight', (Flyweight,),
+                               dict({name: _flyweight_field(name) for name in fields}, __slots__=()))
+
+    def __len__(self):
+        return len(self._handles)
+
+    def __contains__(self, key):
+        return key in self._handles
+
+    def _new(self, key):
+        if self._free:
+            handle = self._free.pop()
+            self._keys[handle] = key
+            self._refs[handle] = 0
+            for name, column in self.columns.items():
+                column[handle] = self._defaults[name]
+        else:
+            handle = len(self._keys)
+            self._keys.append(key)
+            self._refs.append(0)
+            self._generations.append(0)
+            for name, column in self.columns.items():
+                column.append(self._defaults[name])
+        self._handles[key] = handle
+        return handle
+
+    def intern(self, key):
+        if key is None:
+            raise TypeError('None can not be interned')
+        handle = self._handles.get(key)
+        if handle is None:
+            handle = self._new(key)
+        self._generations[handle] = self.generation
+        return handle
+
+    def acquire(self, key):
+        handle = self.intern(key)
+        self._refs[handle] += 1
+        return handle
+
+    def release(self, handle):
+        refs = self._refs[handle]
+        if refs == 0:
+            raise ValueError('handle {} has no references'.format(handle))
+        self._refs[handle] = refs - 1
+        if refs == 1:
+            self._free_handle(handle)
+
+    def _free_handle(self, handle):
+        del self._handles[self._keys[handle]]
+        self._keys[handle] = None
+        for name, column in self.columns.items():
+            if self.fields[name] is None:
+                column[handle] = None       # don't keep the objects alive
+        self._free.append(handle)
+
+    def sweep(self, keep=1):
+        oldest = self.generation - keep
+        refs, generations, keys = self._refs, self._generations, self._keys
+        freed = 0
+        for handle in range(len(keys)):
+            if keys[handle] is not None and refs[handle] == 0 and generations[handle] <= oldest:
+                self._free_handle(handle)
+                freed += 1
+        self.generation += 1
+        return freed
+
+    def lookup(self, key):
+        return self._handles.get(key)
+
+    def key(self, handle):
+        key = self._keys[handle]
+        if key is None:
+            raise KeyError('handle {} is free'.format(handle))
+        return key
+
+    def refs(self, handle):
+        return self._refs[handle]
+
+    def get(self, handle, field):
+        return self.columns[field][handle]
+
+    def set(self, handle, field, value):
+        self.columns[field][handle] = value
+
+    def handle(self, handle):
+        return self._flyweight(self, handle)
+
+    def __getitem__(self, key):
+        return self.handle(self.intern(key))
+
+
+def bench_intern_table(count=200000):
+    import gc
+    import tracemalloc
+
+    names = ['spam-{}'.format(i) for i in range(count)]
+
+    class Spam:
+        def __init__(self, name):
+            self.name = name
+            self.count = 0
+            self.score = 0.0
+
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    cache = weakref.WeakValueDictionary()
+    alive = []
+    for name in names:
+        spam = Spam(name)
+        spam.count = 1
+        cache[name] = spam
+        alive.append(spam)
+    weak_time = time.perf_counter() - start
+    weak_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del cache, alive, spam
+
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    table = InternTable(count='q', score='d')
+    counts = table.columns['count']
+    for name in names:
+        counts[table.acquire(name)] = 1
+    table_time = time.perf_counter() - start
+    table_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print('{} names (the name strings themselves are not counted)'.format(count))
+    print('Spam objects + WeakValueDictionary  {:6.1f} bytes/entry  {:.2f} s'.format(weak_memory / count, weak_time))
+    print('InternTable(count, score)           {:6.1f} bytes/entry  {:.2f} s'.format(table_memory / count, table_time))
+
+    for name in names[::2]:
+        table.release(table.lookup(name))
+    print('released half: {} entries left, {} free handles'.format(len(table), len(table._free)))
+    for i in range(count // 2):
+        table.intern('temporary-{}'.format(i))
+    table.sweep()
+    freed = table.sweep()
+    print('interned {} more without references, swept: {} freed, {} entries'.format(count // 2, freed, len(table)))